@@ -0,0 +1,484 @@
+"""Нагрузочный тест бота целиком через поддельный Bot API.
+
+Запускает бота в режиме bot.polling против локального FakeBotAPI и
+моделирует тысячи виртуальных пользователей. Каждый проходит настоящие
+сценарии: /start и ввод баланса, затем по кругу добавление расхода
+(кнопка, категория, сумма), статистику и историю. Следующее сообщение
+пользователь отправляет только после ответа на предыдущее, поэтому
+число пользователей - это число одновременных запросов к боту.
+
+Тест идет этапами с растущим числом пользователей. Для каждого этапа
+замеряются ответы в секунду и задержка от появления обновления в
+getUpdates до прихода sendMessage (p50/p99 по каждому шагу сценария),
+а также наибольшая очередь задач пула потоков TeleBot. Точка насыщения -
+этап, после которого рост числа пользователей почти не увеличивает
+пропускную способность, а только задержку.
+
+Запуск из корня репозитория::
+
+    python benchmarks/load_bot.py --users 50 200 1000 2000 \\
+        --duration 10 --bot-threads 2 8 --output load.json
+
+Бот собирается через create_app() с базой во временном каталоге,
+finance.db репозитория не затрагивается. Лимиты Outbox по умолчанию
+подняты, чтобы замерять сам бот, а не ограничения Telegram (30 сообщений
+в секунду на бота и 1 в секунду в чат), их можно вернуть через
+--global-rate и --chat-rate.
+"""
+import argparse
+import heapq
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from telebot import util
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from finance_fakeapi import FakeBotAPI  # noqa: E402
+from proekt_onlycod_documentation import (  # noqa: E402
+    AppConfig,
+    create_app,
+)
+from storage import percentile  # noqa: E402
+
+SETUP = (("start", "/start"), ("balance", "1000000"))
+"""
+Шаги нового пользователя: шаг сценария и текст сообщения
+
+:type: tuple[tuple[str, str]]
+"""
+
+LOOP = (
+    ("add_expense", "➕ Добавить расход"),
+    ("category", "🍔 Еда"),
+    ("amount", "12.50"),
+    ("stats", "📊 Статистика"),
+    ("history", "📋 История"),
+)
+"""
+Шаги, которые пользователь повторяет по кругу после SETUP
+
+:type: tuple[tuple[str, str]]
+"""
+
+
+class LoadBotAPI(FakeBotAPI):
+    """FakeBotAPI, который сообщает LoadDriver о каждом ответе бота.
+
+    :ivar driver: Виртуальные пользователи текущего этапа
+    :vartype driver: LoadDriver или None
+    """
+
+    driver = None
+
+    def handle(self, method, params, files):
+        now = time.monotonic()
+        driver = self.driver
+        if method == "sendMessage" and driver is not None:
+            driver.reply(int(params["chat_id"]), params.get("text", ""), now)
+        return super().handle(method, params, files)
+
+
+class LoadDriver:
+    """Виртуальные пользователи одного этапа.
+
+    Пользователь отправляет сообщение, ждет ответ бота в свой чат, через
+    время на размышление отправляет следующее. Обновления кладутся в
+    очередь getUpdates поддельного API.
+
+    :ivar latencies: Задержки ответов в секундах по шагам сценария
+    :vartype latencies: dict[str, list[float]]
+
+    :ivar replies: Количество полученных ответов
+    :vartype replies: int
+
+    :ivar errors: Количество ответов, начинающихся с "❌"
+    :vartype errors: int
+    """
+
+    def __init__(self, api, user_ids, update_ids, think=0.0, seed=0):
+        """
+        :param api: Поддельный Bot API
+        :type api: LoadBotAPI
+        :param user_ids: Идентификаторы пользователей, они же id чатов
+        :type user_ids: iterable[int]
+        :param update_ids: Источник возрастающих update_id
+        :type update_ids: itertools.count
+        :param think: Среднее время на размышление между ответом и
+            следующим сообщением в секундах, 0 - отвечать сразу
+        :type think: float
+        :param seed: Зерно генератора случайных чисел
+        :type seed: int
+        """
+        self.api = api
+        self.think = think
+        self.latencies = {}
+        self.replies = 0
+        self.errors = 0
+        self._steps = dict.fromkeys(user_ids, 0)
+        self._update_ids = update_ids
+        self._rng = random.Random(seed)
+        self._inflight = {}
+        self._timers = []
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._timer_thread = None
+
+    def start(self):
+        """Отправляет первое сообщение от каждого пользователя.
+
+        :return: None
+        :rtype: None
+        """
+        if self.think:
+            self._timer_thread = threading.Thread(
+                target=self._run_timers, name="load-timers", daemon=True
+            )
+            self._timer_thread.start()
+        now = time.monotonic()
+        with self._cond:
+            for user_id in self._steps:
+                self._schedule(user_id, now)
+
+    def reply(self, chat_id, text, now):
+        """Учитывает ответ бота и планирует следующее сообщение.
+
+        :param chat_id: Чат, в который ответил бот
+        :type chat_id: int
+        :param text: Текст ответа
+        :type text: str
+        :param now: Момент ответа по time.monotonic()
+        :type now: float
+        :return: None
+        :rtype: None
+        """
+        with self._cond:
+            inflight = self._inflight.pop(chat_id, None)
+            if inflight is None:
+                return
+            step, sent = inflight
+            self.latencies.setdefault(step, []).append(now - sent)
+            self.replies += 1
+            if text.startswith("❌"):
+                self.errors += 1
+            self._steps[chat_id] += 1
+            if self._stopping:
+                self._cond.notify_all()
+            else:
+                self._schedule(chat_id, now)
+
+    def stop(self, timeout):
+        """Прекращает отправку новых сообщений и ждет ответов на
+        отправленные.
+
+        :param timeout: Сколько ждать ответов в секундах
+        :type timeout: float
+        :return: Количество сообщений, оставшихся без ответа
+        :rtype: int
+        """
+        with self._cond:
+            self._stopping = True
+            self._timers.clear()
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: not self._inflight, timeout)
+            return len(self._inflight)
+
+    def _schedule(self, user_id, now):
+        """Отправляет следующее сообщение пользователя сразу или после
+        размышления. Вызывается под self._cond.
+        """
+        if not self.think:
+            self._send(user_id)
+            return
+        delay = self._rng.expovariate(1 / self.think)
+        heapq.heappush(self._timers, (now + delay, user_id))
+        self._cond.notify_all()
+
+    def _send(self, user_id):
+        """Кладет сообщение текущего шага в очередь getUpdates."""
+        index = self._steps[user_id]
+        if index < len(SETUP):
+            step, text = SETUP[index]
+        else:
+            step, text = LOOP[(index - len(SETUP)) % len(LOOP)]
+        update_id = next(self._update_ids)
+        self._inflight[user_id] = (step, time.monotonic())
+        self.api.updates.put({
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {
+                    "id": user_id,
+                    "is_bot": False,
+                    "first_name": "load",
+                },
+                "text": text,
+            },
+        })
+
+    def _run_timers(self):
+        """Отправляет отложенные сообщения, когда подходит их время."""
+        with self._cond:
+            while not self._stopping:
+                if not self._timers:
+                    self._cond.wait()
+                    continue
+                when, user_id = self._timers[0]
+                delay = when - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._timers)
+                self._send(user_id)
+
+
+def run_stage(app, api, users, bot_threads, args, first_user, update_ids):
+    """Прогоняет один этап: users пользователей в течение args.duration
+    секунд при bot_threads потоках обработчиков TeleBot.
+
+    :return: Словарь с users, replies, replies_per_sec, errors, lost,
+        max_worker_queue, max_updates_queue, p50_ms, p99_ms и steps
+    :rtype: dict
+    """
+    app.bot.worker_pool.close()
+    app.bot.worker_pool = util.ThreadPool(app.bot, num_threads=bot_threads)
+    driver = LoadDriver(
+        api,
+        range(first_user, first_user + users),
+        update_ids,
+        think=args.think,
+        seed=args.seed,
+    )
+    api.driver = driver
+    polling = threading.Thread(
+        target=app.bot.polling,
+        kwargs={"non_stop": True, "timeout": 5, "long_polling_timeout": 1},
+        name="load-polling",
+        daemon=True,
+    )
+    polling.start()
+
+    started = time.monotonic()
+    driver.start()
+    max_worker_queue = max_updates_queue = 0
+    while time.monotonic() - started < args.duration:
+        max_worker_queue = max(
+            max_worker_queue, app.bot.worker_pool.tasks.qsize()
+        )
+        max_updates_queue = max(max_updates_queue, api.updates.qsize())
+        time.sleep(0.05)
+    seconds = time.monotonic() - started
+    replies = driver.replies
+    lost = driver.stop(args.drain)
+
+    app.bot.stop_polling()
+    polling.join()
+    api.driver = None
+
+    def summary(values):
+        values = sorted(values)
+        return {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+        }
+
+    overall = summary(
+        value for values in driver.latencies.values() for value in values
+    )
+    return {
+        "users": users,
+        "replies": replies,
+        "replies_per_sec": round(replies / seconds, 1),
+        "errors": driver.errors,
+        "lost": lost,
+        "max_worker_queue": max_worker_queue,
+        "max_updates_queue": max_updates_queue,
+        "p50_ms": overall["p50_ms"],
+        "p99_ms": overall["p99_ms"],
+        "steps": {
+            step: summary(values)
+            for step, values in sorted(driver.latencies.items())
+        },
+    }
+
+
+def saturation(stages, knee):
+    """Находит этап, после которого пропускная способность перестает
+    расти.
+
+    :param stages: Результаты этапов по возрастанию числа пользователей
+    :type stages: list[dict]
+    :param knee: Минимальный относительный прирост ответов в секунду,
+        при котором рост еще считается
+    :type knee: float
+    :return: Число пользователей в точке насыщения или None, если
+        пропускная способность росла до последнего этапа
+    :rtype: int или None
+    """
+    for previous, stage in zip(stages, stages[1:]):
+        if stage["replies_per_sec"] < previous["replies_per_sec"] * (1 + knee):
+            return previous["users"]
+    return None
+
+
+def build_app(args, workdir):
+    """Собирает приложение бота с базой в workdir и лимитами Outbox из
+    аргументов.
+
+    :return: Приложение
+    :rtype: proekt_onlycod_documentation.App
+    """
+    app = create_app(
+        AppConfig(
+            token="0:load",
+            db_path=os.path.join(workdir, "finance.db"),
+            shards=args.shards,
+            group_commit=args.group_commit,
+            global_rate=args.global_rate,
+            chat_rate=args.chat_rate,
+            chat_burst=args.chat_burst,
+            sender_workers=args.sender_workers,
+        )
+    )
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--users",
+        type=int,
+        nargs="+",
+        default=[50, 200, 1000, 2000],
+        help="число виртуальных пользователей на этапах",
+    )
+    parser.add_argument(
+        "--bot-threads",
+        type=int,
+        nargs="+",
+        default=[2],
+        help="потоки обработчиков TeleBot, по умолчанию как в боте",
+    )
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument(
+        "--think",
+        type=float,
+        default=0.0,
+        help="среднее время между ответом и следующим сообщением, с",
+    )
+    parser.add_argument(
+        "--drain",
+        type=float,
+        default=30.0,
+        help="сколько ждать ответов на отправленное после этапа, с",
+    )
+    parser.add_argument(
+        "--api-latency",
+        type=float,
+        default=0.0,
+        help="задержка ответа поддельного Bot API, с",
+    )
+    parser.add_argument("--global-rate", type=float, default=100000.0)
+    parser.add_argument("--chat-rate", type=float, default=1000.0)
+    parser.add_argument("--chat-burst", type=int, default=1000)
+    parser.add_argument("--sender-workers", type=int, default=8)
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--group-commit", action="store_true")
+    parser.add_argument(
+        "--knee",
+        type=float,
+        default=0.1,
+        help="прирост ответов в секунду, меньше которого рост остановился",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="файл JSON, по умолчанию stdout")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="finance_load_")
+    app = build_app(args, workdir)
+    try:
+        update_ids = itertools.count(1)
+        stage_ids = itertools.count(1)
+        results = {}
+        api = LoadBotAPI(latency=args.api_latency, record=False)
+        with api:
+            for bot_threads in args.bot_threads:
+                stages = []
+                for users in sorted(args.users):
+                    # Каждый этап начинается с новыми пользователями
+                    first_user = next(stage_ids) * 1000000
+                    stage = run_stage(
+                        app, api, users, bot_threads, args, first_user,
+                        update_ids,
+                    )
+                    stages.append(stage)
+                    print(
+                        f"потоков={bot_threads:<3} "
+                        f"пользователей={users:<6} "
+                        f"{stage['replies_per_sec']:>9.1f} ответов/с "
+                        f"p50={stage['p50_ms']:.1f} мс "
+                        f"p99={stage['p99_ms']:.1f} мс "
+                        f"очередь={stage['max_worker_queue']} "
+                        f"ошибок={stage['errors']} "
+                        f"потеряно={stage['lost']}",
+                        file=sys.stderr,
+                    )
+                knee = saturation(stages, args.knee)
+                print(
+                    f"потоков={bot_threads:<3} насыщение: "
+                    + (
+                        f"{knee} пользователей"
+                        if knee is not None
+                        else "не достигнуто"
+                    ),
+                    file=sys.stderr,
+                )
+                results[str(bot_threads)] = {
+                    "stages": stages,
+                    "saturation_users": knee,
+                    "max_replies_per_sec": max(
+                        stage["replies_per_sec"] for stage in stages
+                    ),
+                }
+    finally:
+        app.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "duration": args.duration,
+            "think": args.think,
+            "api_latency": args.api_latency,
+            "global_rate": args.global_rate,
+            "chat_rate": args.chat_rate,
+            "sender_workers": args.sender_workers,
+            "shards": args.shards,
+            "group_commit": args.group_commit,
+            "seed": args.seed,
+            "python": platform.python_version(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results": results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
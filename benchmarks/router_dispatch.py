@@ -0,0 +1,154 @@
+"""Микробенчмарк выбора обработчика сообщения.
+
+Сравнивает стоимость выбора обработчика для одного обновления в TeleBot
+с обработчиками ``func=lambda msg: msg.text == ...`` и через Router при
+разном количестве кнопок меню. Обработчики пустые, поэтому замеряется
+только выбор обработчика.
+
+Последней строкой замеряется маршрутизатор самого бота, установленный
+register_handlers() в приложении с базой в файле: вместе с условием
+awaiting_input, которое на каждом сообщении читает состояние из
+SQLiteStateStore. Часть пользователей (``--pending``) находится на шаге
+ввода суммы. Обработчики бота не вызываются, маршрутизатор только
+выбирает их, поэтому замедление проверки состояния видно без шума от
+работы с базой.
+
+Запуск из корня репозитория::
+
+    python benchmarks/router_dispatch.py --buttons 6 25 100 400
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+import telebot
+from telebot import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from finance_router import Router  # noqa: E402
+from proekt_onlycod_documentation import (  # noqa: E402
+    AppConfig,
+    create_app,
+    router,
+)
+
+
+def make_message(text, user_id=1):
+    """Собирает текстовое сообщение Telegram."""
+    return types.Message.de_json({
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+        "text": text,
+    })
+
+
+def noop(message):
+    pass
+
+
+def linear_bot(buttons):
+    """TeleBot, где у каждой кнопки свой обработчик с lambda-фильтром."""
+    bot = telebot.TeleBot("0:bench", threaded=False)
+    bot.register_message_handler(noop, commands=["start"])
+    for text in buttons:
+        bot.register_message_handler(
+            noop, func=lambda msg, text=text: msg.text == text
+        )
+    bot.register_message_handler(noop, func=lambda msg: True)
+    return bot
+
+
+def router_bot(buttons):
+    """TeleBot с одним обработчиком-маршрутизатором."""
+    bot = telebot.TeleBot("0:bench", threaded=False)
+    router = Router()
+    router.command("start")(noop)
+    router.text(*buttons)(noop)
+    router.default(noop)
+    router.install(bot)
+    return bot
+
+
+def app_bot(workdir, pending):
+    """Приложение бота с базой в workdir и сообщения для него.
+
+    Сообщения - все команды и кнопки маршрутизатора плюс сообщение мимо
+    меню, каждое от своего пользователя. Каждый ``1 / pending``-й
+    пользователь ждет ввода суммы.
+
+    :return: Приложение и список сообщений
+    :rtype: tuple
+    """
+    app = create_app(
+        AppConfig(
+            token="0:bench",
+            db_path=os.path.join(workdir, "bench.db"),
+            threaded=False,
+        )
+    )
+    texts = ["/" + name for name in router.commands]
+    texts += list(router.texts)
+    texts.append("unknown")
+    messages = []
+    step = round(1 / pending) if pending > 0 else 0
+    for user_id, text in enumerate(texts, 1):
+        if step and user_id % step == 0:
+            app.user_state.put(user_id, {"step": "amount", "category": "Еда"})
+        messages.append(make_message(text, user_id))
+    return app, messages
+
+
+def measure(bot, messages, number):
+    """Среднее время обработки одного сообщения в микросекундах."""
+    seconds = timeit.timeit(
+        lambda: bot.process_new_messages(messages), number=number
+    )
+    return seconds / (number * len(messages)) * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--buttons", type=int, nargs="+", default=[6, 25, 100, 400]
+    )
+    parser.add_argument("--number", type=int, default=200)
+    parser.add_argument(
+        "--pending", type=float, default=0.1,
+        help="доля пользователей, от которых бот ждет ввода суммы",
+    )
+    args = parser.parse_args(argv)
+
+    print(f"{'кнопок':>7} {'линейно, мкс':>13} {'Router, мкс':>12}")
+    for count in args.buttons:
+        buttons = [f"button {i}" for i in range(count)]
+        # Нажатия всех кнопок поровну плюс сообщение мимо меню
+        messages = [make_message(text) for text in buttons]
+        messages.append(make_message("unknown"))
+        linear = measure(linear_bot(buttons), messages, args.number)
+        routed = measure(router_bot(buttons), messages, args.number)
+        print(f"{count:>7} {linear:>13.2f} {routed:>12.2f}")
+
+    workdir = tempfile.mkdtemp(prefix="router-bench-")
+    app = None
+    try:
+        app, messages = app_bot(workdir, args.pending)
+        # Установленный обработчик зовет router.dispatch(), подмена на
+        # resolve() оставляет от него только выбор обработчика
+        router.dispatch = router.resolve
+        routed = measure(app.bot, messages, args.number)
+        print(f"бот, {len(messages)} сообщений: {routed:.2f} мкс")
+    finally:
+        vars(router).pop("dispatch", None)
+        if app is not None:
+            app.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Замер времени импорта модуля бота и создания приложения.
+
+Импорт замеряется в новых процессах интерпретатора, чтобы модули не
+были уже загружены. Создание приложения - это create_app() с базой в
+памяти и его close() в одном процессе, так же собираются независимые
+экземпляры в тестах и бенчмарках.
+
+Запуск из корня репозитория::
+
+    python benchmarks/startup.py --imports 10 --apps 100
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+IMPORT_CODE = """\
+import time
+started = time.perf_counter()
+import proekt_onlycod_documentation
+print(time.perf_counter() - started)
+"""
+
+
+def measure_import(number):
+    """Время импорта модуля бота в новых процессах, в миллисекундах.
+
+    :param number: Количество процессов
+    :type number: int
+    :return: Времена импорта
+    :rtype: list[float]
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    times = []
+    for _ in range(number):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_CODE],
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        times.append(float(output) * 1000)
+    return times
+
+
+def measure_apps(number):
+    """Время create_app() с базой в памяти и close(), в миллисекундах.
+
+    :param number: Количество приложений
+    :type number: int
+    :return: Времена создания и закрытия
+    :rtype: tuple[list[float], list[float]]
+    """
+    import logging
+
+    from proekt_onlycod_documentation import AppConfig, create_app
+
+    logging.getLogger("proekt_onlycod_documentation").setLevel(
+        logging.WARNING
+    )
+    config = AppConfig(token="0:startup", db_path=":memory:")
+    created, closed = [], []
+    for _ in range(number):
+        started = time.perf_counter()
+        app = create_app(config)
+        created.append((time.perf_counter() - started) * 1000)
+        started = time.perf_counter()
+        app.close()
+        closed.append((time.perf_counter() - started) * 1000)
+    return created, closed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--imports", type=int, default=10)
+    parser.add_argument("--apps", type=int, default=100)
+    args = parser.parse_args(argv)
+
+    rows = [("импорт модуля", measure_import(args.imports))]
+    created, closed = measure_apps(args.apps)
+    rows += [("create_app(:memory:)", created), ("App.close()", closed)]
+    print(f"{'':<22} {'медиана, мс':>12} {'максимум, мс':>13}")
+    for name, times in rows:
+        print(
+            f"{name:<22} {statistics.median(times):>12.2f} "
+            f"{max(times):>13.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
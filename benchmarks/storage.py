@@ -0,0 +1,374 @@
+"""Нагрузочный бенчмарк хранилища FinanceDB на больших объемах данных.
+
+Генерирует базу с заданным количеством пользователей и расходов, затем
+замеряет основные методы FinanceDB в одном потоке и в нескольких
+потоках одновременно. Результат - JSON с операциями в секунду и
+задержками p50/p99 для каждого метода и количества потоков. Режим
+compare сравнивает два таких JSON и отмечает ухудшения.
+
+Запуск из корня репозитория::
+
+    python benchmarks/storage.py run --users 100000 --expenses 10000000 \\
+        --db /tmp/finance_bench.db --threads 1 8 --output after.json
+    python benchmarks/storage.py compare before.json after.json
+
+Сгенерированная база переиспользуется, если файл --db уже существует.
+Сами замеры идут на ее копии во временном каталоге, поэтому add_expense
+и clear_data не меняют файл --db и повторные запуски на нем сравнимы.
+Запуск с --shards N переносит копию в N шардов.
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from finance_shards import ShardedFinanceDB, reshard  # noqa: E402
+from proekt_onlycod_documentation import (  # noqa: E402
+    CATEGORY_BUTTONS,
+    FinanceDB,
+)
+
+OPERATIONS = ("add_expense", "get_stats", "get_history", "clear_data")
+"""
+Замеряемые методы FinanceDB
+
+:type: tuple[str]
+"""
+
+CATEGORIES = [button[2:] for button in CATEGORY_BUTTONS]
+
+
+def generate(path, users, expenses, seed=0, batch_size=100000):
+    """Создает базу с users пользователями и expenses расходами.
+
+    Пользователи записываются напрямую, а расходы загружаются через
+    FinanceDB.import_expenses() из временного CSV, поэтому суммы по
+    категориям и периодам заполнены так же, как в рабочей базе. Даты
+    расходов равномерно распределены по последнему году.
+
+    :param path: Файл базы
+    :type path: str
+    :param users: Количество пользователей
+    :type users: int
+    :param expenses: Количество расходов
+    :type expenses: int
+    :param seed: Зерно генератора случайных чисел
+    :type seed: int
+    :param batch_size: Расходов в одной транзакции импорта
+    :type batch_size: int
+    :return: None
+    :rtype: None
+    """
+    rng = random.Random(seed)
+    db = FinanceDB(path)
+    balance = 10 ** 12
+    with db.pool.writer() as cursor:
+        cursor.executemany(
+            """INSERT INTO users (user_id, balance, initial_balance)
+            VALUES (?, ?, ?)""",
+            ((user_id, balance, balance) for user_id in range(1, users + 1)),
+        )
+    now = time.time()
+    with tempfile.NamedTemporaryFile(
+        "w", suffix=".csv", newline="", encoding="utf-8", delete=False
+    ) as f:
+        writer = csv.writer(f)
+        writer.writerow(("user_id", "category", "amount", "date"))
+        for _ in range(expenses):
+            when = time.gmtime(now - rng.random() * 365 * 86400)
+            writer.writerow((
+                rng.randint(1, users),
+                rng.choice(CATEGORIES),
+                f"{rng.randint(100, 500000) / 100:.2f}",
+                time.strftime("%Y-%m-%d %H:%M:%S", when),
+            ))
+    try:
+        started = time.perf_counter()
+        result = db.import_expenses(f.name, batch_size=batch_size)
+        print(
+            f"Сгенерировано расходов: {result['imported']} за "
+            f"{time.perf_counter() - started:.1f} с",
+            file=sys.stderr,
+        )
+    finally:
+        os.unlink(f.name)
+        db.close()
+
+
+def percentile(values, q):
+    """Перцентиль по ближайшему рангу.
+
+    :param values: Отсортированные значения
+    :type values: list[float]
+    :param q: Доля от 0 до 1
+    :type q: float
+    :return: Значение перцентиля
+    :rtype: float
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run_operation(db, name, targets, threads):
+    """Вызывает метод для каждого пользователя из targets в threads
+    потоках.
+
+    :return: Словарь с ops, seconds, ops_per_sec, p50_ms, p99_ms
+    :rtype: dict
+    """
+    calls = {
+        "add_expense": lambda uid: db.add_expense(uid, "Еда", 12.5),
+        "get_stats": lambda uid: db.get_stats(uid),
+        "get_history": lambda uid: db.get_history(uid, 10),
+        "clear_data": lambda uid: db.clear_data(uid),
+    }
+    call = calls[name]
+    latencies = [[] for _ in range(threads)]
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(index):
+        times = latencies[index]
+        barrier.wait()
+        for user_id in targets[index::threads]:
+            started = time.perf_counter()
+            call(user_id)
+            times.append(time.perf_counter() - started)
+
+    workers = [
+        threading.Thread(target=worker, args=(index,))
+        for index in range(threads)
+    ]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    seconds = time.perf_counter() - started
+    merged = sorted(value for times in latencies for value in times)
+    return {
+        "ops": len(merged),
+        "seconds": round(seconds, 4),
+        "ops_per_sec": round(len(merged) / seconds, 1) if seconds else 0.0,
+        "p50_ms": round(percentile(merged, 0.50) * 1000, 4),
+        "p99_ms": round(percentile(merged, 0.99) * 1000, 4),
+    }
+
+
+def copy_database(source, target):
+    """Копирует базу SQLite через backup API, вместе с еще не
+    перенесенными из WAL страницами.
+
+    :param source: Файл исходной базы
+    :type source: str
+    :param target: Файл копии
+    :type target: str
+    :return: None
+    :rtype: None
+    """
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(target)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+def run(args):
+    """Генерирует базу при необходимости и замеряет методы на ее копии.
+
+    :return: Результат бенчмарка
+    :rtype: dict
+    :raises ValueError: Если для clear_data не хватает пользователей
+    """
+    needed = args.ops * len(args.threads)
+    if "clear_data" in args.operations and args.users < needed:
+        raise ValueError(
+            f"clear_data удаляет разных пользователей: нужно --users не "
+            f"меньше --ops * количество --threads = {needed}"
+        )
+    workdir = tempfile.mkdtemp(prefix="finance_bench_")
+    try:
+        path = args.db or os.path.join(workdir, "finance.db")
+        if not os.path.exists(path):
+            generate(path, args.users, args.expenses, args.seed)
+        work = os.path.join(workdir, "work.db")
+        copy_database(path, work)
+        return measure(args, work)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def measure(args, path):
+    """Замеряет методы на базе path, которую замеры меняют.
+
+    :return: Результат бенчмарка
+    :rtype: dict
+    """
+    if args.shards > 1:
+        root, extension = os.path.splitext(path)
+        target = f"{root}_shards{extension}"
+        reshard([path], target, args.shards)
+        db = ShardedFinanceDB(
+            target,
+            args.shards,
+            factory=FinanceDB,
+            group_commit=args.group_commit,
+            cache_size=args.cache_size,
+        )
+    else:
+        db = FinanceDB(
+            path, group_commit=args.group_commit, cache_size=args.cache_size
+        )
+
+    rng = random.Random(args.seed)
+    # clear_data каждый раз удаляет еще не очищенных пользователей, чтобы
+    # не замерять удаление пустых данных
+    cleared = iter(rng.sample(range(1, args.users + 1), args.users))
+    results = {}
+    try:
+        for name in args.operations:
+            results[name] = {}
+            for threads in args.threads:
+                if name == "clear_data":
+                    targets = [uid for _, uid in zip(range(args.ops), cleared)]
+                else:
+                    targets = [
+                        rng.randint(1, args.users) for _ in range(args.ops)
+                    ]
+                result = run_operation(db, name, targets, threads)
+                results[name][str(threads)] = result
+                print(
+                    f"{name:>12} потоков={threads:<3} "
+                    f"{result['ops_per_sec']:>10.1f} оп/с "
+                    f"p50={result['p50_ms']:.3f} мс "
+                    f"p99={result['p99_ms']:.3f} мс",
+                    file=sys.stderr,
+                )
+    finally:
+        db.close()
+    return {
+        "meta": {
+            "users": args.users,
+            "expenses": args.expenses,
+            "ops": args.ops,
+            "shards": args.shards,
+            "group_commit": args.group_commit,
+            "cache_size": args.cache_size,
+            "seed": args.seed,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results": results,
+    }
+
+
+def compare(before, after, threshold=0.1):
+    """Сравнивает два результата run().
+
+    Ухудшением считается падение ops_per_sec или рост p99_ms больше чем
+    на threshold от прежнего значения.
+
+    :param before: Прежний результат
+    :type before: dict
+    :param after: Новый результат
+    :type after: dict
+    :param threshold: Допустимое относительное ухудшение
+    :type threshold: float
+    :return: Строки сравнения (операция, потоки, метрика, было, стало,
+        изменение, ухудшение ли это)
+    :rtype: list[tuple]
+    """
+    rows = []
+    for name, by_threads in after["results"].items():
+        for threads, new in by_threads.items():
+            old = before["results"].get(name, {}).get(threads)
+            if old is None:
+                continue
+            for metric, higher_is_better in (
+                ("ops_per_sec", True),
+                ("p99_ms", False),
+            ):
+                if not old[metric]:
+                    continue
+                change = (new[metric] - old[metric]) / old[metric]
+                worse = -change if higher_is_better else change
+                rows.append((
+                    name, threads, metric, old[metric], new[metric],
+                    round(change, 4), worse > threshold,
+                ))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    bench = commands.add_parser("run", help="замерить методы FinanceDB")
+    bench.add_argument("--db", help="файл базы, по умолчанию временный")
+    bench.add_argument("--users", type=int, default=10000)
+    bench.add_argument("--expenses", type=int, default=1000000)
+    bench.add_argument("--ops", type=int, default=2000)
+    bench.add_argument("--threads", type=int, nargs="+", default=[1, 8])
+    bench.add_argument(
+        "--operations", nargs="+", choices=OPERATIONS, default=OPERATIONS
+    )
+    bench.add_argument("--shards", type=int, default=1)
+    bench.add_argument("--group-commit", action="store_true")
+    bench.add_argument(
+        "--cache-size",
+        type=int,
+        default=0,
+        help="размер кэшей FinanceDB, 0 - замерять чтение из базы",
+    )
+    bench.add_argument("--seed", type=int, default=0)
+    bench.add_argument("--output", help="файл JSON, по умолчанию stdout")
+
+    diff = commands.add_parser("compare", help="сравнить два запуска")
+    diff.add_argument("before")
+    diff.add_argument("after")
+    diff.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        try:
+            result = run(args)
+        except ValueError as e:
+            parser.error(str(e))
+        text = json.dumps(result, ensure_ascii=False, indent=2)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(text + "\n")
+        else:
+            print(text)
+        return 0
+
+    with open(args.before, encoding="utf-8") as f:
+        before = json.load(f)
+    with open(args.after, encoding="utf-8") as f:
+        after = json.load(f)
+    rows = compare(before, after, args.threshold)
+    for name, threads, metric, old, new, change, worse in rows:
+        mark = "УХУДШЕНИЕ" if worse else ""
+        print(
+            f"{name:>12} потоков={threads:<3} {metric:<11} "
+            f"{old:>10} -> {new:<10} {change:+.1%} {mark}"
+        )
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,313 @@
+"""Служебные команды для обслуживания базы данных бота.
+
+Запуск::
+
+    python finance_admin.py --db finance.db verify-stats
+    python finance_admin.py --db finance.db reconcile
+    python finance_admin.py --db finance.db rebuild-stats --user 42
+    python finance_admin.py --db finance.db check-plans
+    python finance_admin.py --db finance.db import history.csv
+    python finance_admin.py --db finance.db rates rates.json
+    python finance_admin.py --db finance.db reshard --to finance.db -n 4
+    python finance_admin.py --db finance.db --shards 4 summary
+"""
+import argparse
+import sys
+import time
+
+from finance_import import FORMATS
+from finance_migrations import schema_version
+from finance_rates import RATES_FILE
+from finance_shards import ShardedFinanceDB, reshard, shard_paths
+from proekt_onlycod_documentation import FinanceDB
+
+
+def rebuild_stats(db, args):
+    """Пересчитывает таблицу category_totals по таблице expenses.
+
+    :param db: База данных бота
+    :type db: FinanceDB
+    :param args: Разобранные аргументы командной строки
+    :type args: argparse.Namespace
+    :return: Код возврата
+    :rtype: int
+    """
+    rows = db.rebuild_category_totals(args.user)
+    print(f"Пересчитано строк category_totals: {rows}")
+    return 0
+
+
+def verify_stats(db, args):
+    """Сверяет таблицу category_totals с таблицей expenses.
+
+    :param db: База данных бота
+    :type db: FinanceDB
+    :param args: Разобранные аргументы командной строки
+    :type args: argparse.Namespace
+    :return: 0 если расхождений нет, иначе 1
+    :rtype: int
+    """
+    mismatches = db.verify_category_totals(args.user)
+    for user_id, category, currency, *totals in mismatches:
+        exp_total, act_total, exp_cnt, act_cnt = totals
+        print(
+            f"{user_id} {category} {currency}: "
+            f"expenses={exp_total} ({exp_cnt} шт.), "
+            f"category_totals={act_total} ({act_cnt} шт.)"
+        )
+    if mismatches:
+        print(f"Расхождений: {len(mismatches)}")
+        return 1
+    print("Расхождений нет")
+    return 0
+
+
+def reconcile(db, args):
+    """Сверяет балансы пользователей с начальным балансом и расходами.
+
+    :param db: База данных бота
+    :type db: FinanceDB
+    :param args: Разобранные аргументы командной строки
+    :type args: argparse.Namespace
+    :return: 0 если расхождений нет, иначе 1
+    :rtype: int
+    """
+    mismatches = db.reconcile(args.user)
+    for user_id, balance, initial, spent, expected in mismatches:
+        print(
+            f"{user_id}: баланс={balance}, начальный={initial}, "
+            f"расходы={spent}, ожидается={expected}"
+        )
+    if mismatches:
+        print(f"Расхождений: {len(mismatches)}")
+        return 1
+    print("Расхождений нет")
+    return 0
+
+
+def check_plans(db, args):
+    """Печатает версию схемы и планы горячих запросов.
+
+    :param db: База данных бота
+    :type db: FinanceDB
+    :param args: Разобранные аргументы командной строки
+    :type args: argparse.Namespace
+    :return: 0 если все запросы идут по индексам, иначе 1
+    :rtype: int
+    """
+    with db.pool.reader() as cursor:
+        print(f"Версия схемы: {schema_version(cursor)}")
+    try:
+        plans = db.check_query_plans()
+    except AssertionError as e:
+        print(e)
+        return 1
+    for name, details in plans.items():
+        print(f"{name}: {'; '.join(details)}")
+    return 0
+
+
+def import_expenses(db, args):
+    """Загружает историю расходов из CSV или JSONL.
+
+    Ход импорта печатается в stderr после каждой пачки.
+
+    :param db: База данных бота
+    :type db: FinanceDB
+    :param args: Разобранные аргументы командной строки
+    :type args: argparse.Namespace
+    :return: 0 если все строки загружены, иначе 1
+    :rtype: int
+    """
+    if isinstance(db, ShardedFinanceDB):
+        print("Импорт в шарды не поддерживается, загрузите файл без "
+              "--shards и выполните reshard")
+        return 1
+    started = time.monotonic()
+
+    def progress(result):
+        percent = 100 * result["offset"] / (result["size"] or 1)
+        rate = result["imported"] / max(time.monotonic() - started, 1e-9)
+        print(
+            f"\r{percent:5.1f}% строк: {result['line']}, "
+            f"загружено: {result['imported']}, "
+            f"отклонено: {result['rejected']}, {rate:.0f} записей/с",
+            end="",
+            file=sys.stderr,
+        )
+
+    result = db.import_expenses(
+        args.path,
+        args.format,
+        batch_size=args.batch_size,
+        resume=not args.restart,
+        adjust_balance=not args.keep_balance,
+        progress=progress,
+    )
+    print(file=sys.stderr)
+    for line, error in result["errors"]:
+        print(f"строка {line}: {error}")
+    print(
+        f"Загружено: {result['imported']}, отклонено: {result['rejected']}"
+    )
+    return 1 if result["rejected"] else 0
+
+
+def load_rates(db, args):
+    """Заменяет курсы валют курсами из файла.
+
+    :param db: База данных бота
+    :type db: FinanceDB
+    :param args: Разобранные аргументы командной строки
+    :type args: argparse.Namespace
+    :return: 0 если курсы загружены, иначе 1
+    :rtype: int
+    """
+    try:
+        count = db.load_rates(args.path)
+    except (OSError, ValueError) as e:
+        print(e)
+        return 1
+    print(f"Загружено курсов: {count}")
+    return 0
+
+
+def summary(db, args):
+    """Печатает суммы расходов всех пользователей по категориям.
+
+    :param db: База данных бота
+    :type db: FinanceDB или ShardedFinanceDB
+    :param args: Разобранные аргументы командной строки
+    :type args: argparse.Namespace
+    :return: Код возврата
+    :rtype: int
+    """
+    for category, (total, count, users) in db.category_summary().items():
+        print(f"{category}: {total} ({count} шт., пользователей: {users})")
+    return 0
+
+
+def reshard_db(db, args):
+    """Переносит данные в новый набор шардов.
+
+    :param db: База данных бота, ее файлы - старые шарды
+    :type db: FinanceDB или ShardedFinanceDB
+    :param args: Разобранные аргументы командной строки
+    :type args: argparse.Namespace
+    :return: Код возврата
+    :rtype: int
+    """
+    counts = reshard(
+        shard_paths(args.db, args.shards), args.to, args.to_shards
+    )
+    for path, count in zip(shard_paths(args.to, args.to_shards), counts):
+        print(f"{path}: пользователей {count}")
+    return 0
+
+
+def build_parser():
+    """Создает разборщик аргументов командной строки.
+
+    :return: Разборщик с подкомандами
+    :rtype: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default="finance.db", help="файл базы")
+    parser.add_argument(
+        "--shards", type=int, default=1, help="количество шардов базы"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rebuild = commands.add_parser(
+        "rebuild-stats", help="пересчитать суммы по категориям"
+    )
+    rebuild.add_argument("--user", type=int, help="только этот пользователь")
+    rebuild.set_defaults(handler=rebuild_stats)
+
+    verify = commands.add_parser(
+        "verify-stats", help="сверить суммы по категориям с расходами"
+    )
+    verify.add_argument("--user", type=int, help="только этот пользователь")
+    verify.set_defaults(handler=verify_stats)
+
+    balances = commands.add_parser(
+        "reconcile", help="сверить балансы с начальными и расходами"
+    )
+    balances.add_argument(
+        "--user", type=int, help="только этот пользователь"
+    )
+    balances.set_defaults(handler=reconcile)
+
+    plans = commands.add_parser(
+        "check-plans", help="проверить, что запросы идут по индексам"
+    )
+    plans.set_defaults(handler=check_plans)
+
+    load = commands.add_parser(
+        "import", help="загрузить историю расходов из CSV или JSONL"
+    )
+    load.add_argument("path", help="файл с полями user_id, category, amount")
+    load.add_argument(
+        "--format", choices=FORMATS, help="формат файла, иначе по расширению"
+    )
+    load.add_argument(
+        "--batch-size", type=int, default=10000, help="записей в транзакции"
+    )
+    load.add_argument(
+        "--restart",
+        action="store_true",
+        help="начать файл заново, не продолжая с места остановки",
+    )
+    load.add_argument(
+        "--keep-balance",
+        action="store_true",
+        help="не списывать импортированные суммы с балансов",
+    )
+    load.set_defaults(handler=import_expenses)
+
+    rates = commands.add_parser("rates", help="загрузить курсы валют")
+    rates.add_argument(
+        "path", nargs="?", default=RATES_FILE, help="файл курсов JSON"
+    )
+    rates.set_defaults(handler=load_rates)
+
+    totals = commands.add_parser(
+        "summary", help="суммы по категориям по всем пользователям"
+    )
+    totals.set_defaults(handler=summary)
+
+    split = commands.add_parser(
+        "reshard", help="перенести данные в другое количество шардов"
+    )
+    split.add_argument(
+        "--to", required=True, help="имя файла базы для новых шардов"
+    )
+    split.add_argument(
+        "-n", "--to-shards", type=int, required=True,
+        help="количество новых шардов",
+    )
+    split.set_defaults(handler=reshard_db)
+    return parser
+
+
+def main(argv=None):
+    """Точка входа командной строки.
+
+    :param argv: Аргументы командной строки, по умолчанию sys.argv
+    :type argv: list[str] или None
+    :return: Код возврата
+    :rtype: int
+    """
+    args = build_parser().parse_args(argv)
+    if args.shards > 1:
+        db = ShardedFinanceDB(args.db, args.shards, factory=FinanceDB)
+    else:
+        db = FinanceDB(args.db)
+    try:
+        return args.handler(db, args)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
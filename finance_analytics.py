@@ -0,0 +1,226 @@
+"""Аналитика расходов по дням, неделям и месяцам.
+
+Суммы расходов заранее разложены по периодам в таблице expense_buckets:
+для каждого расхода к строке его дня ("d"), недели ("w", начинается с
+понедельника) и месяца ("m") прибавляются сумма и количество. Таблицу
+поддерживают операции записи FinanceDB, поэтому запросы здесь читают
+несколько строк по первичному ключу и не разбирают даты в expenses.
+Суммы хранятся в валюте расходов и переводятся в базовую валюту
+пользователя соединением с exchange_rates при чтении.
+
+Периоды считаются по дате расхода в UTC, как ее записывает
+CURRENT_TIMESTAMP.
+"""
+from datetime import date, datetime, timedelta, timezone
+
+from finance_import import DATE_FORMAT
+from finance_money import from_kopecks
+from finance_queries import BUCKETS_RANGE, MONTHS_COMPARE, MONTHS_RANGE
+
+PERIODS = ("d", "w", "m")
+"""
+Периоды expense_buckets: день, неделя, месяц
+
+:type: tuple[str]
+"""
+
+
+def timestamp():
+    """Возвращает текущее время в формате даты расхода.
+
+    :return: Время в UTC, например "2024-05-01 12:30:00"
+    :rtype: str
+    """
+    return datetime.now(timezone.utc).strftime(DATE_FORMAT)
+
+
+def period_start(day, period):
+    """Возвращает первый день периода, в который входит день.
+
+    :param day: День
+    :type day: datetime.date
+    :param period: "d", "w" или "m"
+    :type period: str
+    :return: Первый день периода
+    :rtype: datetime.date
+    """
+    if period == "w":
+        return day - timedelta(days=day.weekday())
+    if period == "m":
+        return day.replace(day=1)
+    return day
+
+
+def shift(start, period, count):
+    """Сдвигает начало периода на count периодов назад.
+
+    :param start: Первый день периода
+    :type start: datetime.date
+    :param period: "d", "w" или "m"
+    :type period: str
+    :param count: На сколько периодов сдвинуть
+    :type count: int
+    :return: Первый день периода, на count раньше
+    :rtype: datetime.date
+    """
+    if period == "m":
+        months = start.year * 12 + start.month - 1 - count
+        return date(months // 12, months % 12 + 1, 1)
+    return start - timedelta(days=count * (7 if period == "w" else 1))
+
+
+def add_to_buckets(cursor, rows):
+    """Прибавляет расходы к их периодам в expense_buckets.
+
+    Вызывается внутри транзакции записи расходов. Расходы с одинаковыми
+    пользователем, категорией и периодом складываются заранее, поэтому
+    на каждую строку expense_buckets приходится одна запись.
+
+    :param cursor: Курсор внутри открытой транзакции
+    :type cursor: sqlite3.Cursor
+    :param rows: Расходы (user_id, category, amount, date, currency),
+        amount в копейках, date в формате DATE_FORMAT
+    :type rows: Iterable[tuple]
+    :return: None
+    :rtype: None
+    """
+    buckets = {}
+    for user_id, category, amount, when, currency in rows:
+        day = date.fromisoformat(when[:10])
+        for period in PERIODS:
+            key = (user_id, period, period_start(day, period).isoformat())
+            bucket = buckets.setdefault(key + (category, currency), [0, 0])
+            bucket[0] += amount
+            bucket[1] += 1
+    cursor.executemany(
+        """INSERT INTO expense_buckets
+        (user_id, period, start, category, currency, total, count)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, period, start, category, currency) DO UPDATE SET
+        total = total + excluded.total, count = count + excluded.count""",
+        [key + tuple(value) for key, value in buckets.items()],
+    )
+
+
+def compare_months(db, user_id, today=None):
+    """Сравнивает расходы текущего и прошлого месяца по категориям.
+
+    :param db: База данных бота
+    :type db: FinanceDB или ShardedFinanceDB
+    :param user_id: Идентификатор пользователя
+    :type user_id: int
+    :param today: День, от которого считать текущий месяц, по умолчанию
+        сегодня в UTC
+    :type today: datetime.date или None
+    :return: Словарь категория - (сумма в этом месяце, сумма в прошлом),
+        упорядоченный по категориям
+    :rtype: dict[str, tuple[decimal.Decimal, decimal.Decimal]]
+    """
+    today = today or datetime.now(timezone.utc).date()
+    current = period_start(today, "m")
+    previous = shift(current, "m", 1)
+    db = _database(db, user_id)
+    with db.pool.reader() as cursor:
+        rate = db.base_rate(cursor, user_id)
+        cursor.execute(
+            MONTHS_COMPARE,
+            (user_id, previous.isoformat(), current.isoformat()),
+        )
+        rows = cursor.fetchall()
+    result = {}
+    for start, category, total in rows:
+        bucket = result.setdefault(category, [0, 0])
+        bucket[start != current.isoformat()] += total
+    return {
+        category: (_base(this, rate), _base(last, rate))
+        for category, (this, last) in sorted(result.items())
+    }
+
+
+def monthly_totals(db, user_id, months=6, today=None):
+    """Суммы расходов по последним месяцам.
+
+    :param db: База данных бота
+    :type db: FinanceDB или ShardedFinanceDB
+    :param user_id: Идентификатор пользователя
+    :type user_id: int
+    :param months: Сколько месяцев, включая текущий
+    :type months: int
+    :param today: День текущего месяца, по умолчанию сегодня в UTC
+    :type today: datetime.date или None
+    :return: Пары (первый день месяца, сумма) от старых к новым, месяцы
+        без расходов тоже входят
+    :rtype: list[tuple[str, decimal.Decimal]]
+    """
+    today = today or datetime.now(timezone.utc).date()
+    last = period_start(today, "m")
+    starts = [
+        shift(last, "m", count).isoformat()
+        for count in range(months - 1, -1, -1)
+    ]
+    db = _database(db, user_id)
+    with db.pool.reader() as cursor:
+        rate = db.base_rate(cursor, user_id)
+        cursor.execute(MONTHS_RANGE, (user_id, starts[0], starts[-1]))
+        rows = cursor.fetchall()
+    totals = dict.fromkeys(starts, 0)
+    for start, total in rows:
+        totals[start] += total
+    return [(start, _base(total, rate)) for start, total in totals.items()]
+
+
+def rolling_average(db, user_id, period="d", window=7, today=None):
+    """Средние расходы за период по последним window периодам.
+
+    Текущий период учитывается, периоды без расходов считаются нулевыми.
+
+    :param db: База данных бота
+    :type db: FinanceDB или ShardedFinanceDB
+    :param user_id: Идентификатор пользователя
+    :type user_id: int
+    :param period: "d", "w" или "m"
+    :type period: str
+    :param window: Сколько периодов усреднять
+    :type window: int
+    :param today: Последний день окна, по умолчанию сегодня в UTC
+    :type today: datetime.date или None
+    :return: Словарь категория - средняя сумма за период, округленная до
+        копеек, упорядоченный по категориям
+    :rtype: dict[str, decimal.Decimal]
+    """
+    today = today or datetime.now(timezone.utc).date()
+    last = period_start(today, period)
+    first = shift(last, period, window - 1)
+    db = _database(db, user_id)
+    with db.pool.reader() as cursor:
+        rate = db.base_rate(cursor, user_id)
+        cursor.execute(
+            BUCKETS_RANGE,
+            (user_id, period, first.isoformat(), last.isoformat()),
+        )
+        rows = cursor.fetchall()
+    totals = {}
+    for category, total in rows:
+        totals[category] = totals.get(category, 0) + total
+    return {
+        category: _base(total, rate * window)
+        for category, total in sorted(totals.items())
+    }
+
+
+def _database(db, user_id):
+    """Возвращает базу, в которой лежат данные пользователя: для
+    ShardedFinanceDB - его шард.
+    """
+    from finance_shards import ShardedFinanceDB
+
+    if isinstance(db, ShardedFinanceDB):
+        return db.shard(user_id)
+    return db
+
+
+def _base(total, rate):
+    """Переводит сумму, умноженную на курс валюты расхода, в Decimal
+    базовой валюты, деленную на rate.
+    """
+    return from_kopecks(round(total / rate))
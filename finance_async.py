@@ -0,0 +1,213 @@
+"""Асинхронный режим работы бота на AsyncTeleBot.
+
+Обновления принимает AsyncTeleBot в одном цикле asyncio, а те же
+обработчики, что зарегистрированы на синхронном боте, выполняются в
+ограниченном пуле потоков вместе со своими запросами к базе. Сетевые
+вызовы Telegram API из обработчиков не блокируют потоки пула: фасад
+AsyncBotBridge ставит их в цикл asyncio и сразу возвращает управление.
+Так тысячам одновременных чатов не нужны тысячи потоков.
+
+Требует пакет aiohttp.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncBotBridge:
+    """Синхронный фасад AsyncTeleBot для обычных обработчиков.
+
+    Повторяет методы TeleBot, которыми пользуются обработчики бота.
+    Вызов не ждет ответа Telegram: корутина запускается в цикле asyncio,
+    а вызывающему возвращается concurrent.futures.Future. Запросы в один
+    чат отправляются строго по очереди, чтобы сообщения не перемешались.
+
+    :ivar abot: Асинхронный бот
+    :vartype abot: telebot.async_telebot.AsyncTeleBot
+    """
+
+    def __init__(self, abot, loop=None):
+        """
+        :param abot: Асинхронный бот
+        :type abot: telebot.async_telebot.AsyncTeleBot
+        :param loop: Цикл asyncio, в котором работает бот
+        :type loop: asyncio.AbstractEventLoop или None
+        """
+        self.abot = abot
+        self.loop = loop
+        self._chat_locks = {}
+        self._pending = defaultdict(int)
+
+    def _schedule(self, chat_id, coro):
+        """Запускает корутину в цикле бота с очередью по чату.
+
+        :param chat_id: Чат, в котором нужен порядок вызовов, или None
+        :param coro: Корутина вызова Telegram API
+        :return: Future с результатом вызова
+        :rtype: concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self._in_order(chat_id, coro), self.loop
+        )
+
+    async def _in_order(self, chat_id, coro):
+        """Выполняет корутину, дождавшись предыдущих вызовов в этот чат."""
+        if chat_id is None:
+            return await coro
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        self._pending[chat_id] += 1
+        try:
+            async with lock:
+                return await coro
+        except Exception as e:
+            logger.error(f"Ошибка отправки в чат {chat_id}: {e}")
+            raise
+        finally:
+            self._pending[chat_id] -= 1
+            if not self._pending[chat_id]:
+                del self._pending[chat_id]
+                del self._chat_locks[chat_id]
+
+    def send_message(self, chat_id, text, **kwargs):
+        """Отправляет сообщение, не дожидаясь ответа Telegram.
+
+        :return: Future с отправленным сообщением
+        :rtype: concurrent.futures.Future
+        """
+        return self._schedule(
+            chat_id, self.abot.send_message(chat_id, text, **kwargs)
+        )
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        """Редактирует текст сообщения, не дожидаясь ответа Telegram.
+
+        :return: Future с отредактированным сообщением
+        :rtype: concurrent.futures.Future
+        """
+        return self._schedule(
+            chat_id,
+            self.abot.edit_message_text(text, chat_id, message_id, **kwargs),
+        )
+
+    def send_document(self, chat_id, document, **kwargs):
+        """Отправляет документ, не дожидаясь ответа Telegram.
+
+        Файл должен оставаться открытым, пока Future не завершится.
+
+        :return: Future с отправленным сообщением
+        :rtype: concurrent.futures.Future
+        """
+        return self._schedule(
+            chat_id, self.abot.send_document(chat_id, document, **kwargs)
+        )
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        """Отправляет картинку, не дожидаясь ответа Telegram.
+
+        :return: Future с отправленным сообщением
+        :rtype: concurrent.futures.Future
+        """
+        return self._schedule(
+            chat_id, self.abot.send_photo(chat_id, photo, **kwargs)
+        )
+
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        """Отвечает на нажатие инлайн-кнопки.
+
+        :return: Future с ответом Telegram
+        :rtype: concurrent.futures.Future
+        """
+        return self._schedule(
+            None,
+            self.abot.answer_callback_query(callback_query_id, text, **kwargs),
+        )
+
+
+class AsyncRuntime:
+    """Запуск обработчиков синхронного бота поверх AsyncTeleBot.
+
+    Все обработчики сообщений и нажатий кнопок, зарегистрированные на
+    синхронном боте, переносятся на асинхронный бот в том же порядке и
+    с теми же фильтрами. Каждый обработчик становится корутиной, которая
+    выполняет исходную функцию в пуле потоков.
+
+    :ivar bridge: Фасад, который обработчики используют вместо TeleBot
+    :vartype bridge: AsyncBotBridge
+    """
+
+    def __init__(self, sync_bot, workers=16):
+        """
+        :param sync_bot: Синхронный бот с зарегистрированными обработчиками
+        :type sync_bot: telebot.TeleBot
+        :param workers: Количество потоков для обработчиков и запросов к
+            базе
+        :type workers: int
+        """
+        from telebot.async_telebot import AsyncTeleBot
+
+        self.sync_bot = sync_bot
+        self.abot = AsyncTeleBot(sync_bot.token)
+        self.bridge = AsyncBotBridge(self.abot)
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="handler"
+        )
+        self.loop = None
+
+        for handler in sync_bot.message_handlers:
+            self.abot.register_message_handler(
+                self.wrap(handler["function"]), **handler["filters"]
+            )
+        for handler in sync_bot.callback_query_handlers:
+            self.abot.register_callback_query_handler(
+                self.wrap(handler["function"]), **handler["filters"]
+            )
+
+    def wrap(self, handler):
+        """Превращает синхронный обработчик в корутину.
+
+        :param handler: Обработчик вида ``handler(update)``
+        :type handler: callable
+        :return: Корутинная функция с тем же именем
+        :rtype: callable
+        """
+        async def coroutine(update):
+            await self.loop.run_in_executor(
+                self.executor, self._call, handler, update
+            )
+
+        coroutine.__name__ = handler.__name__
+        coroutine.__doc__ = handler.__doc__
+        return coroutine
+
+    @staticmethod
+    def _call(handler, update):
+        """Вызывает обработчик в потоке пула и записывает его ошибки."""
+        try:
+            handler(update)
+        except Exception as e:
+            logger.error(f"Ошибка в {handler.__name__}: {e}")
+
+    async def main(self):
+        """Запускает опрос Telegram до остановки.
+
+        :return: None
+        :rtype: None
+        """
+        self.loop = asyncio.get_running_loop()
+        self.bridge.loop = self.loop
+        try:
+            await self.abot.infinity_polling()
+        finally:
+            await self.abot.close_session()
+            self.executor.shutdown(wait=False)
+
+    def run(self):
+        """Запускает цикл asyncio с ботом и блокирует поток до остановки.
+
+        :return: None
+        :rtype: None
+        """
+        asyncio.run(self.main())
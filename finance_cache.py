@@ -0,0 +1,128 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Потокобезопасный LRU-кэш с ограниченным временем жизни записей.
+
+    Хранит не больше ``maxsize`` записей, при переполнении вытесняет
+    самую давно использованную. Запись старше ``ttl`` секунд считается
+    отсутствующей.
+
+    Значение, загруженное через get_or_load(), не попадает в кэш, если
+    пока оно читалось из базы, ключ был сброшен через invalidate(). Так
+    чтение, начавшееся до записи в базу, не вернет в кэш старое значение.
+
+    :ivar hits: Количество попаданий в кэш
+    :vartype hits: int
+
+    :ivar misses: Количество промахов
+    :vartype misses: int
+    """
+
+    def __init__(self, maxsize=10000, ttl=60.0, clock=time.monotonic):
+        """
+        Создает пустой кэш
+
+        :param maxsize: Максимальное количество записей, 0 - не кэшировать
+        :type maxsize: int
+        :param ttl: Время жизни записи в секундах
+        :type ttl: float
+        :param clock: Источник времени, нужен для подмены в тестах
+        :type clock: callable
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._data = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_or_load(self, key, loader):
+        """Возвращает значение из кэша или загружает его через loader.
+
+        Результат None не кэшируется.
+
+        :param key: Ключ записи
+        :param loader: Функция без аргументов, читающая значение из базы
+        :type loader: callable
+        :return: Значение из кэша или результат loader()
+        :raises Exception: Исключение, которое выбросил loader
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > self._clock():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            token = object()
+            self._loading[key] = token
+
+        try:
+            value = loader()
+        except BaseException:
+            with self._lock:
+                if self._loading.get(key) is token:
+                    del self._loading[key]
+            raise
+
+        with self._lock:
+            if self._loading.get(key) is token:
+                del self._loading[key]
+                if value is not None:
+                    self._store(key, value)
+        return value
+
+    def _store(self, key, value):
+        """Кладет значение в кэш, вытесняя старые записи. Вызывается под
+        блокировкой.
+        """
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (value, self._clock() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """Сбрасывает запись кэша.
+
+        :param key: Ключ записи, None - сбросить весь кэш
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            if key is None:
+                self._data.clear()
+                self._loading.clear()
+            else:
+                self._data.pop(key, None)
+                self._loading.pop(key, None)
+
+    def info(self):
+        """Возвращает счетчики кэша.
+
+        :return: Словарь с ключами hits, misses, hit_rate, size, maxsize,
+            ttl
+        :rtype: dict
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+            }
@@ -0,0 +1,227 @@
+"""Картинки со статистикой расходов.
+
+График строит matplotlib в отдельном процессе пула, поэтому его работа
+не держит GIL и не задерживает потоки обработчиков. Готовые PNG хранятся
+в кэше по хэшу пользователя и данных графика, а после первой отправки
+запоминается file_id картинки в Telegram: повторный запрос с теми же
+данными не строит график заново и не загружает файл, а отправляет
+file_id.
+
+Требует пакет matplotlib, без него графики отключены.
+"""
+import hashlib
+import importlib.util
+import io
+import json
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from finance_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+CHARTS_AVAILABLE = importlib.util.find_spec("matplotlib") is not None
+"""
+Установлен ли matplotlib, нужный для графиков
+
+:type: bool
+"""
+
+
+def render_chart(stats, months):
+    """Рисует круговую диаграмму по категориям и столбцы по месяцам.
+
+    Выполняется в процессе пула, поэтому принимает и возвращает только
+    простые значения.
+
+    :param stats: Суммы по категориям
+    :type stats: dict[str, float]
+    :param months: Суммы по месяцам: пары (первый день месяца, сумма)
+    :type months: list[tuple[str, float]]
+    :return: Картинка PNG
+    :rtype: bytes
+    """
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=(9, 4), dpi=100)
+    pie, bars = figure.subplots(1, 2)
+    pie.pie(
+        list(stats.values()),
+        labels=list(stats),
+        autopct="%1.0f%%",
+        startangle=90,
+    )
+    pie.set_title("По категориям")
+    pie.axis("equal")
+    bars.bar([start[:7] for start, _ in months], [t for _, t in months])
+    bars.set_title("По месяцам")
+    bars.tick_params(axis="x", labelrotation=45)
+    figure.tight_layout()
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+
+def pool_context():
+    """Способ запуска процессов пула рисования.
+
+    Пул создается при первом графике, когда в боте уже работают потоки
+    Outbox, TeleBot и писателя SQLite. Процесс, созданный fork, мог бы
+    унаследовать блокировку, которую в этот момент держал один из них, и
+    зависнуть навсегда, поэтому процессы запускаются через forkserver, а
+    где его нет - через spawn.
+
+    :return: Контекст multiprocessing
+    :rtype: multiprocessing.context.BaseContext
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def chart_key(user_id, stats, months):
+    """Хэш пользователя и данных графика, ключ кэшей картинок.
+
+    :param user_id: Идентификатор пользователя
+    :type user_id: int
+    :param stats: Суммы по категориям
+    :type stats: dict[str, float]
+    :param months: Суммы по месяцам
+    :type months: list[tuple[str, float]]
+    :return: Шестнадцатеричный SHA-256
+    :rtype: str
+    """
+    data = json.dumps(
+        [user_id, sorted(stats.items()), list(months)], ensure_ascii=False
+    )
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class ChartRenderer:
+    """Построение и отправка графиков статистики.
+
+    :ivar outbox: Очередь отправки: картинка уходит в очередь чата после
+        поставленных раньше сообщений, с ее лимитами и повтором после 429
+    :vartype outbox: finance_outbox.Outbox
+
+    :ivar pngs: Готовые PNG по ключу chart_key()
+    :vartype pngs: TTLCache
+
+    :ivar file_ids: file_id отправленных картинок по ключу chart_key()
+    :vartype file_ids: TTLCache
+
+    :ivar renders: Сколько раз график рисовался
+    :vartype renders: int
+    """
+
+    def __init__(
+        self,
+        outbox,
+        processes=1,
+        cache_size=256,
+        cache_ttl=86400.0,
+        render=render_chart,
+    ):
+        """
+        :param outbox: Очередь отправки
+        :type outbox: finance_outbox.Outbox
+        :param processes: Количество процессов для рисования
+        :type processes: int
+        :param cache_size: Сколько картинок и file_id держать в кэше
+        :type cache_size: int
+        :param cache_ttl: Время жизни записи кэша в секундах
+        :type cache_ttl: float
+        :param render: Функция рисования ``render(stats, months) ->
+            bytes``, должна быть доступна по имени модуля в процессе пула
+        :type render: callable
+        """
+        self.outbox = outbox
+        self.processes = processes
+        self.render = render
+        self.pngs = TTLCache(cache_size, cache_ttl)
+        self.file_ids = TTLCache(cache_size, cache_ttl)
+        self.renders = 0
+        self._processes = None
+        self._threads = None
+        self._lock = threading.Lock()
+
+    def submit(self, chat_id, user_id, stats, months):
+        """Ставит отправку графика в очередь и сразу возвращается.
+
+        :param chat_id: Чат получателя
+        :type chat_id: int
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :param stats: Суммы по категориям
+        :type stats: dict[str, decimal.Decimal или float]
+        :param months: Суммы по месяцам
+        :type months: list[tuple[str, decimal.Decimal или float]]
+        :return: Future с отправленным сообщением
+        :rtype: concurrent.futures.Future
+        """
+        # В процесс пула и в ключ кэша передаются простые float
+        stats = {category: float(total) for category, total in stats.items()}
+        months = [(start, float(total)) for start, total in months]
+        with self._lock:
+            if self._threads is None:
+                self._processes = ProcessPoolExecutor(
+                    self.processes, mp_context=pool_context()
+                )
+                self._threads = ThreadPoolExecutor(
+                    max_workers=self.processes * 2,
+                    thread_name_prefix="chart",
+                )
+        return self._threads.submit(
+            self.send, chat_id, user_id, stats, months
+        )
+
+    def send(self, chat_id, user_id, stats, months):
+        """Отправляет график, построив и загрузив его только при
+        необходимости.
+
+        :return: Отправленное сообщение
+        :rtype: telebot.types.Message
+        :raises Exception: Ошибки рисования и Telegram API
+        """
+        key = chart_key(user_id, stats, months)
+        sent = []
+
+        def upload():
+            png = self.pngs.get_or_load(
+                key, lambda: self._render(stats, months)
+            )
+            sent.append(self._send_photo(chat_id, png))
+            return sent[0].photo[-1].file_id
+
+        try:
+            file_id = self.file_ids.get_or_load(key, upload)
+            if not sent:
+                sent.append(self._send_photo(chat_id, file_id))
+        except Exception as e:
+            logger.error(f"Ошибка отправки графика для {user_id}: {e}")
+            raise
+        return sent[0]
+
+    def _render(self, stats, months):
+        """Рисует график в процессе пула и ждет результат."""
+        with self._lock:
+            self.renders += 1
+            processes = self._processes
+        if processes is None:
+            return self.render(stats, months)
+        return processes.submit(self.render, stats, months).result()
+
+    def _send_photo(self, chat_id, photo):
+        return self.outbox.call(chat_id, "send_photo", chat_id, photo).result()
+
+    def close(self):
+        """Дожидается отправки графиков и останавливает пулы.
+
+        :return: None
+        :rtype: None
+        """
+        if self._threads is not None:
+            self._threads.shutdown(wait=True)
+            self._processes.shutdown(wait=True)
@@ -0,0 +1,220 @@
+"""Выгрузка всей истории расходов пользователя файлом.
+
+Расходы читаются генератором FinanceDB.iter_expenses() и сразу пишутся
+в SpooledTemporaryFile: небольшой файл остается в памяти, большой
+переносится на диск, поэтому память не зависит от количества записей.
+Выгрузка выполняется в отдельном небольшом пуле потоков, чтобы долгий
+экспорт не занимал потоки обработчиков сообщений.
+
+Формат XLSX требует пакет openpyxl, без него доступен только CSV.
+"""
+import csv
+import importlib.util
+import io
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+logger = logging.getLogger(__name__)
+
+SPOOL_SIZE = 1024 * 1024
+"""
+Размер файла в байтах, после которого выгрузка переносится из памяти во
+временный файл на диске
+
+:type: int
+"""
+
+HEADER = ("date", "category", "amount")
+"""
+Заголовок выгружаемой таблицы
+
+:type: tuple[str]
+"""
+
+XLSX_AVAILABLE = importlib.util.find_spec("openpyxl") is not None
+"""
+Установлен ли openpyxl, нужный для формата XLSX
+
+:type: bool
+"""
+
+
+def write_csv(rows, spool_size=SPOOL_SIZE):
+    """Пишет строки в CSV во временный файл.
+
+    Файл начинается с BOM, чтобы Excel открыл кириллицу без настройки
+    кодировки.
+
+    :param rows: Строки таблицы без заголовка
+    :type rows: Iterable[tuple]
+    :param spool_size: Сколько байт держать в памяти
+    :type spool_size: int
+    :return: Двоичный файл, установленный на начало, и количество строк
+    :rtype: tuple[tempfile.SpooledTemporaryFile, int]
+    """
+    f = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    text = io.TextIOWrapper(f, encoding="utf-8-sig", newline="")
+    writer = csv.writer(text)
+    writer.writerow(HEADER)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    text.flush()
+    text.detach()
+    f.seek(0)
+    return f, count
+
+
+def write_xlsx(rows, spool_size=SPOOL_SIZE):
+    """Пишет строки в XLSX во временный файл.
+
+    Книга создается в режиме write_only: openpyxl не держит строки в
+    памяти, а сразу сбрасывает их на диск.
+
+    :param rows: Строки таблицы без заголовка
+    :type rows: Iterable[tuple]
+    :param spool_size: Сколько байт держать в памяти
+    :type spool_size: int
+    :return: Двоичный файл, установленный на начало, и количество строк
+    :rtype: tuple[tempfile.SpooledTemporaryFile, int]
+    :raises ImportError: Если openpyxl не установлен
+    """
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Расходы")
+    sheet.append(HEADER)
+    count = 0
+    for row in rows:
+        sheet.append(row)
+        count += 1
+    f = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    workbook.save(f)
+    f.seek(0)
+    return f, count
+
+
+WRITERS = {"csv": write_csv, "xlsx": write_xlsx}
+"""
+Функции записи по формату выгрузки
+
+:type: dict[str, callable]
+"""
+
+
+class Exporter:
+    """Пул выгрузок истории расходов с отправкой документом.
+
+    Одновременно у пользователя идет не больше одной выгрузки, повторный
+    запрос во время выгрузки отклоняется.
+
+    :ivar outbox: Очередь отправки: документ уходит в очередь чата после
+        поставленных раньше сообщений, с ее лимитами и повтором после 429
+    :vartype outbox: finance_outbox.Outbox
+
+    :ivar db: База данных бота
+    :vartype db: FinanceDB
+    """
+
+    def __init__(self, outbox, db, workers=2, chunk_size=1000):
+        """
+        :param outbox: Очередь отправки
+        :type outbox: finance_outbox.Outbox
+        :param db: База данных бота
+        :type db: FinanceDB
+        :param workers: Количество одновременных выгрузок
+        :type workers: int
+        :param chunk_size: Сколько записей читать из базы за раз
+        :type chunk_size: int
+        """
+        self.outbox = outbox
+        self.db = db
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._executor = None
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def submit(self, chat_id, user_id, fmt="csv", notice=None):
+        """Ставит выгрузку в очередь.
+
+        :param chat_id: Чат, в который отправить файл
+        :type chat_id: int
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :param fmt: "csv" или "xlsx"
+        :type fmt: str
+        :param notice: Сообщение, которое поставить в очередь чата до
+            начала выгрузки, если она принята. Так оно всегда приходит
+            раньше файла
+        :type notice: str или None
+        :return: Future с количеством выгруженных расходов или None, если
+            у пользователя уже идет выгрузка
+        :rtype: concurrent.futures.Future или None
+        :raises ValueError: Если формат не поддерживается
+        """
+        if fmt not in WRITERS:
+            raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+        with self._lock:
+            if user_id in self._running:
+                return None
+            self._running.add(user_id)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="export"
+                )
+        if notice is not None:
+            self.outbox.send(chat_id, notice)
+        return self._executor.submit(self.export, chat_id, user_id, fmt)
+
+    def export(self, chat_id, user_id, fmt="csv"):
+        """Выгружает расходы пользователя и отправляет файл в чат.
+
+        Если расходов нет, документ не отправляется.
+
+        :param chat_id: Чат, в который отправить файл
+        :type chat_id: int
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :param fmt: "csv" или "xlsx"
+        :type fmt: str
+        :return: Количество выгруженных расходов
+        :rtype: int
+        :raises Exception: Ошибки базы и Telegram API
+        """
+        try:
+            rows = self.db.iter_expenses(user_id, self.chunk_size)
+            f, count = WRITERS[fmt](rows)
+            with f:
+                if count:
+                    # Файл открыт, пока Outbox не отправит его
+                    self.outbox.call(
+                        chat_id,
+                        "send_document",
+                        chat_id,
+                        f,
+                        caption=f"📤 Расходов: {count}",
+                        visible_file_name=(
+                            f"expenses_{date.today().isoformat()}.{fmt}"
+                        ),
+                    ).result()
+            return count
+        except Exception as e:
+            logger.error(f"Ошибка выгрузки для {user_id}: {e}")
+            raise
+        finally:
+            with self._lock:
+                self._running.discard(user_id)
+
+    def close(self):
+        """Дожидается текущих выгрузок и останавливает пул.
+
+        :return: None
+        :rtype: None
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
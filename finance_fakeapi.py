@@ -0,0 +1,290 @@
+"""Локальный поддельный сервер Bot API для тестов и нагрузочных замеров.
+
+Сервер отвечает на методы Telegram так, как это нужно боту: sendMessage,
+sendDocument и sendPhoto возвращают сообщение, getUpdates отдает обновления из
+очереди, остальные методы возвращают True. Все вызовы записываются, а
+ошибки вроде 429 Too Many Requests можно заранее запланировать.
+
+Пример::
+
+    with FakeBotAPI() as api:
+        bot.send_message(1, "Привет")
+        assert api.calls[0].params["text"] == "Привет"
+"""
+import itertools
+import json
+import queue
+import threading
+import time
+from collections import namedtuple
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from telebot import apihelper
+
+ApiCall = namedtuple("ApiCall", "method params files time")
+"""
+Запись об одном вызове API: имя метода, параметры, имена загруженных
+файлов и момент вызова по time.monotonic()
+"""
+
+
+class _Server(ThreadingHTTPServer):
+    """HTTP-сервер с длинной очередью подключений.
+
+    При стандартной очереди из 5 подключений лишние SYN отбрасываются, и
+    клиент повторяет подключение только через секунду, что искажает
+    задержки в нагрузочных замерах.
+    """
+
+    request_queue_size = 256
+    daemon_threads = True
+
+
+class FakeBotAPI:
+    """Поддельный сервер Bot API на свободном локальном порту.
+
+    Внутри ``with`` запросы TeleBot направляются на этот сервер через
+    ``telebot.apihelper.API_URL``, на выходе прежний адрес
+    восстанавливается.
+
+    :ivar calls: Вызовы API в порядке поступления
+    :vartype calls: list[ApiCall]
+
+    :ivar updates: Обновления, которые вернет getUpdates
+    :vartype updates: queue.Queue
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, record=True):
+        """
+        :param host: Адрес сервера
+        :type host: str
+        :param port: Порт сервера, 0 - выбрать свободный
+        :type port: int
+        :param latency: Задержка ответа на каждый вызов в секундах
+        :type latency: float
+        :param record: Записывать ли вызовы в calls. В долгих нагрузочных
+            замерах запись отключают, чтобы не копить все вызовы в памяти
+        :type record: bool
+        """
+        self.latency = latency
+        self.record = record
+        self.calls = []
+        self.updates = queue.Queue()
+        self._failures = {}
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._saved_url = None
+        self.httpd = _Server((host, port), self._handler_class())
+        self._serving = None
+
+    @property
+    def url(self):
+        """Адрес сервера вида http://host:port.
+
+        :rtype: str
+        """
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def fail_next(self, method, error_code=429, retry_after=1, times=1):
+        """Планирует ошибку на следующие вызовы метода.
+
+        :param method: Имя метода API, например "sendMessage"
+        :type method: str
+        :param error_code: Код ошибки Telegram
+        :type error_code: int
+        :param retry_after: Значение parameters.retry_after для 429
+        :type retry_after: int
+        :param times: Сколько вызовов подряд завершатся ошибкой
+        :type times: int
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            self._failures.setdefault(method, []).extend(
+                [(error_code, retry_after)] * times
+            )
+
+    def methods(self, method):
+        """Возвращает параметры всех вызовов метода.
+
+        :param method: Имя метода API
+        :type method: str
+        :return: Параметры вызовов в порядке поступления
+        :rtype: list[dict]
+        """
+        with self._lock:
+            return [
+                call.params for call in self.calls if call.method == method
+            ]
+
+    def handle(self, method, params, files):
+        """Записывает вызов и формирует ответ API.
+
+        :param method: Имя метода API
+        :type method: str
+        :param params: Параметры вызова
+        :type params: dict
+        :param files: Имена загруженных файлов по полям формы
+        :type files: dict[str, str]
+        :return: HTTP-код и JSON-ответ
+        :rtype: tuple[int, dict]
+        """
+        with self._lock:
+            if self.record:
+                self.calls.append(
+                    ApiCall(method, params, files, time.monotonic())
+                )
+            failures = self._failures.get(method)
+            failure = failures.pop(0) if failures else None
+        if self.latency:
+            time.sleep(self.latency)
+        if failure is not None:
+            error_code, retry_after = failure
+            body = {
+                "ok": False,
+                "error_code": error_code,
+                "description": f"Error {error_code}",
+            }
+            if error_code == 429:
+                body["parameters"] = {"retry_after": retry_after}
+            return error_code, body
+        return 200, {"ok": True, "result": self._result(method, params)}
+
+    def _result(self, method, params):
+        """Результат успешного вызова метода."""
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "FakeBot"}
+        if method == "getUpdates":
+            return self._drain_updates(params)
+        if method in (
+            "sendMessage", "editMessageText", "sendDocument", "sendPhoto"
+        ):
+            message = {
+                "message_id": int(params.get("message_id") or 0)
+                or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "private"},
+            }
+            if method == "sendDocument":
+                message["document"] = {
+                    "file_id": f"doc{message['message_id']}",
+                    "file_unique_id": f"u{message['message_id']}",
+                }
+            elif method == "sendPhoto":
+                photo = params["photo"]
+                if isinstance(photo, bytes):
+                    photo = f"photo{message['message_id']}"
+                message["photo"] = [{
+                    "file_id": photo,
+                    "file_unique_id": f"u{photo}",
+                    "width": 1,
+                    "height": 1,
+                }]
+            else:
+                message["text"] = params.get("text", "")
+            return message
+        return True
+
+    def _drain_updates(self, params):
+        """Ответ getUpdates: ждет первое обновление не дольше timeout."""
+        try:
+            timeout = float(params.get("timeout") or 0)
+            result = [self.updates.get(timeout=min(timeout, 1.0) or 0.01)]
+        except queue.Empty:
+            return []
+        limit = int(params.get("limit") or 100)
+        while len(result) < limit:
+            try:
+                result.append(self.updates.get_nowait())
+            except queue.Empty:
+                break
+        return result
+
+    def _handler_class(self):
+        """Создает класс обработчика HTTP-запросов для этого сервера."""
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self._call(b"")
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self._call(self.rfile.read(length))
+
+            def _call(self, body):
+                parts = urlsplit(self.path)
+                method = parts.path.rsplit("/", 1)[-1]
+                params = dict(parse_qsl(parts.query))
+                files = {}
+                content_type = self.headers.get("Content-Type") or ""
+                if content_type.startswith("multipart/form-data"):
+                    _parse_multipart(content_type, body, params, files)
+                elif content_type.startswith("application/json"):
+                    params.update(json.loads(body or b"{}"))
+                elif body:
+                    params.update(parse_qsl(body.decode("utf-8")))
+                status, answer = api.handle(method, params, files)
+                data = json.dumps(answer).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        """Запускает сервер в фоновом потоке.
+
+        :return: Этот же сервер
+        :rtype: FakeBotAPI
+        """
+        self._serving = threading.Thread(
+            target=self.httpd.serve_forever, name="fake-bot-api", daemon=True
+        )
+        self._serving.start()
+        return self
+
+    def stop(self):
+        """Останавливает сервер.
+
+        :return: None
+        :rtype: None
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        self.start()
+        self._saved_url = apihelper.API_URL
+        apihelper.API_URL = self.url + "/bot{0}/{1}"
+        return self
+
+    def __exit__(self, *exc_info):
+        apihelper.API_URL = self._saved_url
+        self.stop()
+
+
+def _parse_multipart(content_type, body, params, files):
+    """Разбирает тело multipart/form-data в параметры и файлы."""
+    message = BytesParser(policy=HTTP).parsebytes(
+        b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n"
+        + body
+    )
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        filename = part.get_filename()
+        payload = part.get_payload(decode=True)
+        if filename is not None:
+            files[name] = filename
+            params[name] = payload
+        else:
+            params[name] = payload.decode("utf-8")
@@ -0,0 +1,158 @@
+"""Потоковое чтение файлов с историей расходов для массового импорта.
+
+Поддерживаются CSV с заголовком и JSONL, по одной записи в строке. Поля
+записи: user_id, category, amount и необязательные date и currency.
+Файл читается построчно в двоичном режиме, поэтому для каждой записи
+известно смещение конца строки в байтах: по нему импорт продолжается с
+места остановки без повторного чтения начала файла, а память не зависит
+от размера файла.
+"""
+import csv
+import json
+import os
+from datetime import datetime
+
+from finance_money import to_kopecks
+from finance_rates import normalize_currency
+
+FORMATS = ("csv", "jsonl")
+"""
+Поддерживаемые форматы файлов
+
+:type: tuple[str]
+"""
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+"""
+Формат даты в таблице expenses, как у CURRENT_TIMESTAMP
+
+:type: str
+"""
+
+
+def detect_format(path):
+    """Определяет формат файла по расширению.
+
+    :param path: Путь к файлу
+    :type path: str
+    :return: "csv" или "jsonl"
+    :rtype: str
+    :raises ValueError: Если расширение не поддерживается
+    """
+    extension = os.path.splitext(path)[1].lower().lstrip(".")
+    if extension == "json":
+        extension = "jsonl"
+    if extension not in FORMATS:
+        raise ValueError(f"Неизвестный формат файла: {path}")
+    return extension
+
+
+def category_names(buttons):
+    """Строит словарь допустимых категорий по кнопкам бота.
+
+    Категорию можно указать и названием ("Еда"), и полным текстом
+    кнопки ("🍔 Еда"), как ее принимает process_category.
+
+    :param buttons: Тексты кнопок категорий
+    :type buttons: Iterable[str]
+    :return: Словарь написание - название категории
+    :rtype: dict[str, str]
+    """
+    names = {}
+    for button in buttons:
+        names[button] = button[2:]
+        names[button[2:]] = button[2:]
+    return names
+
+
+def read_records(path, fmt, offset=0, line=0):
+    """Читает записи файла по одной.
+
+    :param path: Путь к файлу
+    :type path: str
+    :param fmt: "csv" или "jsonl"
+    :type fmt: str
+    :param offset: Смещение в байтах, с которого продолжить чтение
+    :type offset: int
+    :param line: Номер строки, соответствующий offset
+    :type line: int
+    :return: Генератор кортежей (номер строки, смещение конца строки,
+        запись или None для пустой строки, ошибка разбора или None)
+    :rtype: Iterator[tuple[int, int, dict или None, str или None]]
+    """
+    with open(path, "rb") as f:
+        header = None
+        if fmt == "csv":
+            first = f.readline()
+            header = next(csv.reader([first.decode("utf-8-sig")]), [])
+            header = [name.strip() for name in header]
+            if offset == 0:
+                offset = f.tell()
+                line = 1
+        f.seek(offset)
+        for raw in iter(f.readline, b""):
+            offset += len(raw)
+            line += 1
+            text = raw.decode("utf-8", errors="replace").strip()
+            if not text:
+                yield line, offset, None, None
+                continue
+            try:
+                if header is not None:
+                    record = dict(zip(header, next(csv.reader([text]))))
+                else:
+                    record = json.loads(text)
+                    if not isinstance(record, dict):
+                        raise ValueError("строка не является объектом")
+            except (ValueError, csv.Error) as e:
+                yield line, offset, None, f"не удалось разобрать: {e}"
+                continue
+            yield line, offset, record, None
+
+
+def parse_record(record, categories, currencies=None):
+    """Проверяет запись и приводит ее к строке таблицы expenses.
+
+    :param record: Запись из файла
+    :type record: dict
+    :param categories: Допустимые категории, результат category_names()
+    :type categories: dict[str, str]
+    :param currencies: Валюты с известным курсом, None - не проверять
+    :type currencies: set[str] или None
+    :return: Кортеж (user_id, category, amount, date, currency), amount -
+        сумма в копейках, date - строка в формате DATE_FORMAT или None
+        для текущего времени, currency - код валюты или None для
+        базовой валюты пользователя
+    :rtype: tuple[int, str, int, str или None, str или None]
+    :raises ValueError: Если запись некорректна
+    """
+    try:
+        user_id = int(record["user_id"])
+        amount = to_kopecks(record["amount"])
+        category = str(record["category"]).strip()
+    except KeyError as e:
+        raise ValueError(f"нет поля {e}")
+    except (TypeError, ValueError):
+        raise ValueError(
+            "user_id и amount должны быть числами в пределах INTEGER"
+        )
+    # Иначе INSERT бросит OverflowError и прервет всю пачку
+    if user_id.bit_length() > 63:
+        raise ValueError("user_id должен быть числом в пределах INTEGER")
+    if category not in categories:
+        raise ValueError(f"неизвестная категория {category!r}")
+    if not amount > 0:
+        raise ValueError("сумма должна быть больше 0")
+    date = record.get("date")
+    if date:
+        try:
+            date = datetime.fromisoformat(str(date)).strftime(DATE_FORMAT)
+        except ValueError:
+            raise ValueError(f"некорректная дата {date!r}")
+    currency = record.get("currency")
+    if currency:
+        currency = normalize_currency(currency)
+        if currencies is not None and currency not in currencies:
+            raise ValueError(f"нет курса валюты {currency}")
+    category = categories[category]
+    return user_id, category, amount, date or None, currency or None
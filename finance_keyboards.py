@@ -0,0 +1,87 @@
+"""Готовые клавиатуры бота.
+
+Клавиатуры ответов не меняются между сообщениями, поэтому каждая
+строится и сериализуется в JSON один раз при запуске. Обработчики берут
+клавиатуру по имени и передают в ``reply_markup`` уже готовую строку:
+TeleBot и AsyncTeleBot вызывают ``to_json()`` у любого
+``types.JsonSerializable``, и повторной сериализации не происходит.
+"""
+from telebot import types
+
+
+class FrozenKeyboard(types.JsonSerializable):
+    """Неизменяемая клавиатура с заранее сериализованным JSON.
+
+    :ivar name: Имя клавиатуры в реестре
+    :vartype name: str
+
+    :ivar json: JSON для параметра reply_markup
+    :vartype json: str
+    """
+
+    __slots__ = ("name", "json")
+
+    def __init__(self, name, markup):
+        """
+        :param name: Имя клавиатуры
+        :type name: str
+        :param markup: Клавиатура, которую нужно заморозить
+        :type markup: telebot.types.JsonSerializable
+        """
+        self.name = name
+        self.json = markup.to_json()
+
+    def to_json(self):
+        return self.json
+
+    def __repr__(self):
+        return f"FrozenKeyboard({self.name!r})"
+
+
+class KeyboardRegistry:
+    """Реестр готовых клавиатур по именам."""
+
+    def __init__(self):
+        self._keyboards = {}
+
+    def add(self, name, markup):
+        """Замораживает клавиатуру и сохраняет ее под именем.
+
+        :param name: Имя клавиатуры
+        :type name: str
+        :param markup: Построенная клавиатура
+        :type markup: telebot.types.JsonSerializable
+        :return: Замороженная клавиатура
+        :rtype: FrozenKeyboard
+        :raises ValueError: Если имя уже занято
+        """
+        if name in self._keyboards:
+            raise ValueError(f"Клавиатура {name!r} уже зарегистрирована")
+        keyboard = FrozenKeyboard(name, markup)
+        self._keyboards[name] = keyboard
+        return keyboard
+
+    def reply(self, name, *rows, row_width=2):
+        """Строит клавиатуру ответа из рядов кнопок и регистрирует ее.
+
+        :param name: Имя клавиатуры
+        :type name: str
+        :param rows: Ряды кнопок, каждый - последовательность текстов
+        :type rows: Sequence[str]
+        :param row_width: Максимум кнопок в ряду
+        :type row_width: int
+        :return: Замороженная клавиатура
+        :rtype: FrozenKeyboard
+        """
+        markup = types.ReplyKeyboardMarkup(
+            resize_keyboard=True, row_width=row_width
+        )
+        for row in rows:
+            markup.add(*row)
+        return self.add(name, markup)
+
+    def __getitem__(self, name):
+        return self._keyboards[name]
+
+    def __contains__(self, name):
+        return name in self._keyboards
@@ -0,0 +1,475 @@
+"""Замеры времени хендлеров, методов FinanceDB и SQL-запросов.
+
+Реестр Metrics хранит для каждого хендлера, метода и запроса счетчики
+вызовов и ошибок и гистограмму времени выполнения. Замеры пишут
+декоратор Metrics.timed(), контекстный менеджер Metrics.timer(),
+декоратор класса instrument() и курсор TimedCursor. Запросы дольше
+slow_query записываются в журнал вместе с текстом SQL.
+
+Счетчики вызовов и ошибок точные, а в гистограмму попадает только доля
+sample_rate вызовов, поэтому при sample_rate < 1 значения _count
+гистограммы меньше _calls_total.
+
+MetricsServer отдает реестр по ``GET /metrics`` в текстовом формате
+Prometheus::
+
+    server = MetricsServer(registry, port=9108).start()
+"""
+import bisect
+import functools
+import inspect
+import logging
+import random
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0,
+)
+"""
+Верхние границы корзин гистограмм в секундах
+
+:type: tuple[float]
+"""
+
+FAMILIES = {
+    "handler": ("handler", "Время обработки сообщения хендлером бота"),
+    "db": ("method", "Время выполнения метода FinanceDB"),
+    "query": ("query", "Время выполнения SQL-запроса"),
+}
+"""
+Семейства замеров: имя метки и описание для Prometheus
+
+:type: dict[str, tuple[str, str]]
+"""
+
+
+class _Series:
+    """Счетчики и гистограмма одного хендлера, метода или запроса."""
+
+    __slots__ = ("calls", "errors", "count", "sum", "buckets")
+
+    def __init__(self, size):
+        self.calls = 0
+        self.errors = 0
+        self.count = 0
+        self.sum = 0.0
+        self.buckets = [0] * size
+
+
+class Metrics:
+    """Потокобезопасный реестр замеров.
+
+    :ivar enabled: Записывать ли замеры, при False декораторы и курсор
+        сразу вызывают исходный код
+    :vartype enabled: bool
+
+    :ivar sample_rate: Доля вызовов от 0 до 1, время которых попадает в
+        гистограмму
+    :vartype sample_rate: float
+
+    :ivar slow_query: Порог медленного запроса в секундах, None - не
+        записывать медленные запросы в журнал
+    :vartype slow_query: float или None
+    """
+
+    def __init__(
+        self,
+        buckets=DEFAULT_BUCKETS,
+        sample_rate=1.0,
+        slow_query=0.1,
+        enabled=True,
+        rng=random.random,
+    ):
+        """
+        :param buckets: Верхние границы корзин гистограмм по возрастанию
+        :type buckets: tuple[float]
+        :param sample_rate: Доля вызовов, попадающих в гистограмму
+        :type sample_rate: float
+        :param slow_query: Порог медленного запроса в секундах
+        :type slow_query: float или None
+        :param enabled: Включены ли замеры
+        :type enabled: bool
+        :param rng: Источник случайных чисел для выборки, нужен для
+            подмены в тестах
+        :type rng: callable
+        """
+        self.buckets = tuple(buckets)
+        self.sample_rate = sample_rate
+        self.slow_query = slow_query
+        self.enabled = enabled
+        self._rng = rng
+        self._series = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def _sampled(self):
+        """Решает, попадет ли очередной вызов в гистограмму."""
+        rate = self.sample_rate
+        return rate >= 1.0 or (rate > 0.0 and self._rng() < rate)
+
+    def observe(self, family, name, seconds, error=False, sampled=True):
+        """Записывает один вызов.
+
+        :param family: Семейство: "handler", "db" или "query"
+        :type family: str
+        :param name: Имя хендлера, метода или текст запроса
+        :type name: str
+        :param seconds: Время выполнения
+        :type seconds: float
+        :param error: Завершился ли вызов исключением
+        :type error: bool
+        :param sampled: Добавлять ли время в гистограмму
+        :type sampled: bool
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            series = self._series.get((family, name))
+            if series is None:
+                series = _Series(len(self.buckets) + 1)
+                self._series[(family, name)] = series
+            series.calls += 1
+            if error:
+                series.errors += 1
+            if sampled:
+                series.count += 1
+                series.sum += seconds
+                series.buckets[bisect.bisect_left(self.buckets, seconds)] += 1
+
+    @contextmanager
+    def timer(self, family, name):
+        """Замеряет блок with как один вызов.
+
+        :param family: Семейство замера
+        :type family: str
+        :param name: Имя вызова
+        :type name: str
+        :return: Контекстный менеджер
+        """
+        if not self.enabled:
+            yield
+            return
+        sampled = self._sampled()
+        started = time.perf_counter()
+        error = True
+        try:
+            yield
+            error = False
+        finally:
+            self.observe(
+                family, name, time.perf_counter() - started, error, sampled
+            )
+
+    def timed(self, family, name=None):
+        """Декоратор: замеряет каждый вызов функции.
+
+        :param family: Семейство замера
+        :type family: str
+        :param name: Имя вызова, по умолчанию имя функции
+        :type name: str или None
+        :return: Декоратор
+        :rtype: callable
+        """
+        def decorator(func):
+            label = name or func.__name__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                sampled = self._sampled()
+                started = time.perf_counter()
+                error = True
+                try:
+                    result = func(*args, **kwargs)
+                    error = False
+                    return result
+                finally:
+                    self.observe(
+                        family,
+                        label,
+                        time.perf_counter() - started,
+                        error,
+                        sampled,
+                    )
+
+            return wrapper
+
+        return decorator
+
+    def query(self, sql, seconds, error=False):
+        """Записывает выполнение SQL-запроса и сообщает о медленном.
+
+        :param sql: Текст запроса
+        :type sql: str
+        :param seconds: Время выполнения
+        :type seconds: float
+        :param error: Завершился ли запрос ошибкой
+        :type error: bool
+        :return: None
+        :rtype: None
+        """
+        text = normalize_sql(sql)
+        self.observe("query", text, seconds, error, self._sampled())
+        if self.slow_query is not None and seconds >= self.slow_query:
+            logger.warning(
+                f"Медленный запрос {seconds * 1000:.1f} мс: {text}"
+            )
+
+    def add_gauges(self, prefix, func):
+        """Добавляет числа, которые считываются при каждом запросе
+        /metrics, например счетчики Outbox.snapshot().
+
+        :param prefix: Часть имени метрик: finance_<prefix>_<ключ>
+        :type prefix: str
+        :param func: Функция без аргументов, возвращающая словарь чисел
+        :type func: callable
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            self._gauges[prefix] = func
+
+    def snapshot(self):
+        """Возвращает копию замеров.
+
+        :return: Словарь семейство - имя - calls, errors, count, sum и
+            buckets (количество вызовов по корзинам, не накопленное)
+        :rtype: dict[str, dict[str, dict]]
+        """
+        result = {}
+        with self._lock:
+            for (family, name), series in self._series.items():
+                result.setdefault(family, {})[name] = {
+                    "calls": series.calls,
+                    "errors": series.errors,
+                    "count": series.count,
+                    "sum": series.sum,
+                    "buckets": list(series.buckets),
+                }
+        return result
+
+    def render(self):
+        """Собирает замеры в текстовом формате Prometheus 0.0.4.
+
+        :return: Текст для ответа на /metrics
+        :rtype: str
+        """
+        lines = []
+        snapshot = self.snapshot()
+        for family in sorted(snapshot):
+            label, description = FAMILIES.get(family, ("name", family))
+            metric = f"finance_{family}"
+            series = sorted(snapshot[family].items())
+            lines.append(f"# HELP {metric}_seconds {description}")
+            lines.append(f"# TYPE {metric}_seconds histogram")
+            for name, values in series:
+                labels = f'{label}="{_escape(name)}"'
+                total = 0
+                bounds = [repr(bound) for bound in self.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, values["buckets"]):
+                    total += count
+                    lines.append(
+                        f'{metric}_seconds_bucket{{{labels},le="{bound}"}} '
+                        f"{total}"
+                    )
+                lines.append(
+                    f"{metric}_seconds_sum{{{labels}}} {values['sum']!r}"
+                )
+                lines.append(
+                    f"{metric}_seconds_count{{{labels}}} {values['count']}"
+                )
+            for kind in ("calls", "errors"):
+                lines.append(f"# TYPE {metric}_{kind}_total counter")
+                for name, values in series:
+                    lines.append(
+                        f'{metric}_{kind}_total{{{label}="{_escape(name)}"}} '
+                        f"{values[kind]}"
+                    )
+        with self._lock:
+            gauges = list(self._gauges.items())
+        for prefix, func in sorted(gauges):
+            try:
+                values = func()
+            except Exception as e:
+                logger.error(f"Ошибка чтения метрик {prefix}: {e}")
+                continue
+            for key, value in sorted(values.items()):
+                metric = f"finance_{prefix}_{key}"
+                lines.append(f"# TYPE {metric} gauge")
+                lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Metrics()
+"""
+Общий реестр замеров бота
+
+:type: Metrics
+"""
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize_sql(sql):
+    """Сжимает пробелы и переводы строк в тексте запроса.
+
+    :param sql: Текст запроса
+    :type sql: str
+    :return: Запрос в одну строку
+    :rtype: str
+    """
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+def _escape(value):
+    """Экранирует значение метки Prometheus."""
+    return (
+        value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    )
+
+
+def instrument(family, metrics=None):
+    """Декоратор класса: замеряет все его публичные методы.
+
+    Генераторы не оборачиваются: их тело выполняется уже после возврата
+    из метода.
+
+    :param family: Семейство замеров
+    :type family: str
+    :param metrics: Реестр, по умолчанию registry
+    :type metrics: Metrics или None
+    :return: Декоратор класса
+    :rtype: callable
+    """
+    if metrics is None:
+        metrics = registry
+
+    def decorator(cls):
+        for name, value in list(vars(cls).items()):
+            if (
+                name.startswith("_")
+                or not inspect.isfunction(value)
+                or inspect.isgeneratorfunction(value)
+            ):
+                continue
+            setattr(cls, name, metrics.timed(family, name)(value))
+        return cls
+
+    return decorator
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Курсор SQLite, который замеряет execute() и executemany() в
+    registry.
+
+    Замеряется выполнение запроса до первой строки результата, чтение
+    остальных строк через fetch*() не входит в замер.
+    """
+
+    def execute(self, sql, parameters=()):
+        if not registry.enabled:
+            return super().execute(sql, parameters)
+        started = time.perf_counter()
+        error = True
+        try:
+            result = super().execute(sql, parameters)
+            error = False
+            return result
+        finally:
+            registry.query(sql, time.perf_counter() - started, error)
+
+    def executemany(self, sql, seq_of_parameters):
+        if not registry.enabled:
+            return super().executemany(sql, seq_of_parameters)
+        started = time.perf_counter()
+        error = True
+        try:
+            result = super().executemany(sql, seq_of_parameters)
+            error = False
+            return result
+        finally:
+            registry.query(sql, time.perf_counter() - started, error)
+
+
+class MetricsServer:
+    """HTTP-сервер, отдающий замеры по ``GET /metrics``.
+
+    Работает в фоновом потоке и не мешает bot.polling() в основном.
+    """
+
+    def __init__(self, metrics=None, host="127.0.0.1", port=9108):
+        """
+        :param metrics: Реестр, по умолчанию registry
+        :type metrics: Metrics или None
+        :param host: Адрес сервера
+        :type host: str
+        :param port: Порт сервера, 0 - выбрать свободный
+        :type port: int
+        """
+        self.metrics = registry if metrics is None else metrics
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self._serving = None
+
+    @property
+    def url(self):
+        """Адрес страницы метрик.
+
+        :rtype: str
+        """
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/metrics"
+
+    def _handler_class(self):
+        """Создает класс обработчика HTTP-запросов для этого сервера."""
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = server.metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+                )
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        """Запускает сервер в фоновом потоке.
+
+        :return: Этот же сервер
+        :rtype: MetricsServer
+        """
+        self._serving = threading.Thread(
+            target=self.httpd.serve_forever, name="metrics", daemon=True
+        )
+        self._serving.start()
+        return self
+
+    def stop(self):
+        """Останавливает сервер.
+
+        :return: None
+        :rtype: None
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,424 @@
+"""Версионные миграции схемы базы данных бота.
+
+Текущая версия схемы хранится в ``PRAGMA user_version``. Каждая миграция
+выполняется в своей транзакции вместе с записью нового номера версии,
+поэтому прерванная миграция не оставляет базу в промежуточном состоянии.
+Миграции, которые уже были применены, больше не меняются: изменения схемы
+добавляются только новыми миграциями в конец списка MIGRATIONS.
+"""
+import finance_queries as queries
+
+
+def _base_tables(cursor):
+    """Миграция 1: таблицы пользователей и расходов.
+
+    Таблицы создаются через IF NOT EXISTS, чтобы миграция прошла и на
+    базах, созданных до появления версий схемы.
+    """
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        balance REAL DEFAULT 0)"""
+    )
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS expenses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        category TEXT,
+        amount REAL,
+        date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"""
+    )
+
+
+def _category_totals(cursor):
+    """Миграция 2: готовые суммы по категориям, заполненные по расходам."""
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS category_totals (
+        user_id INTEGER,
+        category TEXT,
+        total REAL DEFAULT 0,
+        count INTEGER DEFAULT 0,
+        PRIMARY KEY (user_id, category))"""
+    )
+    cursor.execute("DELETE FROM category_totals")
+    cursor.execute(
+        """INSERT INTO category_totals (user_id, category, total, count)
+        SELECT user_id, category, SUM(amount), COUNT(*) FROM expenses
+        GROUP BY user_id, category"""
+    )
+
+
+def _expense_indexes(cursor):
+    """Миграция 3: индексы для истории и сумм по категориям."""
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS idx_expenses_user_date
+        ON expenses (user_id, date DESC)"""
+    )
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS idx_expenses_user_category
+        ON expenses (user_id, category, amount)"""
+    )
+
+
+def _history_keyset_index(cursor):
+    """Миграция 4: индекс (user_id, date, id) для постраничной истории.
+
+    Заменяет idx_expenses_user_date: при равных датах порядок задает id,
+    и с ним и первая страница, и переходы по ключу (date, id) в обе
+    стороны читаются из индекса без сортировки.
+    """
+    cursor.execute("DROP INDEX IF EXISTS idx_expenses_user_date")
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS idx_expenses_user_date_id
+        ON expenses (user_id, date, id)"""
+    )
+
+
+def _conversation_state(cursor):
+    """Миграция 5: состояние многошаговых диалогов бота."""
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS conversation_state (
+        user_id INTEGER PRIMARY KEY,
+        state TEXT NOT NULL,
+        updated_at REAL NOT NULL)"""
+    )
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS idx_conversation_state_updated
+        ON conversation_state (updated_at)"""
+    )
+
+
+def _import_checkpoints(cursor):
+    """Миграция 6: места остановки массового импорта расходов."""
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS import_checkpoints (
+        source TEXT PRIMARY KEY,
+        offset INTEGER NOT NULL,
+        line INTEGER NOT NULL,
+        imported INTEGER NOT NULL,
+        rejected INTEGER NOT NULL,
+        done INTEGER NOT NULL DEFAULT 0,
+        updated_at REAL NOT NULL)"""
+    )
+
+
+def _expense_buckets(cursor):
+    """Миграция 7: суммы расходов по дням, неделям и месяцам.
+
+    Неделя начинается с понедельника: ``weekday 0`` переносит дату на
+    ближайшее воскресенье не раньше нее, минус шесть дней дают
+    понедельник той же недели.
+    """
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS expense_buckets (
+        user_id INTEGER NOT NULL,
+        period TEXT NOT NULL,
+        start TEXT NOT NULL,
+        category TEXT NOT NULL,
+        total REAL NOT NULL DEFAULT 0,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, period, start, category)) WITHOUT ROWID"""
+    )
+    _fill_expense_buckets(cursor)
+
+
+def _fill_expense_buckets(cursor, keys="category"):
+    """Заполняет expense_buckets заново по таблице expenses.
+
+    keys - столбцы ключа периода после start, они же столбцы
+    группировки.
+    """
+    cursor.execute("DELETE FROM expense_buckets")
+    for period, start in (
+        ("d", "date(date)"),
+        ("w", "date(date, 'weekday 0', '-6 days')"),
+        ("m", "date(date, 'start of month')"),
+    ):
+        cursor.execute(
+            f"""INSERT INTO expense_buckets
+            (user_id, period, start, {keys}, total, count)
+            SELECT user_id, '{period}', {start}, {keys}, SUM(amount),
+            COUNT(*) FROM expenses WHERE date IS NOT NULL
+            GROUP BY user_id, {start}, {keys}"""
+        )
+
+
+def _integer_money(cursor):
+    """Миграция 8: суммы в целых копейках и начальный баланс.
+
+    SQLite не меняет тип столбца, поэтому таблицы с суммами создаются
+    заново и заполняются копейками, округленными от REAL. Суммы по
+    категориям и периодам пересчитываются по новым расходам точно.
+    initial_balance - баланс до всех записанных расходов, для сверки
+    balance = initial_balance - SUM(expenses.amount).
+    """
+    cursor.execute(
+        """CREATE TABLE users_new (
+        user_id INTEGER PRIMARY KEY,
+        balance INTEGER NOT NULL DEFAULT 0,
+        initial_balance INTEGER NOT NULL DEFAULT 0)"""
+    )
+    cursor.execute(
+        """CREATE TABLE expenses_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        category TEXT,
+        amount INTEGER NOT NULL,
+        date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"""
+    )
+    cursor.execute(
+        """INSERT INTO expenses_new (id, user_id, category, amount, date)
+        SELECT id, user_id, category, CAST(ROUND(amount * 100) AS INTEGER),
+        date FROM expenses"""
+    )
+    cursor.execute(
+        """INSERT INTO users_new (user_id, balance, initial_balance)
+        SELECT user_id, CAST(ROUND(balance * 100) AS INTEGER),
+        CAST(ROUND(balance * 100) AS INTEGER) + COALESCE((
+            SELECT SUM(amount) FROM expenses_new
+            WHERE expenses_new.user_id = users.user_id), 0)
+        FROM users"""
+    )
+    cursor.execute("DROP TABLE users")
+    cursor.execute("DROP TABLE expenses")
+    cursor.execute("ALTER TABLE users_new RENAME TO users")
+    cursor.execute("ALTER TABLE expenses_new RENAME TO expenses")
+    cursor.execute(
+        """CREATE INDEX idx_expenses_user_date_id
+        ON expenses (user_id, date, id)"""
+    )
+    cursor.execute(
+        """CREATE INDEX idx_expenses_user_category
+        ON expenses (user_id, category, amount)"""
+    )
+
+    cursor.execute("DROP TABLE category_totals")
+    cursor.execute(
+        """CREATE TABLE category_totals (
+        user_id INTEGER,
+        category TEXT,
+        total INTEGER NOT NULL DEFAULT 0,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, category))"""
+    )
+    cursor.execute(
+        """INSERT INTO category_totals (user_id, category, total, count)
+        SELECT user_id, category, SUM(amount), COUNT(*) FROM expenses
+        GROUP BY user_id, category"""
+    )
+
+    cursor.execute("DROP TABLE expense_buckets")
+    cursor.execute(
+        """CREATE TABLE expense_buckets (
+        user_id INTEGER NOT NULL,
+        period TEXT NOT NULL,
+        start TEXT NOT NULL,
+        category TEXT NOT NULL,
+        total INTEGER NOT NULL DEFAULT 0,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, period, start, category)) WITHOUT ROWID"""
+    )
+    _fill_expense_buckets(cursor)
+
+
+def _currencies(cursor):
+    """Миграция 9: валюта расходов и таблица курсов.
+
+    Суммы по категориям и периодам теперь ведутся отдельно по каждой
+    валюте и переводятся в базовую валюту пользователя при чтении.
+    charged - сколько копеек базовой валюты списано с баланса по курсу
+    на момент записи, по нему сверяются балансы. Все старые суммы
+    считаются рублевыми.
+    """
+    cursor.execute(
+        """CREATE TABLE exchange_rates (
+        currency TEXT PRIMARY KEY,
+        rate REAL NOT NULL,
+        updated_at REAL NOT NULL) WITHOUT ROWID"""
+    )
+    cursor.execute("INSERT INTO exchange_rates VALUES ('RUB', 1.0, 0)")
+    cursor.execute(
+        "ALTER TABLE users ADD COLUMN currency TEXT NOT NULL DEFAULT 'RUB'"
+    )
+    cursor.execute(
+        """ALTER TABLE expenses
+        ADD COLUMN currency TEXT NOT NULL DEFAULT 'RUB'"""
+    )
+    cursor.execute(
+        "ALTER TABLE expenses ADD COLUMN charged INTEGER NOT NULL DEFAULT 0"
+    )
+    cursor.execute("UPDATE expenses SET charged = amount")
+    cursor.execute("DROP INDEX idx_expenses_user_category")
+    cursor.execute(
+        """CREATE INDEX idx_expenses_user_category
+        ON expenses (user_id, category, currency, amount)"""
+    )
+
+    cursor.execute("DROP TABLE category_totals")
+    cursor.execute(
+        """CREATE TABLE category_totals (
+        user_id INTEGER,
+        category TEXT,
+        currency TEXT NOT NULL DEFAULT 'RUB',
+        total INTEGER NOT NULL DEFAULT 0,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, category, currency))"""
+    )
+    cursor.execute(
+        """INSERT INTO category_totals
+        (user_id, category, currency, total, count)
+        SELECT user_id, category, currency, SUM(amount), COUNT(*)
+        FROM expenses GROUP BY user_id, category, currency"""
+    )
+
+    cursor.execute("DROP TABLE expense_buckets")
+    cursor.execute(
+        """CREATE TABLE expense_buckets (
+        user_id INTEGER NOT NULL,
+        period TEXT NOT NULL,
+        start TEXT NOT NULL,
+        category TEXT NOT NULL,
+        currency TEXT NOT NULL DEFAULT 'RUB',
+        total INTEGER NOT NULL DEFAULT 0,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, period, start, category, currency))
+        WITHOUT ROWID"""
+    )
+    _fill_expense_buckets(cursor, "category, currency")
+
+
+def _budgets(cursor):
+    """Миграция 10: месячные бюджеты по категориям.
+
+    amount - лимит, spent - сколько списано в категории за месяц month,
+    оба в копейках базовой валюты. spent увеличивается при каждой трате,
+    а в новом месяце обнуляется той же трате, которая в нем первая, так
+    что проверка лимита не суммирует расходы. alerted - последний порог
+    в процентах, о котором пользователь уже предупрежден в этом месяце.
+    """
+    cursor.execute(
+        """CREATE TABLE budgets (
+        user_id INTEGER NOT NULL,
+        category TEXT NOT NULL,
+        amount INTEGER NOT NULL,
+        month TEXT NOT NULL,
+        spent INTEGER NOT NULL DEFAULT 0,
+        alerted INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, category)) WITHOUT ROWID"""
+    )
+
+
+MIGRATIONS = [
+    (1, "таблицы users и expenses", _base_tables),
+    (2, "таблица category_totals", _category_totals),
+    (3, "индексы таблицы expenses", _expense_indexes),
+    (4, "индекс постраничной истории", _history_keyset_index),
+    (5, "таблица conversation_state", _conversation_state),
+    (6, "таблица import_checkpoints", _import_checkpoints),
+    (7, "таблица expense_buckets", _expense_buckets),
+    (8, "суммы в копейках", _integer_money),
+    (9, "валюты и курсы", _currencies),
+    (10, "таблица budgets", _budgets),
+]
+"""
+Список миграций в порядке применения: кортежи (версия, описание,
+функция). Функция получает курсор внутри открытой транзакции.
+
+:type: list[tuple[int, str, callable]]
+"""
+
+HOT_QUERIES = [
+    ("get_history", queries.HISTORY_LATEST, (1.0, 0, 5),
+     "idx_expenses_user_date_id"),
+    ("get_history_page", queries.HISTORY_FIRST, (1.0, 0, 6),
+     "idx_expenses_user_date_id"),
+    ("get_history_page_before", queries.HISTORY_BEFORE,
+     (1.0, 0, "", 0, 6), "idx_expenses_user_date_id"),
+    ("iter_expenses", queries.HISTORY_OLDEST, (1.0, 0, 1000),
+     "idx_expenses_user_date_id"),
+    ("iter_expenses_after", queries.HISTORY_AFTER, (1.0, 0, "", 0, 1000),
+     "idx_expenses_user_date_id"),
+    ("get_stats", queries.STATS, (1.0, 0),
+     "sqlite_autoindex_category_totals_1"),
+    ("compare_months", queries.MONTHS_COMPARE,
+     (0, "2024-01-01", "2024-02-01"), "PRIMARY KEY"),
+    ("monthly_totals", queries.MONTHS_RANGE,
+     (0, "2024-01-01", "2024-06-01"), "PRIMARY KEY"),
+    ("rolling_average", queries.BUCKETS_RANGE,
+     (0, "d", "2024-01-01", "2024-01-07"), "PRIMARY KEY"),
+    ("rebuild_category_totals", queries.TOTALS_REBUILD, (0,),
+     "idx_expenses_user_category"),
+    (
+        "charge_budget",
+        queries.BUDGET_UPDATE,
+        {"month": "2024-01-01", "charged": 0, "user_id": 0, "category": ""},
+        "PRIMARY KEY",
+    ),
+    ("set_budget", queries.BUDGET_SPENT, (0, "", "2024-01-01"),
+     "idx_expenses_user_date_id"),
+]
+"""
+Горячие запросы бота и индексы, которые они обязаны использовать:
+кортежи (название, SQL из finance_queries, параметры, имя индекса).
+
+:type: list[tuple[str, str, tuple или dict, str]]
+"""
+
+
+def schema_version(cursor):
+    """Возвращает текущую версию схемы базы.
+
+    :param cursor: Курсор базы данных
+    :type cursor: sqlite3.Cursor
+    :return: Значение PRAGMA user_version
+    :rtype: int
+    """
+    cursor.execute("PRAGMA user_version")
+    return cursor.fetchone()[0]
+
+
+def migrate(pool):
+    """Применяет к базе все миграции новее её текущей версии.
+
+    :param pool: Пул соединений базы данных
+    :type pool: finance_pool.ConnectionPool
+    :return: Список номеров примененных миграций
+    :rtype: list[int]
+    :raises sqlite3.Error: Если миграция завершилась ошибкой, версия
+        базы при этом остается прежней
+    """
+    applied = []
+    for version, _, apply in MIGRATIONS:
+        with pool.writer() as cursor:
+            if schema_version(cursor) >= version:
+                continue
+            apply(cursor)
+            cursor.execute(f"PRAGMA user_version = {int(version)}")
+        applied.append(version)
+    return applied
+
+
+def check_query_plans(cursor):
+    """Проверяет через EXPLAIN QUERY PLAN, что горячие запросы идут по
+    индексам, без полного просмотра таблицы и без сортировки во временном
+    B-дереве.
+
+    :param cursor: Курсор базы данных
+    :type cursor: sqlite3.Cursor
+    :return: Словарь: название запроса - строки его плана
+    :rtype: dict[str, list[str]]
+    :raises AssertionError: Если какой-то запрос не использует свой индекс
+    """
+    plans = {}
+    for name, sql, params, index in HOT_QUERIES:
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        details = [row[-1] for row in cursor.fetchall()]
+        plans[name] = details
+        if not any(index in detail for detail in details):
+            raise AssertionError(f"{name} не использует {index}: {details}")
+        if any(
+            detail.startswith("SCAN") or "TEMP B-TREE" in detail
+            for detail in details
+        ):
+            raise AssertionError(f"{name} просматривает таблицу: {details}")
+    return plans
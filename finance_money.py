@@ -0,0 +1,93 @@
+"""Денежные суммы в копейках.
+
+В базе суммы хранятся целыми числами копеек: сложение и вычитание в
+SQLite тогда точные, а SUM по INTEGER не накапливает ошибку округления.
+Снаружи FinanceDB суммы - это Decimal с двумя знаками после точки.
+"""
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+CENT = Decimal("0.01")
+"""
+Одна копейка
+
+:type: decimal.Decimal
+"""
+
+MAX_KOPECKS = 2 ** 63 - 1
+"""
+Наибольшая сумма в копейках, которая помещается в INTEGER SQLite
+
+:type: int
+"""
+
+
+def to_kopecks(value):
+    """Переводит сумму в целое число копеек.
+
+    Дробные копейки округляются до ближайшей, половина - от нуля.
+    float переводится через свое строковое представление, поэтому 0.1
+    дает 10 копеек, а не 9.
+
+    :param value: Сумма
+    :type value: decimal.Decimal, int, float или str
+    :return: Сумма в копейках
+    :rtype: int
+    :raises ValueError: Если значение не является конечным числом или
+        по модулю больше MAX_KOPECKS копеек
+    """
+    if isinstance(value, float):
+        value = repr(value)
+    try:
+        amount = Decimal(value)
+        if not amount.is_finite():
+            raise ValueError(f"Некорректная сумма: {value!r}")
+        kopecks = int(amount.quantize(CENT, rounding=ROUND_HALF_UP).scaleb(2))
+    except (InvalidOperation, TypeError):
+        raise ValueError(f"Некорректная сумма: {value!r}")
+    if abs(kopecks) > MAX_KOPECKS:
+        raise ValueError(f"Слишком большая сумма: {value!r}")
+    return kopecks
+
+
+def from_kopecks(kopecks):
+    """Переводит копейки из базы в Decimal.
+
+    :param kopecks: Сумма в копейках или None
+    :type kopecks: int или None
+    :return: Сумма с двумя знаками после точки или None
+    :rtype: decimal.Decimal или None
+    """
+    if kopecks is None:
+        return None
+    return Decimal(kopecks).scaleb(-2)
+
+
+def parse_money(text):
+    """Разбирает сумму, введенную пользователем.
+
+    Допускаются пробелы между разрядами и запятая вместо точки, но не
+    больше двух знаков после нее.
+
+    :param text: Текст сообщения
+    :type text: str
+    :return: Сумма с двумя знаками после точки
+    :rtype: decimal.Decimal
+    :raises ValueError: Если текст не является суммой или сумма больше
+        MAX_KOPECKS копеек
+    """
+    cleaned = text.strip().replace(" ", "").replace(",", ".")
+    try:
+        amount = Decimal(cleaned)
+    except InvalidOperation:
+        amount = None
+    if amount is None or not amount.is_finite():
+        raise ValueError("Введите число, например 1500 или 99.90")
+    if amount.as_tuple().exponent < -2:
+        raise ValueError("Введите сумму с точностью до копеек")
+    try:
+        amount = amount.quantize(CENT)
+    except InvalidOperation:
+        amount = None
+    if amount is None or abs(amount.scaleb(2)) > MAX_KOPECKS:
+        raise ValueError("Слишком большая сумма")
+    return amount
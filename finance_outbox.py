@@ -0,0 +1,500 @@
+"""Очередь исходящих сообщений бота с учетом ограничений Telegram.
+
+Telegram допускает около 30 сообщений в секунду от бота в целом и
+примерно одно сообщение в секунду в один чат, а при превышении отвечает
+429 Too Many Requests с полем ``retry_after``. Обработчики не отправляют
+сообщения сами, а ставят их в Outbox и сразу возвращаются. Диспетчер
+выбирает чаты по приоритету, соблюдает общий и початовый token bucket,
+откладывает чат на ``retry_after`` после 429 и склеивает несколько
+ожидающих сообщений в один чат в одно.
+
+Остальные запросы к Telegram, относящиеся к чату (картинки, документы,
+правка сообщений, ответы на нажатия кнопок), ставятся в ту же очередь
+через call() и подчиняются тем же лимитам и порядку.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telebot.apihelper import ApiTelegramException
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 0
+"""
+Приоритет ответов, которые пользователь ждет прямо сейчас
+
+:type: int
+"""
+
+PRIORITY_NORMAL = 1
+"""
+Приоритет по умолчанию
+
+:type: int
+"""
+
+PRIORITY_LOW = 2
+"""
+Приоритет фоновых и массовых рассылок
+
+:type: int
+"""
+
+MAX_MESSAGE_LENGTH = 4096
+"""
+Максимальная длина текста сообщения Telegram, длиннее сообщения не
+склеиваются
+
+:type: int
+"""
+
+
+class TokenBucket:
+    """Ограничитель частоты: ``rate`` токенов в секунду, не больше
+    ``capacity`` накопленных.
+
+    Методы вызываются под блокировкой владельца.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity, now):
+        """
+        :param rate: Скорость пополнения в токенах в секунду
+        :type rate: float
+        :param capacity: Максимум накопленных токенов
+        :type capacity: float
+        :param now: Текущее время
+        :type now: float
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+
+    def delay(self, now):
+        """Через сколько секунд будет доступен токен.
+
+        :param now: Текущее время
+        :type now: float
+        :return: 0, если токен есть сейчас
+        :rtype: float
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        """Забирает токен, если он есть.
+
+        :param now: Текущее время
+        :type now: float
+        :return: 0, если токен забран, иначе через сколько секунд он
+            появится
+        :rtype: float
+        """
+        wait = self.delay(now)
+        if not wait:
+            self.tokens -= 1
+        return wait
+
+    def full(self, now):
+        """Проверяет, что bucket полон и его можно забыть.
+
+        :param now: Текущее время
+        :type now: float
+        :rtype: bool
+        """
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _OutMessage:
+    """Сообщение или другой запрос в очереди Outbox.
+
+    У сообщения method равен None, у запроса call() - имя метода бота,
+    а text равен None.
+    """
+
+    __slots__ = (
+        "text", "kwargs", "priority", "method", "args", "future", "attempts"
+    )
+
+    def __init__(self, text, kwargs, priority, method=None, args=()):
+        self.text = text
+        self.kwargs = kwargs
+        self.priority = priority
+        self.method = method
+        self.args = args
+        self.future = Future()
+        self.attempts = 0
+
+
+class Outbox:
+    """Диспетчер исходящих сообщений.
+
+    Сообщения и запросы call() одного чата отправляются строго по
+    порядку, и в каждый момент в полете не больше одного запроса в чат.
+    Ожидающие сообщения в чат склеиваются через пустую строку, если у них
+    одинаковые параметры (например, одна и та же клавиатура) и общий
+    текст не длиннее MAX_MESSAGE_LENGTH. Место чата в очереди определяет
+    приоритет его первого ожидающего сообщения.
+
+    Потоки запускаются при первой отправке.
+
+    :ivar bot: Бот, через которого отправляются сообщения. Если его
+        методы возвращают Future (AsyncBotBridge), Outbox ждет результат
+    :vartype bot: telebot.TeleBot или finance_async.AsyncBotBridge
+
+    :ivar metrics: Счетчики: queued, requests, delivered, coalesced,
+        retries, errors
+    :vartype metrics: dict[str, int]
+    """
+
+    def __init__(
+        self,
+        bot,
+        global_rate=30.0,
+        chat_rate=1.0,
+        chat_burst=3,
+        workers=8,
+        max_retries=5,
+        clock=time.monotonic,
+    ):
+        """
+        :param bot: Бот для отправки
+        :type bot: telebot.TeleBot
+        :param global_rate: Общий лимит запросов в секунду
+        :type global_rate: float
+        :param chat_rate: Лимит запросов в секунду в один чат
+        :type chat_rate: float
+        :param chat_burst: Сколько запросов в чат можно сделать подряд
+        :type chat_burst: int
+        :param workers: Количество потоков, выполняющих запросы
+        :type workers: int
+        :param max_retries: Сколько раз повторять сообщение после 429
+        :type max_retries: int
+        :param clock: Источник времени
+        :type clock: callable
+        """
+        self.bot = bot
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.max_retries = max_retries
+        self.metrics = dict.fromkeys(
+            [
+                "queued",
+                "requests",
+                "delivered",
+                "coalesced",
+                "retries",
+                "errors",
+            ],
+            0,
+        )
+        self._clock = clock
+        self._global = TokenBucket(global_rate, global_rate, clock())
+        self._buckets = {}
+        self._pending = {}
+        self._depth = 0
+        self._ready = []
+        self._delayed = []
+        self._scheduled = set()
+        self._inflight = set()
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._executor = None
+        self._closed = False
+
+    def send(self, chat_id, text, priority=PRIORITY_NORMAL, **kwargs):
+        """Ставит сообщение в очередь и сразу возвращается.
+
+        :param chat_id: Чат получателя
+        :type chat_id: int
+        :param text: Текст сообщения
+        :type text: str
+        :param priority: PRIORITY_HIGH, PRIORITY_NORMAL или PRIORITY_LOW
+        :type priority: int
+        :param kwargs: Остальные параметры send_message, например
+            reply_markup
+        :return: Future с отправленным сообщением
+        :rtype: concurrent.futures.Future
+        :raises RuntimeError: Если Outbox уже закрыт
+        """
+        return self._put(chat_id, _OutMessage(text, kwargs, priority))
+
+    def call(self, chat_id, method, *args, priority=PRIORITY_NORMAL,
+             **kwargs):
+        """Ставит в очередь чата вызов произвольного метода бота.
+
+        Вызов выполняется после всех сообщений и вызовов, поставленных в
+        этот чат раньше, с общим и початовым лимитом и повтором после
+        429, но ни с чем не склеивается. Файлы среди аргументов
+        перематываются в начало перед каждой попыткой.
+
+        :param chat_id: Чат, в очередь которого поставить вызов
+        :type chat_id: int
+        :param method: Имя метода бота, например "send_photo"
+        :type method: str
+        :param args: Позиционные аргументы метода
+        :param priority: PRIORITY_HIGH, PRIORITY_NORMAL или PRIORITY_LOW
+        :type priority: int
+        :param kwargs: Именованные аргументы метода
+        :return: Future с результатом метода
+        :rtype: concurrent.futures.Future
+        :raises RuntimeError: Если Outbox уже закрыт
+        """
+        return self._put(
+            chat_id, _OutMessage(None, kwargs, priority, method, args)
+        )
+
+    def _put(self, chat_id, message):
+        """Добавляет сообщение в очередь чата и будит диспетчер."""
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Outbox закрыт")
+            if self._thread is None:
+                self._start()
+            self._pending.setdefault(chat_id, deque()).append(message)
+            self._depth += 1
+            self.metrics["queued"] += 1
+            if chat_id not in self._scheduled and (
+                chat_id not in self._inflight
+            ):
+                self._schedule(chat_id, message.priority)
+            self._cond.notify()
+        return message.future
+
+    def snapshot(self):
+        """Возвращает копию счетчиков и количество ожидающих сообщений.
+
+        :return: Счетчики и depth - сообщения, еще не отправленные
+        :rtype: dict[str, int]
+        """
+        with self._cond:
+            result = dict(self.metrics)
+            result["depth"] = self._depth
+        return result
+
+    def flush(self, timeout=None):
+        """Ждет, пока все поставленные сообщения будут отправлены.
+
+        :param timeout: Максимальное время ожидания в секундах
+        :type timeout: float или None
+        :return: True, если очередь опустела
+        :rtype: bool
+        """
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._pending and not self._inflight, timeout
+            )
+
+    def close(self, timeout=None):
+        """Отправляет оставшиеся сообщения и останавливает потоки.
+
+        Если за timeout отправить все не удалось, диспетчер продолжает
+        работу в фоне и сам останавливает пул, когда очередь опустеет.
+
+        :param timeout: Максимальное время ожидания отправки
+        :type timeout: float или None
+        :return: None
+        :rtype: None
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is None:
+            return
+        thread.join(timeout)
+        if thread.is_alive():
+            logger.warning(
+                f"Outbox не отправил все сообщения за {timeout} с"
+            )
+            return
+        self._executor.shutdown(wait=True)
+
+    def _start(self):
+        """Запускает диспетчер и пул отправки. Вызывается под блокировкой."""
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="outbox"
+        )
+        self._thread = threading.Thread(
+            target=self._dispatch, name="outbox-dispatch", daemon=True
+        )
+        self._thread.start()
+
+    def _schedule(self, chat_id, priority, when=None):
+        """Ставит чат в очередь готовых или отложенных. Вызывается под
+        блокировкой.
+        """
+        self._scheduled.add(chat_id)
+        if when is None:
+            heapq.heappush(self._ready, (priority, next(self._seq), chat_id))
+        else:
+            heapq.heappush(
+                self._delayed, (when, next(self._seq), priority, chat_id)
+            )
+
+    def _dispatch(self):
+        """Цикл диспетчера: выбирает чаты и передает их сообщения в пул."""
+        with self._cond:
+            while True:
+                now = self._clock()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, seq, priority, chat_id = heapq.heappop(self._delayed)
+                    heapq.heappush(self._ready, (priority, seq, chat_id))
+                if not self._ready:
+                    if self._closed and not self._pending and (
+                        not self._inflight
+                    ):
+                        self._executor.shutdown(wait=False)
+                        return
+                    if not self._delayed:
+                        self._prune(now)
+                    timeout = (
+                        self._delayed[0][0] - now if self._delayed else None
+                    )
+                    self._cond.wait(timeout)
+                    continue
+                wait = self._global.delay(now)
+                if wait:
+                    self._cond.wait(wait)
+                    continue
+                priority, seq, chat_id = heapq.heappop(self._ready)
+                bucket = self._buckets.get(chat_id)
+                if bucket is None:
+                    bucket = TokenBucket(self.chat_rate, self.chat_burst, now)
+                    self._buckets[chat_id] = bucket
+                wait = bucket.take(now)
+                if wait:
+                    heapq.heappush(
+                        self._delayed, (now + wait, seq, priority, chat_id)
+                    )
+                    continue
+                self._global.take(now)
+                batch = self._take_batch(chat_id)
+                self._scheduled.discard(chat_id)
+                self._inflight.add(chat_id)
+                self.metrics["requests"] += 1
+                self._executor.submit(self._deliver, chat_id, batch)
+
+    def _prune(self, now):
+        """Забывает полные bucket'ы чатов без сообщений. Вызывается под
+        блокировкой.
+        """
+        for chat_id in [
+            chat_id
+            for chat_id, bucket in self._buckets.items()
+            if chat_id not in self._inflight and bucket.full(now)
+        ]:
+            del self._buckets[chat_id]
+
+    def _take_batch(self, chat_id):
+        """Забирает первое сообщение чата и все, что можно к нему
+        приклеить. Вызывается под блокировкой.
+        """
+        pending = self._pending[chat_id]
+        first = pending.popleft()
+        batch = [first]
+        length = len(first.text) if first.method is None else 0
+        while first.method is None and pending:
+            candidate = pending[0]
+            if candidate.method is not None:
+                break
+            length += 2 + len(candidate.text)
+            if candidate.kwargs != first.kwargs or (
+                length > MAX_MESSAGE_LENGTH
+            ):
+                break
+            batch.append(pending.popleft())
+        if not pending:
+            del self._pending[chat_id]
+        self._depth -= len(batch)
+        self.metrics["coalesced"] += len(batch) - 1
+        return batch
+
+    def _request(self, chat_id, batch):
+        """Выполняет запрос к Telegram для склеенных сообщений или вызова
+        call().
+        """
+        first = batch[0]
+        if first.method is None:
+            text = "\n\n".join(message.text for message in batch)
+            return self.bot.send_message(chat_id, text, **first.kwargs)
+        for value in itertools.chain(first.args, first.kwargs.values()):
+            if hasattr(value, "seek"):
+                value.seek(0)
+        return getattr(self.bot, first.method)(*first.args, **first.kwargs)
+
+    def _deliver(self, chat_id, batch):
+        """Отправляет склеенные сообщения в потоке пула."""
+        try:
+            result = self._request(chat_id, batch)
+            if isinstance(result, Future):
+                result = result.result()
+        except ApiTelegramException as e:
+            batch[0].attempts += 1
+            if e.error_code == 429 and batch[0].attempts <= self.max_retries:
+                parameters = e.result_json.get("parameters") or {}
+                self._retry(chat_id, batch, parameters.get("retry_after", 1))
+                return
+            self._finish(chat_id, batch, error=e)
+        except Exception as e:
+            self._finish(chat_id, batch, error=e)
+        else:
+            self._finish(chat_id, batch, result=result)
+
+    def _retry(self, chat_id, batch, retry_after):
+        """Возвращает сообщения в начало очереди чата после 429."""
+        logger.warning(f"429 для чата {chat_id}, повтор через {retry_after}")
+        with self._cond:
+            self._pending.setdefault(chat_id, deque()).extendleft(
+                reversed(batch)
+            )
+            self._depth += len(batch)
+            self.metrics["retries"] += 1
+            self.metrics["coalesced"] -= len(batch) - 1
+            self._inflight.discard(chat_id)
+            self._schedule(
+                chat_id, batch[0].priority, self._clock() + retry_after
+            )
+            self._cond.notify_all()
+
+    def _finish(self, chat_id, batch, result=None, error=None):
+        """Завершает Future сообщений и ставит чат в очередь снова, если
+        у него есть еще сообщения.
+        """
+        if error is not None:
+            logger.error(f"Ошибка отправки в чат {chat_id}: {error}")
+        for message in batch:
+            if error is None:
+                message.future.set_result(result)
+            else:
+                message.future.set_exception(error)
+        with self._cond:
+            if error is None:
+                self.metrics["delivered"] += len(batch)
+            else:
+                self.metrics["errors"] += len(batch)
+            self._inflight.discard(chat_id)
+            pending = self._pending.get(chat_id)
+            if pending:
+                self._schedule(chat_id, pending[0].priority)
+            self._cond.notify_all()
@@ -0,0 +1,271 @@
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+
+class ConnectionPool:
+    """Пул соединений SQLite для FinanceDB.
+
+    Для файловой базы включает режим WAL, держит фиксированное число
+    соединений для чтения и одно соединение для записи. Читатели работают
+    параллельно, записи выстраиваются в очередь на блокировке писателя
+    и выполняются в транзакции ``BEGIN IMMEDIATE``.
+
+    База ``:memory:`` существует только внутри одного соединения,
+    поэтому для неё чтение и запись идут через соединение писателя.
+
+    :ivar db_name: Имя файла базы данных
+    :vartype db_name: str
+
+    :ivar writer_conn: Единственное соединение для записи
+    :vartype writer_conn: sqlite3.Connection
+    """
+
+    def __init__(self, db_name, readers=4, timeout=30.0, cursor_factory=None):
+        """
+        Открывает соединение писателя и соединения читателей
+
+        :param db_name: Имя файла базы данных
+        :type db_name: str
+        :param readers: Количество соединений для чтения
+        :type readers: int
+        :param timeout: Сколько секунд ждать снятия блокировки базы
+        :type timeout: float
+        :param cursor_factory: Класс курсоров, которые выдают reader() и
+            writer(), по умолчанию sqlite3.Cursor
+        :type cursor_factory: type или None
+
+        :raises sqlite3.Error: Если не удалось подключиться к базе данных
+        """
+        self.db_name = db_name
+        self.timeout = timeout
+        self.cursor_factory = cursor_factory or sqlite3.Cursor
+        self.in_memory = db_name == ":memory:" or "mode=memory" in db_name
+        self._write_lock = threading.RLock()
+        self._readers = queue.Queue()
+        self._all = []
+
+        self.writer_conn = self._connect()
+        if not self.in_memory:
+            self.writer_conn.execute("PRAGMA journal_mode=WAL")
+            self.writer_conn.execute("PRAGMA synchronous=NORMAL")
+            for _ in range(readers):
+                self._readers.put(self._connect())
+
+    def _connect(self):
+        """Открывает новое соединение в режиме автокоммита.
+
+        Транзакциями управляет сам пул, поэтому ``isolation_level``
+        отключен.
+
+        :return: Новое соединение
+        :rtype: sqlite3.Connection
+        """
+        conn = sqlite3.connect(
+            self.db_name,
+            check_same_thread=False,
+            timeout=self.timeout,
+            isolation_level=None,
+            uri=self.db_name.startswith("file:"),
+        )
+        self._all.append(conn)
+        return conn
+
+    @contextmanager
+    def reader(self):
+        """Выдает курсор для чтения на время одного вызова.
+
+        Если все читатели заняты, поток ждет освобождения соединения.
+
+        :return: Курсор, закрываемый при выходе из блока with
+        :rtype: sqlite3.Cursor
+        """
+        if self.in_memory:
+            with self._write_lock:
+                cursor = self.writer_conn.cursor(self.cursor_factory)
+                try:
+                    yield cursor
+                finally:
+                    cursor.close()
+            return
+
+        conn = self._readers.get()
+        cursor = conn.cursor(self.cursor_factory)
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+            self._readers.put(conn)
+
+    @contextmanager
+    def writer(self):
+        """Выдает курсор писателя внутри транзакции BEGIN IMMEDIATE.
+
+        При нормальном выходе из блока транзакция фиксируется, при
+        исключении в блоке или при фиксации откатывается, а исключение
+        пробрасывается дальше.
+
+        :return: Курсор соединения писателя
+        :rtype: sqlite3.Cursor
+        """
+        with self._write_lock:
+            cursor = self.writer_conn.cursor(self.cursor_factory)
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield cursor
+                self.writer_conn.commit()
+            except BaseException:
+                # Сюда же попадает ошибка самого COMMIT, например
+                # SQLITE_BUSY: без отката следующий BEGIN не пройдет
+                if self.writer_conn.in_transaction:
+                    self.writer_conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def close(self):
+        """Закрывает все соединения пула.
+
+        :return: None
+        :rtype: None
+        """
+        with self._write_lock:
+            for conn in self._all:
+                conn.close()
+            self._all.clear()
+
+
+_STOP = object()
+
+
+class GroupCommitWriter:
+    """Фоновый писатель с групповой фиксацией транзакций.
+
+    Операции записи складываются в очередь, фоновый поток забирает их
+    пачками (не больше ``max_batch`` операций или за ``max_delay``
+    секунд) и выполняет одной транзакцией, то есть одним fsync на всю
+    пачку. Каждая операция выполняется внутри своей точки сохранения,
+    поэтому ошибка одной операции откатывает только её, а остальные
+    операции пачки фиксируются.
+
+    Вызывающий получает concurrent.futures.Future с результатом своей
+    операции или с её исключением.
+
+    :ivar batches: Сколько транзакций зафиксировано
+    :vartype batches: int
+
+    :ivar operations: Сколько операций выполнено
+    :vartype operations: int
+    """
+
+    def __init__(self, pool, max_batch=64, max_delay=0.005):
+        """
+        Запускает фоновый поток писателя
+
+        :param pool: Пул соединений, через писателя которого идут записи
+        :type pool: ConnectionPool
+        :param max_batch: Максимум операций в одной транзакции
+        :type max_batch: int
+        :param max_delay: Сколько секунд ждать добора пачки
+        :type max_delay: float
+        """
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.batches = 0
+        self.operations = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name="group-commit", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, op, *args):
+        """Ставит операцию записи в очередь.
+
+        :param op: Функция вида ``op(cursor, *args)``, выполняющая запись
+            без фиксации транзакции
+        :type op: callable
+        :param args: Аргументы операции
+        :return: Future с результатом операции
+        :rtype: concurrent.futures.Future
+        """
+        future = Future()
+        self._queue.put((op, args, future))
+        return future
+
+    def _run(self):
+        """Основной цикл фонового потока: набирает пачки и фиксирует их.
+
+        :return: None
+        :rtype: None
+        """
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+
+    def _commit(self, batch):
+        """Выполняет пачку операций в одной транзакции.
+
+        :param batch: Список кортежей (операция, аргументы, future)
+        :type batch: list[tuple]
+        :return: None
+        :rtype: None
+        """
+        done = []
+        try:
+            with self.pool.writer() as cursor:
+                for op, args, future in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    cursor.execute("SAVEPOINT op")
+                    try:
+                        result = op(cursor, *args)
+                    except Exception as e:
+                        cursor.execute("ROLLBACK TO op")
+                        cursor.execute("RELEASE op")
+                        future.set_exception(e)
+                    else:
+                        cursor.execute("RELEASE op")
+                        done.append((future, result))
+        except Exception as e:
+            for future, _ in done:
+                future.set_exception(e)
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.operations += len(done)
+        for future, result in done:
+            future.set_result(result)
+
+    def close(self):
+        """Дожидается записи всех операций из очереди и останавливает поток.
+
+        :return: None
+        :rtype: None
+        """
+        self._queue.put(_STOP)
+        self._thread.join()
@@ -0,0 +1,136 @@
+"""SQL горячих запросов бота.
+
+Каждая строка определена здесь один раз: её выполняют FinanceDB и
+finance_analytics, а finance_migrations.HOT_QUERIES проверяет планы
+именно этих строк. Поэтому проверка индексов не может разойтись с тем,
+что бот на самом деле выполняет.
+
+Суммы в запросах истории и статистики переводятся в базовую валюту
+пользователя соединением с exchange_rates, первым параметром идет курс
+базовой валюты.
+"""
+
+HISTORY_SELECT = """SELECT e.id, e.category,
+CAST(ROUND(e.amount * r.rate / ?) AS INTEGER), e.date
+FROM expenses e JOIN exchange_rates r USING (currency)"""
+"""
+Начало запросов страниц истории
+
+:type: str
+"""
+
+HISTORY_LATEST = """SELECT e.category,
+CAST(ROUND(e.amount * r.rate / ?) AS INTEGER), e.date
+FROM expenses e JOIN exchange_rates r USING (currency)
+WHERE e.user_id=? ORDER BY e.date DESC, e.id DESC LIMIT ?"""
+"""
+Последние расходы для get_history(): курс, user_id, limit
+
+:type: str
+"""
+
+HISTORY_FIRST = HISTORY_SELECT + """
+WHERE e.user_id=? ORDER BY e.date DESC, e.id DESC LIMIT ?"""
+"""
+Первая страница истории, от новых к старым: курс, user_id, limit
+
+:type: str
+"""
+
+HISTORY_BEFORE = HISTORY_SELECT + """
+WHERE e.user_id=? AND (e.date, e.id) < (?, ?)
+ORDER BY e.date DESC, e.id DESC LIMIT ?"""
+"""
+Страница истории старше ключа (date, id): курс, user_id, date, id,
+limit
+
+:type: str
+"""
+
+HISTORY_OLDEST = HISTORY_SELECT + """
+WHERE e.user_id=? ORDER BY e.date, e.id LIMIT ?"""
+"""
+Первый кусок перебора расходов от старых к новым: курс, user_id, limit
+
+:type: str
+"""
+
+HISTORY_AFTER = HISTORY_SELECT + """
+WHERE e.user_id=? AND (e.date, e.id) > (?, ?)
+ORDER BY e.date, e.id LIMIT ?"""
+"""
+Расходы новее ключа (date, id) от старых к новым: курс, user_id, date,
+id, limit
+
+:type: str
+"""
+
+STATS = """SELECT t.category,
+CAST(ROUND(SUM(t.total * r.rate) / ?) AS INTEGER)
+FROM category_totals t JOIN exchange_rates r USING (currency)
+WHERE t.user_id=? GROUP BY t.category ORDER BY t.category"""
+"""
+Суммы по категориям для get_stats(): курс, user_id
+
+:type: str
+"""
+
+TOTALS_REBUILD = """INSERT INTO category_totals
+(user_id, category, currency, total, count)
+SELECT user_id, category, currency, SUM(amount), COUNT(*)
+FROM expenses WHERE user_id=? GROUP BY user_id, category, currency"""
+"""
+Пересчет category_totals одного пользователя: user_id
+
+:type: str
+"""
+
+MONTHS_COMPARE = """SELECT b.start, b.category, b.total * r.rate
+FROM expense_buckets b JOIN exchange_rates r USING (currency)
+WHERE b.user_id=? AND b.period='m' AND b.start IN (?, ?)"""
+"""
+Месячные корзины двух месяцев по категориям: user_id, начала месяцев
+
+:type: str
+"""
+
+MONTHS_RANGE = """SELECT b.start, b.total * r.rate
+FROM expense_buckets b JOIN exchange_rates r USING (currency)
+WHERE b.user_id=? AND b.period='m' AND b.start BETWEEN ? AND ?"""
+"""
+Месячные корзины за диапазон месяцев: user_id, первый и последний месяц
+
+:type: str
+"""
+
+BUCKETS_RANGE = """SELECT b.category, b.total * r.rate
+FROM expense_buckets b JOIN exchange_rates r USING (currency)
+WHERE b.user_id=? AND b.period=? AND b.start BETWEEN ? AND ?"""
+"""
+Корзины периода за диапазон по категориям: user_id, период, первое и
+последнее начало периода
+
+:type: str
+"""
+
+BUDGET_UPDATE = """UPDATE budgets SET
+spent = CASE WHEN month = :month THEN spent ELSE 0 END + :charged,
+alerted = CASE WHEN month = :month THEN alerted ELSE 0 END,
+month = :month
+WHERE user_id = :user_id AND category = :category"""
+"""
+Добавление траты к бюджету категории. Если бюджет еще считается за
+прошлый месяц, spent и alerted сначала обнуляются, так что месяц
+сменяется у каждого бюджета его первой тратой, без общего сброса
+
+:type: str
+"""
+
+BUDGET_SPENT = """SELECT COALESCE(SUM(charged), 0) FROM expenses
+WHERE user_id=? AND category=? AND date >= ?"""
+"""
+Сколько списано в категории с начала месяца, считается один раз при
+установке бюджета: user_id, категория, начало месяца
+
+:type: str
+"""
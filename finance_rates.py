@@ -0,0 +1,110 @@
+"""Валюты расходов и курсы обмена.
+
+Каждый расход хранится в своей валюте, а суммы в базовой валюте
+пользователя считаются при чтении: запросы FinanceDB соединяют суммы с
+таблицей exchange_rates и переводят их одним SQL-запросом. Курсы
+загружаются из локального файла JSON вида::
+
+    {"base": "RUB", "rates": {"USD": 92.5, "EUR": 100.1}}
+
+где rates - сколько единиц базовой валюты файла стоит единица валюты.
+"""
+import json
+import math
+
+DEFAULT_CURRENCY = "RUB"
+"""
+Валюта пользователей и расходов, для которых она не указана
+
+:type: str
+"""
+
+RATES_FILE = "rates.json"
+"""
+Файл курсов, который бот загружает при запуске
+
+:type: str
+"""
+
+SYMBOLS = {"₽": "RUB", "$": "USD", "€": "EUR"}
+"""
+Знаки валют, которые можно написать после суммы вместо кода
+
+:type: dict[str, str]
+"""
+
+
+def normalize_currency(code):
+    """Приводит код валюты к виду ISO 4217.
+
+    :param code: Код валюты в любом регистре или знак из SYMBOLS
+    :type code: str
+    :return: Код из трех заглавных латинских букв
+    :rtype: str
+    :raises ValueError: Если это не код валюты
+    """
+    code = str(code).strip()
+    code = SYMBOLS.get(code, code).upper()
+    if len(code) != 3 or not (code.isascii() and code.isalpha()):
+        raise ValueError(f"Некорректный код валюты: {code!r}")
+    return code
+
+
+def read_rates(path):
+    """Читает файл курсов.
+
+    :param path: Путь к файлу JSON
+    :type path: str
+    :return: Словарь код валюты - курс, базовая валюта файла с курсом 1
+    :rtype: dict[str, float]
+    :raises ValueError: Если файл не в формате курсов или курс не является
+        положительным числом
+    :raises OSError: Если файл не удалось прочитать
+    """
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or not isinstance(data.get("rates"), dict):
+        raise ValueError(f"{path}: нет словаря rates")
+    rates = {normalize_currency(data.get("base", DEFAULT_CURRENCY)): 1.0}
+    for code, rate in data["rates"].items():
+        if isinstance(rate, bool) or not isinstance(rate, (int, float)):
+            raise ValueError(f"{path}: курс {code} не является числом")
+        if not (math.isfinite(rate) and rate > 0):
+            raise ValueError(f"{path}: курс {code} должен быть больше 0")
+        rates[normalize_currency(code)] = float(rate)
+    return rates
+
+
+def convert(kopecks, rate, base_rate):
+    """Переводит сумму в копейках из одной валюты в другую.
+
+    :param kopecks: Сумма в копейках (центах) исходной валюты
+    :type kopecks: int
+    :param rate: Курс исходной валюты
+    :type rate: float
+    :param base_rate: Курс валюты, в которую переводится сумма
+    :type base_rate: float
+    :return: Сумма в копейках, округленная до целой
+    :rtype: int
+    """
+    if rate == base_rate:
+        return kopecks
+    return round(kopecks * rate / base_rate)
+
+
+def split_currency(text):
+    """Отделяет валюту, написанную после суммы: "10 USD", "10$".
+
+    :param text: Текст сообщения
+    :type text: str
+    :return: Текст суммы и код валюты или None, если валюта не указана
+    :rtype: tuple[str, str или None]
+    :raises ValueError: Если после суммы написан не код валюты
+    """
+    text = text.strip()
+    if text[-1:] in SYMBOLS:
+        return text[:-1], SYMBOLS[text[-1]]
+    head, _, tail = text.rpartition(" ")
+    if head and tail.isalpha():
+        return head, normalize_currency(tail)
+    return text, None
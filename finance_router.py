@@ -0,0 +1,162 @@
+"""Маршрутизатор входящих сообщений бота.
+
+TeleBot проверяет фильтры обработчиков по очереди, и каждое сообщение
+проходит через все ``func=lambda msg: ...`` до первого совпадения.
+Router один раз при запуске собирает словари "точный текст кнопки ->
+обработчик" и "команда -> обработчик" и находит обработчик одним
+поиском в словаре. По списку проверяются только действительно
+динамические условия.
+
+Одну таблицу можно установить на несколько ботов сразу. Аргументы,
+переданные в install(), например приложение бота, достаются каждому
+условию и обработчику перед сообщением, поэтому обработчики не зависят от
+глобальных переменных.
+"""
+from telebot import util
+
+
+class Router:
+    """Таблица обработчиков текстовых сообщений.
+
+    Обработчик выбирается в таком порядке:
+    1. Условия, зарегистрированные через ``predicate(func, first=True)``
+    2. Команда (``/start``) по словарю commands
+    3. Точный текст сообщения по словарю texts
+    4. Остальные условия ``predicate(func)`` в порядке регистрации
+    5. Обработчик по умолчанию
+
+    :ivar commands: Обработчики команд по имени команды без "/"
+    :vartype commands: dict[str, callable]
+
+    :ivar texts: Обработчики по точному тексту сообщения
+    :vartype texts: dict[str, callable]
+
+    :ivar metrics: Реестр, в который dispatch() пишет время каждого
+        обработчика под его именем, или None
+    :vartype metrics: finance_metrics.Metrics или None
+    """
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self.commands = {}
+        self.texts = {}
+        self.first = []
+        self.fallbacks = []
+        self.default_handler = None
+
+    def command(self, *names):
+        """Декоратор: обработчик команд с указанными именами.
+
+        :param names: Имена команд без "/"
+        :type names: str
+        :return: Декоратор, возвращающий обработчик без изменений
+        :rtype: callable
+        """
+        def decorator(handler):
+            for name in names:
+                self.commands[name] = handler
+            return handler
+
+        return decorator
+
+    def text(self, *texts):
+        """Декоратор: обработчик сообщений с точно таким текстом.
+
+        :param texts: Тексты кнопок
+        :type texts: str
+        :return: Декоратор, возвращающий обработчик без изменений
+        :rtype: callable
+        """
+        def decorator(handler):
+            for text in texts:
+                self.texts[text] = handler
+            return handler
+
+        return decorator
+
+    def predicate(self, func, first=False):
+        """Декоратор: обработчик с динамическим условием.
+
+        :param func: Условие вида ``func(message) -> bool``
+        :type func: callable
+        :param first: Проверять условие раньше команд и кнопок
+        :type first: bool
+        :return: Декоратор, возвращающий обработчик без изменений
+        :rtype: callable
+        """
+        def decorator(handler):
+            (self.first if first else self.fallbacks).append((func, handler))
+            return handler
+
+        return decorator
+
+    def default(self, handler):
+        """Декоратор: обработчик сообщений, которым ничего не подошло.
+
+        :param handler: Обработчик
+        :type handler: callable
+        :return: Тот же обработчик
+        :rtype: callable
+        """
+        self.default_handler = handler
+        return handler
+
+    def resolve(self, message, *context):
+        """Находит обработчик для сообщения.
+
+        :param message: Входящее сообщение
+        :type message: telebot.types.Message
+        :param context: Аргументы условий перед сообщением
+        :return: Обработчик или None
+        :rtype: callable или None
+        """
+        for func, handler in self.first:
+            if func(*context, message):
+                return handler
+        text = message.text
+        if text is not None:
+            if text.startswith("/"):
+                handler = self.commands.get(util.extract_command(text))
+                if handler is not None:
+                    return handler
+            handler = self.texts.get(text)
+            if handler is not None:
+                return handler
+        for func, handler in self.fallbacks:
+            if func(*context, message):
+                return handler
+        return self.default_handler
+
+    def dispatch(self, message, *context):
+        """Вызывает обработчик, подходящий сообщению.
+
+        :param message: Входящее сообщение
+        :type message: telebot.types.Message
+        :param context: Аргументы обработчика перед сообщением
+        :return: None
+        :rtype: None
+        """
+        handler = self.resolve(message, *context)
+        if handler is None:
+            return
+        if self.metrics is None:
+            handler(*context, message)
+            return
+        with self.metrics.timer("handler", handler.__name__):
+            handler(*context, message)
+
+    def install(self, bot, *context):
+        """Регистрирует маршрутизатор единственным обработчиком текстовых
+        сообщений бота.
+
+        :param bot: Бот
+        :type bot: telebot.TeleBot
+        :param context: Аргументы, которые передавать условиям и
+            обработчикам перед сообщением, например приложение бота
+        :return: None
+        :rtype: None
+        """
+        def dispatch(message):
+            self.dispatch(message, *context)
+
+        bot.register_message_handler(dispatch, func=lambda msg: True)
@@ -0,0 +1,340 @@
+"""Хранилище, разделенное по нескольким файлам SQLite.
+
+В одной базе все записи бота ждут единственную блокировку писателя
+SQLite. ShardedFinanceDB делит пользователей по хэшу user_id между N
+файлами, у каждого из которых свой FinanceDB со своим пулом и писателем,
+поэтому записи разных шардов идут параллельно. Все данные пользователя
+лежат в одном шарде, и операции над ним затрагивают только этот файл.
+Запросы по всем пользователям выполняются на всех шардах параллельно и
+объединяются.
+
+Изменить количество шардов можно функцией reshard(), она переносит
+данные в новый набор файлов.
+"""
+import os
+import sqlite3
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+SHARDED_TABLES = {
+    "users": "user_id, balance, initial_balance, currency",
+    "expenses": "user_id, category, amount, currency, charged, date",
+    "category_totals": "user_id, category, currency, total, count",
+    "expense_buckets": (
+        "user_id, period, start, category, currency, total, count"
+    ),
+    "conversation_state": "user_id, state, updated_at",
+    "budgets": "user_id, category, amount, month, spent, alerted",
+}
+"""
+Таблицы с данными пользователей, которые переносит reshard(), и их
+столбцы. Идентификаторы расходов в новом шарде выдаются заново
+
+:type: dict[str, str]
+"""
+
+
+def shard_for(user_id, shards):
+    """Возвращает номер шарда пользователя.
+
+    Хэш CRC32 не зависит от запуска интерпретатора, поэтому пользователь
+    всегда попадает в один и тот же файл.
+
+    :param user_id: Идентификатор пользователя
+    :type user_id: int
+    :param shards: Количество шардов
+    :type shards: int
+    :return: Номер шарда от 0 до shards - 1
+    :rtype: int
+    """
+    return zlib.crc32(str(user_id).encode("ascii")) % shards
+
+
+def shard_paths(path, shards):
+    """Возвращает имена файлов шардов: finance.db - finance.0.db, ...
+
+    :param path: Имя файла базы без шардов
+    :type path: str
+    :param shards: Количество шардов
+    :type shards: int
+    :return: Имена файлов, для одного шарда - сам path
+    :rtype: list[str]
+    """
+    if shards == 1:
+        return [path]
+    root, extension = os.path.splitext(path)
+    return [f"{root}.{index}{extension}" for index in range(shards)]
+
+
+def _routed(name):
+    """Создает метод, который вызывает метод FinanceDB шарда
+    пользователя, переданного первым аргументом.
+    """
+
+    def method(self, user_id, *args, **kwargs):
+        return getattr(self.shard(user_id), name)(user_id, *args, **kwargs)
+
+    method.__name__ = name
+    method.__doc__ = f"Вызывает FinanceDB.{name}() в шарде пользователя."
+    return method
+
+
+class ShardedFinanceDB:
+    """Набор FinanceDB, между которыми пользователи делятся по хэшу
+    user_id.
+
+    Повторяет интерфейс FinanceDB, которым пользуется бот. Методы
+    одного пользователя выполняются в его шарде, методы по всем
+    пользователям (с user_id=None) - на всех шардах.
+
+    :ivar shards: Базы шардов по номерам
+    :vartype shards: list[FinanceDB]
+
+    :ivar paths: Файлы шардов
+    :vartype paths: list[str]
+    """
+
+    def __init__(self, path="finance.db", shards=4, factory=None, **kwargs):
+        """
+        :param path: Имя файла базы, из него строятся имена шардов
+        :type path: str
+        :param shards: Количество шардов
+        :type shards: int
+        :param factory: Класс базы шарда, по умолчанию FinanceDB
+        :type factory: type или None
+        :param kwargs: Аргументы FinanceDB для каждого шарда: readers,
+            group_commit, cache_size, cache_ttl
+        :raises ValueError: Если shards меньше 1
+        """
+        if shards < 1:
+            raise ValueError("Нужен хотя бы один шард")
+        if factory is None:
+            from proekt_onlycod_documentation import FinanceDB as factory
+        self.paths = shard_paths(path, shards)
+        self.shards = [factory(shard, **kwargs) for shard in self.paths]
+        self._executor = ThreadPoolExecutor(
+            max_workers=shards, thread_name_prefix="shard"
+        )
+
+    def shard(self, user_id):
+        """Возвращает базу шарда пользователя.
+
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :return: База, в которой лежат данные пользователя
+        :rtype: FinanceDB
+        """
+        return self.shards[shard_for(user_id, len(self.shards))]
+
+    set_balance = _routed("set_balance")
+    get_balance = _routed("get_balance")
+    get_currency = _routed("get_currency")
+    add_expense = _routed("add_expense")
+    add_expense_atomic = _routed("add_expense_atomic")
+    spend = _routed("spend")
+    set_budget = _routed("set_budget")
+    get_budgets = _routed("get_budgets")
+    get_stats = _routed("get_stats")
+    get_history = _routed("get_history")
+    get_history_page = _routed("get_history_page")
+    iter_expenses = _routed("iter_expenses")
+    clear_data = _routed("clear_data")
+
+    def submit(self, op, user_id, *args):
+        """Отправляет операцию записи в шард пользователя.
+
+        :param op: Имя метода записи FinanceDB, например "add_expense"
+        :type op: str
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :param args: Остальные аргументы операции
+        :return: Future с результатом или исключением операции
+        :rtype: concurrent.futures.Future
+        """
+        return self.shard(user_id).submit(op, user_id, *args)
+
+    def rate(self, currency):
+        """Возвращает курс валюты, курсы во всех шардах одинаковые.
+
+        :param currency: Код валюты
+        :type currency: str
+        :return: Курс валюты
+        :rtype: float
+        :raises ValueError: Если курс валюты неизвестен
+        """
+        return self.shards[0].rate(currency)
+
+    def _each(self, name, *args):
+        """Вызывает метод на всех шардах параллельно.
+
+        :return: Результаты по шардам в порядке номеров
+        :rtype: list
+        """
+        return list(
+            self._executor.map(
+                lambda shard: getattr(shard, name)(*args), self.shards
+            )
+        )
+
+    def _user_or_all(self, name, user_id):
+        """Вызывает метод сверки в шарде пользователя или, для None, на
+        всех шардах и объединяет списки.
+        """
+        if user_id is not None:
+            return getattr(self.shard(user_id), name)(user_id)
+        return [row for rows in self._each(name, None) for row in rows]
+
+    def load_rates(self, path):
+        """Загружает курсы валют во все шарды.
+
+        :param path: Путь к файлу курсов
+        :type path: str
+        :return: Количество загруженных курсов
+        :rtype: int
+        :raises ValueError: Если файл некорректен
+        :raises OSError: Если файл не удалось прочитать
+        """
+        return self._each("load_rates", path)[0]
+
+    def rebuild_category_totals(self, user_id=None):
+        """Пересчитывает category_totals в шарде пользователя или во
+        всех шардах.
+
+        :return: Количество записанных строк
+        :rtype: int
+        """
+        if user_id is not None:
+            return self.shard(user_id).rebuild_category_totals(user_id)
+        return sum(self._each("rebuild_category_totals", None))
+
+    def verify_category_totals(self, user_id=None):
+        """Сверяет category_totals с расходами, см.
+        FinanceDB.verify_category_totals().
+
+        :rtype: list[tuple]
+        """
+        return self._user_or_all("verify_category_totals", user_id)
+
+    def reconcile(self, user_id=None):
+        """Сверяет балансы с расходами, см. FinanceDB.reconcile().
+
+        :rtype: list[tuple]
+        """
+        return self._user_or_all("reconcile", user_id)
+
+    def category_summary(self):
+        """Суммы по категориям по всем пользователям всех шардов.
+
+        Пользователь лежит только в одном шарде, поэтому количества
+        пользователей по шардам складываются.
+
+        :return: Словарь категория - (сумма, количество расходов,
+            количество пользователей), упорядоченный по категориям
+        :rtype: dict[str, tuple[decimal.Decimal, int, int]]
+        """
+        merged = {}
+        for summary in self._each("category_summary"):
+            for category, values in summary.items():
+                if category in merged:
+                    values = tuple(map(sum, zip(merged[category], values)))
+                merged[category] = values
+        return dict(sorted(merged.items()))
+
+    def check_query_plans(self):
+        """Проверяет планы горячих запросов во всех шардах.
+
+        :return: Планы первого шарда, схема у всех одинаковая
+        :rtype: dict[str, list[str]]
+        :raises AssertionError: Если какой-то запрос не использует индекс
+        """
+        return self._each("check_query_plans")[0]
+
+    def close(self):
+        """Закрывает базы всех шардов.
+
+        :return: None
+        :rtype: None
+        """
+        self._executor.shutdown(wait=True)
+        for shard in self.shards:
+            shard.close()
+
+
+def reshard(sources, target, shards, factory=None):
+    """Переносит данные пользователей из одних файлов в новый набор
+    шардов.
+
+    Каждый новый шард присоединяет старые файлы через ATTACH и забирает
+    свои строки одним INSERT ... SELECT на таблицу, поэтому данные не
+    проходят через Python. Курсы и места остановки импорта копируются из
+    первого старого файла. Бот на время переноса нужно остановить, а
+    после - запустить с новыми файлами.
+
+    :param sources: Файлы старых шардов
+    :type sources: list[str]
+    :param target: Имя файла базы для новых шардов
+    :type target: str
+    :param shards: Количество новых шардов
+    :type shards: int
+    :param factory: Класс базы, создающий схему, по умолчанию FinanceDB
+    :type factory: type или None
+    :return: Количество пользователей в каждом новом шарде
+    :rtype: list[int]
+    :raises ValueError: Если новые файлы совпадают со старыми или уже
+        содержат пользователей
+    """
+    if factory is None:
+        from proekt_onlycod_documentation import FinanceDB as factory
+    paths = shard_paths(target, shards)
+    sources = [os.path.abspath(source) for source in sources]
+    if set(map(os.path.abspath, paths)) & set(sources):
+        raise ValueError("Новые шарды должны быть в других файлах")
+    counts = []
+    for index, path in enumerate(paths):
+        db = factory(path)
+        db.close()
+        conn = sqlite3.connect(path, isolation_level=None)
+        try:
+            if conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+                raise ValueError(f"{path} уже содержит пользователей")
+            conn.create_function(
+                "finance_shard",
+                1,
+                lambda user_id: shard_for(user_id, shards),
+                deterministic=True,
+            )
+            for number, source in enumerate(sources):
+                conn.execute("ATTACH DATABASE ? AS source", (source,))
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    _copy_shard(conn, index, first=number == 0)
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+                finally:
+                    conn.execute("DETACH DATABASE source")
+            counts.append(
+                conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+            )
+        finally:
+            conn.close()
+    return counts
+
+
+def _copy_shard(conn, index, first):
+    """Копирует из присоединенной базы source строки шарда index."""
+    for table, columns in SHARDED_TABLES.items():
+        order = " ORDER BY id" if table == "expenses" else ""
+        conn.execute(
+            f"""INSERT INTO main.{table} ({columns})
+            SELECT {columns} FROM source.{table}
+            WHERE finance_shard(user_id) = ?{order}""",
+            (index,),
+        )
+    if first:
+        for table in ("exchange_rates", "import_checkpoints"):
+            conn.execute(
+                f"INSERT OR REPLACE INTO main.{table} "
+                f"SELECT * FROM source.{table}"
+            )
@@ -0,0 +1,348 @@
+"""Хранилища состояния диалогов бота.
+
+Состояние - это словарь с текущим шагом диалога пользователя (ключ
+"step") и данными, собранными на предыдущих шагах, например выбранной
+категорией расхода. Оба хранилища ограничены по размеру и забывают
+брошенные диалоги через ``ttl`` секунд, поэтому память процесса не растет
+со временем. SQLiteStateStore к тому же переживает перезапуск бота, а
+ShardedStateStore хранит состояние в шарде пользователя.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from finance_shards import shard_for
+
+
+class _StateEntry:
+    """Запись хранилища в памяти: состояние и момент, когда оно устареет."""
+
+    __slots__ = ("state", "expires")
+
+    def __init__(self, state, expires):
+        self.state = state
+        self.expires = expires
+
+
+class MemoryStateStore:
+    """Хранилище состояний в памяти процесса.
+
+    При переполнении вытесняется состояние, которое дольше всех не
+    менялось.
+
+    :ivar ttl: Через сколько секунд без изменений состояние забывается
+    :vartype ttl: float
+
+    :ivar max_size: Максимальное количество хранимых состояний
+    :vartype max_size: int
+    """
+
+    def __init__(self, ttl=3600.0, max_size=100000, clock=time.monotonic):
+        """
+        :param ttl: Время жизни состояния в секундах
+        :type ttl: float
+        :param max_size: Максимальное количество состояний
+        :type max_size: int
+        :param clock: Источник времени, нужен для подмены в тестах
+        :type clock: callable
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, user_id):
+        """Возвращает состояние пользователя.
+
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :return: Копия состояния или None, если его нет или оно устарело
+        :rtype: dict или None
+        """
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is None:
+                return None
+            if entry.expires <= self._clock():
+                del self._data[user_id]
+                return None
+            return dict(entry.state)
+
+    def put(self, user_id, state):
+        """Сохраняет состояние пользователя целиком.
+
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :param state: Состояние диалога
+        :type state: dict
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            self._data[user_id] = _StateEntry(
+                dict(state), self._clock() + self.ttl
+            )
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, user_id):
+        """Удаляет состояние пользователя.
+
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :return: Удаленное состояние или None
+        :rtype: dict или None
+        """
+        with self._lock:
+            entry = self._data.pop(user_id, None)
+        if entry is None or entry.expires <= self._clock():
+            return None
+        return entry.state
+
+    def purge(self):
+        """Удаляет все устаревшие состояния.
+
+        Записи упорядочены по времени изменения, поэтому просмотр
+        останавливается на первой неустаревшей.
+
+        :return: Количество удаленных состояний
+        :rtype: int
+        """
+        removed = 0
+        now = self._clock()
+        with self._lock:
+            while self._data:
+                user_id, entry = next(iter(self._data.items()))
+                if entry.expires > now:
+                    break
+                del self._data[user_id]
+                removed += 1
+        return removed
+
+
+class SQLiteStateStore:
+    """Хранилище состояний в таблице conversation_state базы бота.
+
+    Состояние хранится как JSON. Перед таблицей стоит сквозной кэш в
+    памяти: put() и pop() сначала пишут в таблицу, а затем в кэш, а get()
+    читает только кэш, поэтому проверка шага на каждом сообщении не
+    обращается к SQLite. Кэш заполняется из таблицы при создании
+    хранилища, так что состояния по-прежнему переживают перезапуск, но
+    писать в conversation_state в обход хранилища нельзя. Устаревшие
+    состояния не возвращаются, а удаляются из таблицы и кэша вместе с
+    лишними сверх ``max_size`` раз в ``purge_every`` записей.
+
+    :ivar ttl: Через сколько секунд без изменений состояние забывается
+    :vartype ttl: float
+
+    :ivar max_size: Максимальное количество хранимых состояний
+    :vartype max_size: int
+    """
+
+    def __init__(
+        self, pool, ttl=3600.0, max_size=100000, purge_every=1000,
+        clock=time.time,
+    ):
+        """
+        :param pool: Пул соединений базы, в которой есть conversation_state
+        :type pool: finance_pool.ConnectionPool
+        :param ttl: Время жизни состояния в секундах
+        :type ttl: float
+        :param max_size: Максимальное количество состояний
+        :type max_size: int
+        :param purge_every: Через сколько записей запускать purge()
+        :type purge_every: int
+        :param clock: Источник времени, переживающего перезапуск
+        :type clock: callable
+        """
+        self.pool = pool
+        self.ttl = ttl
+        self.max_size = max_size
+        self.purge_every = purge_every
+        self._clock = clock
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        with pool.reader() as cursor:
+            cursor.execute(
+                """SELECT user_id, state, updated_at FROM conversation_state
+                WHERE updated_at > ? ORDER BY updated_at""",
+                (clock() - ttl,),
+            )
+            for user_id, state, updated_at in cursor.fetchall():
+                self._data[user_id] = _StateEntry(
+                    json.loads(state), updated_at + ttl
+                )
+
+    def __len__(self):
+        with self.pool.reader() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM conversation_state")
+            return cursor.fetchone()[0]
+
+    def get(self, user_id):
+        """Возвращает состояние пользователя из кэша, не читая таблицу.
+
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :return: Копия состояния или None, если его нет или оно устарело
+        :rtype: dict или None
+        """
+        entry = self._data.get(user_id)
+        if entry is None or entry.expires <= self._clock():
+            return None
+        return dict(entry.state)
+
+    def put(self, user_id, state):
+        """Сохраняет состояние пользователя целиком.
+
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :param state: Состояние диалога, должно сериализоваться в JSON
+        :type state: dict
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            now = self._clock()
+            with self.pool.writer() as cursor:
+                cursor.execute(
+                    """INSERT OR REPLACE INTO conversation_state
+                    VALUES (?, ?, ?)""",
+                    (user_id, json.dumps(state, ensure_ascii=False), now),
+                )
+            self._data[user_id] = _StateEntry(dict(state), now + self.ttl)
+            self._data.move_to_end(user_id)
+            self._puts += 1
+            purge = self._puts % self.purge_every == 0
+        if purge:
+            self.purge()
+
+    def pop(self, user_id):
+        """Удаляет состояние пользователя.
+
+        Если в кэше состояния нет, то нет его и в таблице, и транзакция
+        записи не открывается.
+
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :return: Удаленное состояние или None
+        :rtype: dict или None
+        """
+        with self._lock:
+            if user_id not in self._data:
+                return None
+            with self.pool.writer() as cursor:
+                cursor.execute(
+                    "DELETE FROM conversation_state WHERE user_id=?",
+                    (user_id,),
+                )
+            entry = self._data.pop(user_id)
+        if entry.expires <= self._clock():
+            return None
+        return entry.state
+
+    def purge(self):
+        """Удаляет устаревшие состояния и самые старые сверх max_size.
+
+        :return: Количество удаленных состояний
+        :rtype: int
+        """
+        with self._lock:
+            now = self._clock()
+            with self.pool.writer() as cursor:
+                cursor.execute(
+                    "DELETE FROM conversation_state WHERE updated_at <= ?",
+                    (now - self.ttl,),
+                )
+                removed = cursor.rowcount
+                cursor.execute(
+                    """DELETE FROM conversation_state WHERE user_id IN (
+                    SELECT user_id FROM conversation_state
+                    ORDER BY updated_at DESC LIMIT -1 OFFSET ?)""",
+                    (self.max_size,),
+                )
+                removed += cursor.rowcount
+            while self._data:
+                user_id, entry = next(iter(self._data.items()))
+                if (entry.expires > now
+                        and len(self._data) <= self.max_size):
+                    break
+                del self._data[user_id]
+            return removed
+
+
+class ShardedStateStore:
+    """Хранилища состояний шардов ShardedFinanceDB.
+
+    Состояние пользователя лежит в conversation_state его шарда, рядом с
+    остальными его данными, поэтому reshard() переносит его вместе с
+    ними, а после смены количества шардов оно находится в новом шарде.
+
+    :ivar stores: Хранилища шардов по номерам
+    :vartype stores: list[SQLiteStateStore]
+    """
+
+    def __init__(self, stores):
+        """
+        :param stores: Хранилища в том же порядке, что и шарды базы
+        :type stores: list[SQLiteStateStore]
+        """
+        self.stores = stores
+
+    def __len__(self):
+        return sum(len(store) for store in self.stores)
+
+    def store(self, user_id):
+        """Возвращает хранилище шарда пользователя.
+
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :rtype: SQLiteStateStore
+        """
+        return self.stores[shard_for(user_id, len(self.stores))]
+
+    def get(self, user_id):
+        """Возвращает состояние пользователя из его шарда.
+
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :return: Состояние или None
+        :rtype: dict или None
+        """
+        return self.store(user_id).get(user_id)
+
+    def put(self, user_id, state):
+        """Сохраняет состояние пользователя в его шарде.
+
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :param state: Состояние диалога
+        :type state: dict
+        :return: None
+        :rtype: None
+        """
+        self.store(user_id).put(user_id, state)
+
+    def pop(self, user_id):
+        """Удаляет состояние пользователя из его шарда.
+
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :return: Удаленное состояние или None
+        :rtype: dict или None
+        """
+        return self.store(user_id).pop(user_id)
+
+    def purge(self):
+        """Чистит хранилища всех шардов.
+
+        :return: Количество удаленных состояний
+        :rtype: int
+        """
+        return sum(store.purge() for store in self.stores)
@@ -1,4 +1,42 @@
+import asyncio
+import csv
+import datetime
+import importlib.util
+import io
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib.error
+import urllib.request
+from decimal import Decimal
+from types import SimpleNamespace
+
+import telebot
+
+from finance_analytics import compare_months, monthly_totals, rolling_average
+from finance_async import AsyncBotBridge, AsyncRuntime
+from finance_router import Router
+from finance_state import MemoryStateStore, ShardedStateStore, SQLiteStateStore
+from finance_webhook import SECRET_HEADER, WebhookServer, replay
+from finance_cache import TTLCache
+from finance_charts import ChartRenderer, pool_context
+from finance_export import Exporter, write_csv
+from finance_fakeapi import FakeBotAPI
+from finance_keyboards import KeyboardRegistry
+from finance_metrics import Metrics, MetricsServer, registry
+from finance_migrations import HOT_QUERIES, MIGRATIONS, migrate
+from finance_money import MAX_KOPECKS, parse_money, to_kopecks
+from finance_outbox import Outbox, TokenBucket
+from finance_rates import split_currency
+from finance_shards import ShardedFinanceDB, reshard, shard_for
+import proekt_onlycod_documentation as app
 from proekt_onlycod_documentation import FinanceDB
 
 class TestFinanceDB(unittest.TestCase):
@@ -250,5 +288,1485 @@ class TestFinanceDB(unittest.TestCase):
         self.assertEqual(stats["Развлечения, кино и отдых"], 300.0)
         self.assertEqual(stats["Коммунальные услуги и квартплата"], 400.0)
 
+
+class TestConnectionPool(unittest.TestCase):
+    """
+    Тесты для пула соединений - проверяем работу FinanceDB из нескольких потоков на файловой базе
+    """
+
+    def setUp(self):
+        """
+        Для пула нужна настоящая база в файле, в памяти WAL не включается
+        """
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = FinanceDB(os.path.join(self.tmpdir.name, "test.db"), readers=3)
+
+    def tearDown(self):
+        self.db.close()
+        self.tmpdir.cleanup()
+
+    def test_1_wal_mode(self):
+        """
+        Тест 1 для пула: файловая база открывается в режиме WAL
+        """
+        mode = self.db.conn.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, "wal", "Для файловой базы должен быть включен WAL")
+
+    def test_2_concurrent_expenses(self):
+        """
+        Тест 2 для пула: много потоков одновременно добавляют расходы и читают баланс
+        Ни одна запись не должна потеряться, а баланс должен сойтись
+        """
+        user_id = 4001
+        self.db.set_balance(user_id, 10000.0)
+
+        def worker():
+            for _ in range(25):
+                self.db.add_expense(user_id, "Еда", 10.0)
+                self.db.get_balance(user_id)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.db.get_balance(user_id), 8000.0, "Должно остаться 8000")
+        self.assertEqual(self.db.get_stats(user_id), {"Еда": 2000.0})
+
+    def test_3_no_overdraft_race(self):
+        """
+        Тест 3 для пула: одновременные траты не могут вместе увести баланс в минус
+        Из 40 попыток по 100 при балансе 1000 пройти должны ровно 10
+        """
+        user_id = 4002
+        self.db.set_balance(user_id, 1000.0)
+        results = []
+
+        def worker():
+            for _ in range(5):
+                results.append(self.db.add_expense_atomic(user_id, "Еда", 100.0))
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        successful = [balance for balance in results if balance is not None]
+        self.assertEqual(len(successful), 10, "Должно пройти ровно 10 трат")
+        self.assertEqual(min(successful), 0.0, "Последняя трата должна обнулить баланс")
+        self.assertEqual(self.db.get_balance(user_id), 0.0)
+
+    def test_4_failed_commit_rolls_back(self):
+        """
+        Тест 4 для пула: если падает сам COMMIT, транзакция откатывается и следующая запись проходит
+        """
+        pool = self.db.pool
+        pool.writer_conn.execute("PRAGMA foreign_keys=ON")
+        pool.writer_conn.execute("CREATE TABLE parent (id INTEGER PRIMARY KEY)")
+        pool.writer_conn.execute(
+            "CREATE TABLE child (parent_id INTEGER REFERENCES parent(id) DEFERRABLE INITIALLY DEFERRED)"
+        )
+        with self.assertRaises(sqlite3.IntegrityError):
+            with pool.writer() as cursor:
+                cursor.execute("INSERT INTO child VALUES (1)")
+        self.assertFalse(pool.writer_conn.in_transaction, "Соединение писателя не должно остаться в транзакции")
+        with pool.writer() as cursor:
+            cursor.execute("INSERT INTO parent VALUES (1)")
+            cursor.execute("INSERT INTO child VALUES (1)")
+        self.assertEqual(pool.writer_conn.execute("SELECT COUNT(*) FROM child").fetchone()[0], 1)
+
+
+class TestGroupCommit(unittest.TestCase):
+    """
+    Тесты для групповой фиксации - записи из разных потоков уходят общими транзакциями
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = FinanceDB(os.path.join(self.tmpdir.name, "test.db"), group_commit=True)
+
+    def tearDown(self):
+        self.db.close()
+        self.tmpdir.cleanup()
+
+    def test_1_futures_report_own_result(self):
+        """
+        Тест 1 для групповой фиксации: каждая операция получает свой результат,
+        ошибка одной операции не ломает соседние в той же пачке
+        """
+        user_id = 5001
+        futures = [
+            self.db.submit("set_balance", user_id, 100.0),
+            self.db.submit("add_expense", user_id, "Еда", 30.0),
+            self.db.submit("set_balance", 5002, "bebe"),
+            self.db.submit("add_expense", user_id, "Еда", 500.0),
+        ]
+
+        self.assertTrue(futures[0].result())
+        self.assertEqual(futures[1].result(), 70.0, "После траты должно остаться 70")
+        self.assertIsInstance(futures[2].exception(), ValueError)
+        self.assertIsNone(futures[3].result(), "На трату 500 денег не хватает")
+        self.assertEqual(self.db.get_balance(user_id), 70.0)
+        self.assertIsNone(self.db.get_balance(5002))
+
+    def test_2_concurrent_writes_are_batched(self):
+        """
+        Тест 2 для групповой фиксации: одновременные записи объединяются в меньшее число транзакций
+        """
+        user_id = 5003
+        self.db.set_balance(user_id, 1000.0)
+
+        def worker():
+            for _ in range(10):
+                self.assertTrue(self.db.add_expense(user_id, "Связь", 5.0))
+
+        threads = [threading.Thread(target=worker) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.db.get_balance(user_id), 500.0)
+        committer = self.db.committer
+        self.assertEqual(committer.operations, 101)
+        self.assertLess(committer.batches, committer.operations, "Записи должны объединяться в пачки")
+
+
+class TestCategoryTotals(unittest.TestCase):
+    """
+    Тесты для таблицы category_totals - готовые суммы по категориям для get_stats
+    """
+
+    def setUp(self):
+        self.db = FinanceDB(":memory:")
+
+    def test_1_totals_follow_expenses_and_clear(self):
+        """
+        Тест 1 для category_totals: суммы и количество растут с расходами и удаляются вместе с данными
+        """
+        user_id = 6001
+        self.db.set_balance(user_id, 1000.0)
+        self.db.add_expense(user_id, "Еда", 100.0)
+        self.db.add_expense(user_id, "Еда", 50.0)
+        self.db.add_expense(user_id, "Связь", 25.0)
+
+        self.db.cursor.execute("SELECT category, total, count FROM category_totals WHERE user_id=? ORDER BY category", (user_id,))
+        self.assertEqual(self.db.cursor.fetchall(), [("Еда", 15000, 2), ("Связь", 2500, 1)])
+        self.assertEqual(self.db.verify_category_totals(), [])
+
+        self.db.clear_data(user_id)
+        self.assertEqual(self.db.get_stats(user_id), {}, "После очистки статистики быть не должно")
+
+    def test_2_verify_and_rebuild(self):
+        """
+        Тест 2 для category_totals: сверка находит испорченную сумму, а пересчет её чинит
+        """
+        user_id = 6002
+        self.db.set_balance(user_id, 1000.0)
+        self.db.add_expense(user_id, "Еда", 100.0)
+        self.db.cursor.execute("UPDATE category_totals SET total = 100 WHERE user_id=?", (user_id,))
+
+        self.assertEqual(self.db.verify_category_totals(user_id), [(user_id, "Еда", "RUB", 100.0, 1.0, 1, 1)])
+        self.db.rebuild_category_totals(user_id)
+        self.assertEqual(self.db.verify_category_totals(user_id), [])
+        self.assertEqual(self.db.get_stats(user_id), {"Еда": 100.0})
+
+    def test_3_backfill_existing_database(self):
+        """
+        Тест 3 для category_totals: в старой базе без таблицы суммы заполняются по уже записанным расходам
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "old.db")
+            conn = sqlite3.connect(path)
+            conn.execute("CREATE TABLE users (user_id INTEGER PRIMARY KEY, balance REAL DEFAULT 0)")
+            conn.execute("""CREATE TABLE expenses (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER,
+                         category TEXT, amount REAL, date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+            conn.execute("INSERT INTO users VALUES (7, 500)")
+            conn.executemany("INSERT INTO expenses (user_id, category, amount) VALUES (7, ?, ?)",
+                             [("Еда", 10.0), ("Еда", 20.0), ("Жилье", 300.0)])
+            conn.commit()
+            conn.close()
+
+            db = FinanceDB(path)
+            self.assertEqual(db.get_stats(7), {"Еда": 30.0, "Жилье": 300.0})
+            db.close()
+
+
+class TestMigrations(unittest.TestCase):
+    """
+    Тесты для миграций схемы - версия в PRAGMA user_version и индексы горячих запросов
+    """
+
+    def test_1_version_and_indexes(self):
+        """
+        Тест 1 для миграций: новая база получает последнюю версию схемы, а горячие запросы идут по индексам
+        """
+        db = FinanceDB(":memory:")
+        db.cursor.execute("PRAGMA user_version")
+        self.assertEqual(db.cursor.fetchone()[0], MIGRATIONS[-1][0])
+
+        plans = db.check_query_plans()
+        self.assertIn("idx_expenses_user_date", plans["get_history"][0])
+
+    def test_2_migrations_are_idempotent(self):
+        """
+        Тест 2 для миграций: повторное открытие базы не применяет миграции заново и не теряет данные
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "test.db")
+            db = FinanceDB(path)
+            db.set_balance(1, 100.0)
+            db.add_expense(1, "Еда", 40.0)
+            db.close()
+
+            db = FinanceDB(path)
+            self.assertEqual(migrate(db.pool), [], "Все миграции уже применены")
+            self.assertEqual(db.get_balance(1), 60.0)
+            self.assertEqual(db.get_stats(1), {"Еда": 40.0})
+            db.close()
+
+
+class TestHistoryPages(unittest.TestCase):
+    """
+    Тесты для get_history_page - листание истории по ключу (date, id)
+    """
+
+    def setUp(self):
+        self.db = FinanceDB(":memory:")
+        self.user_id = 8001
+        self.db.set_balance(self.user_id, 10000.0)
+        # Все расходы попадают в одну секунду, порядок при равных датах задает id
+        for i in range(1, 13):
+            self.db.add_expense(self.user_id, "Еда", float(i))
+
+    def test_1_walk_older_and_back(self):
+        """
+        Тест 1 для get_history_page: листаем от новых к старым и обратно, не теряя и не повторяя записи
+        """
+        amounts = []
+        pages = []
+        page, older, newer = self.db.get_history_page(self.user_id)
+        self.assertIsNone(newer, "У первой страницы нет более новых записей")
+        while True:
+            pages.append(page)
+            amounts.extend(amount for _, amount, _ in page)
+            if older is None:
+                break
+            page, older, newer = self.db.get_history_page(self.user_id, before=older)
+            self.assertIsNotNone(newer)
+
+        self.assertEqual(amounts, [float(i) for i in range(12, 0, -1)])
+        self.assertEqual([len(p) for p in pages], [5, 5, 2])
+
+        page, older, newer = self.db.get_history_page(self.user_id, after=newer)
+        self.assertEqual(page, pages[1], "Шаг назад должен вернуть предыдущую страницу")
+        page, older, newer = self.db.get_history_page(self.user_id, after=newer)
+        self.assertEqual(page, pages[0])
+        self.assertIsNone(newer, "Новее первой страницы записей нет")
+
+    def test_2_empty_history(self):
+        """
+        Тест 2 для get_history_page: у пользователя без расходов пустая страница без ключей
+        """
+        self.assertEqual(self.db.get_history_page(8002), ([], None, None))
+
+    def test_3_parse_history_key(self):
+        """
+        Тест 3 для get_history_page: ключ кнопки разбирается обратно, подделанные кнопки отклоняются
+        """
+        markup = app.history_markup(("2024-05-01 10:00:00", 7), None)
+        data = markup.keyboard[0][0].callback_data
+        self.assertEqual(app.parse_history_key(data), ("o", ("2024-05-01 10:00:00", 7)))
+        for data in ("hist:o:2024-05-01|x", "hist:z:2024-05-01|7", "hist:o", "hist", "page:o:d|1", "hist:n:|7"):
+            with self.assertRaises(ValueError, msg=data):
+                app.parse_history_key(data)
+
+
+class TestCaches(unittest.TestCase):
+    """
+    Тесты для кэшей баланса и статистики
+    """
+
+    def test_1_ttl_and_lru(self):
+        """
+        Тест 1 для TTLCache: запись устаревает через ttl, а при переполнении вытесняется самая старая
+        """
+        now = [0.0]
+        cache = TTLCache(maxsize=2, ttl=10, clock=lambda: now[0])
+        self.assertEqual(cache.get_or_load("a", lambda: 1), 1)
+        self.assertEqual(cache.get_or_load("a", lambda: 2), 1, "Второе чтение должно прийти из кэша")
+        cache.get_or_load("b", lambda: 3)
+        cache.get_or_load("c", lambda: 4)
+        self.assertEqual(cache.get_or_load("a", lambda: 5), 5, "Запись a должна быть вытеснена")
+
+        now[0] = 11.0
+        self.assertEqual(cache.get_or_load("a", lambda: 6), 6, "Запись a должна устареть")
+        self.assertEqual(cache.info()["hits"], 1)
+
+    def test_2_writes_invalidate_db_cache(self):
+        """
+        Тест 2 для кэша FinanceDB: повторные чтения идут из кэша, а запись сразу видна при следующем чтении
+        """
+        db = FinanceDB(":memory:")
+        user_id = 9001
+        db.set_balance(user_id, 500.0)
+        db.get_balance(user_id)
+        db.get_balance(user_id)
+        self.assertEqual(db.cache_info()["balance"]["hits"], 1)
+
+        db.add_expense(user_id, "Еда", 100.0)
+        self.assertEqual(db.get_balance(user_id), 400.0, "После траты кэш должен быть сброшен")
+        self.assertEqual(db.get_stats(user_id), {"Еда": 100.0})
+        db.submit("add_expense", user_id, "Еда", 50.0).result()
+        self.assertEqual(db.get_balance(user_id), 350.0)
+        self.assertEqual(db.get_stats(user_id), {"Еда": 150.0})
+
+        db.clear_data(user_id)
+        self.assertIsNone(db.get_balance(user_id))
+        self.assertEqual(db.get_stats(user_id), {})
+
+    def test_3_one_invalidation_per_write(self):
+        """
+        Тест 3 для кэша FinanceDB: запись сбрасывает кэш один раз, и с групповой фиксацией до возврата из метода
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = FinanceDB(os.path.join(tmpdir, "test.db"), group_commit=True)
+            calls = []
+            invalidate = db._invalidate
+            db._invalidate = lambda user_id: (calls.append(user_id), invalidate(user_id))
+            db.set_balance(1, 500)
+            for _ in range(20):
+                db.get_balance(1)
+                db.add_expense(1, "Еда", 1)
+            self.assertEqual(db.get_balance(1), Decimal("480.00"), "Поток, дождавшийся записи, не видит старый баланс")
+            self.assertEqual(calls, [1] * 21)
+            db.close()
+
+
+class FakeAsyncBot:
+    """
+    Подмена AsyncTeleBot: запоминает отправленные сообщения, отвечая со случайной задержкой
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(random.random() / 100)
+        self.sent.append((chat_id, text))
+        return text
+
+
+class TestAsyncRuntime(unittest.TestCase):
+    """
+    Тесты для асинхронного режима - обработчики в пуле потоков, отправка через цикл asyncio
+    """
+
+    def test_1_bridge_keeps_order_per_chat(self):
+        """
+        Тест 1 для AsyncBotBridge: сообщения из потоков уходят в чат в том порядке, в котором их отправили
+        """
+        abot = FakeAsyncBot()
+        bridge = AsyncBotBridge(abot)
+
+        def handler(chat_id):
+            return [bridge.send_message(chat_id, f"{chat_id}:{i}") for i in range(5)]
+
+        async def scenario():
+            bridge.loop = asyncio.get_running_loop()
+            batches = await asyncio.gather(*(asyncio.to_thread(handler, chat_id) for chat_id in range(3)))
+            await asyncio.gather(*(asyncio.wrap_future(f) for batch in batches for f in batch))
+
+        asyncio.run(scenario())
+        for chat_id in range(3):
+            texts = [text for chat, text in abot.sent if chat == chat_id]
+            self.assertEqual(texts, [f"{chat_id}:{i}" for i in range(5)])
+        self.assertEqual(bridge._chat_locks, {}, "Блокировки чатов должны освобождаться")
+
+    @unittest.skipUnless(importlib.util.find_spec("aiohttp"), "нужен aiohttp")
+    def test_2_runtime_copies_handlers(self):
+        """
+        Тест 2 для AsyncRuntime: обработчики синхронного бота переносятся с фильтрами и выполняются в пуле потоков
+        """
+        sync_bot = telebot.TeleBot("123:TEST", threaded=False)
+        calls = []
+
+        @sync_bot.message_handler(func=lambda msg: msg.text == "ping")
+        def ping(message):
+            calls.append((message.text, threading.current_thread().name))
+
+        runtime = AsyncRuntime(sync_bot, workers=2)
+        handlers = runtime.abot.message_handlers
+        self.assertEqual(len(handlers), 1, "Переносятся только обработчики синхронного бота")
+        self.assertEqual(handlers[0]["function"].__name__, "ping")
+
+        async def scenario():
+            runtime.loop = asyncio.get_running_loop()
+            await handlers[0]["function"](SimpleNamespace(text="ping"))
+
+        asyncio.run(scenario())
+        self.assertEqual(calls[0][0], "ping")
+        self.assertTrue(calls[0][1].startswith("handler"), "Обработчик должен выполняться в пуле потоков")
+        runtime.executor.shutdown()
+
+
+def make_update(update_id, user_id, text):
+    """
+    Собирает JSON обновления Telegram с текстовым сообщением
+    """
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Тест"},
+            "text": text,
+        },
+    }
+
+
+class BlockingBot:
+    """
+    Подмена бота для вебхука: запоминает обновления и ждет разрешения на обработку
+    """
+
+    def __init__(self):
+        self.updates = []
+        self.release = threading.Event()
+
+    def process_new_updates(self, updates):
+        self.release.wait(5)
+        self.updates.extend(updates)
+
+
+class TestWebhook(unittest.TestCase):
+    """
+    Тесты для вебхука - проверка секрета, очередь с обратным давлением и проигрывание записанных обновлений
+    """
+
+    def setUp(self):
+        self.bot = BlockingBot()
+        self.server = WebhookServer(self.bot, port=0, secret_token="s3cret", workers=1, queue_size=2).start()
+
+    def tearDown(self):
+        self.bot.release.set()
+        self.server.stop()
+
+    def post(self, update, secret="s3cret"):
+        request = urllib.request.Request(
+            self.server.url, data=json.dumps(update).encode(), headers={SECRET_HEADER: secret}
+        )
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def test_1_secret_and_backpressure(self):
+        """
+        Тест 1 для вебхука: чужой секрет отклоняется, а переполненная очередь отвечает 503
+        """
+        self.assertEqual(self.post(make_update(1, 10, "/start"), secret="wrong"), 401)
+        body = json.dumps(make_update(1, 10, "/start")).encode()
+        self.assertEqual(self.server.accept(body, {SECRET_HEADER: "сéкрет"}), 401, "не-ASCII секрет не роняет проверку")
+
+        self.assertEqual(self.post(make_update(2, 10, "/start")), 200)
+        # Ждем, пока единственный обработчик заберет первое обновление из очереди
+        for _ in range(100):
+            if self.server.queue.empty():
+                break
+            threading.Event().wait(0.01)
+
+        statuses = [self.post(make_update(i, 10, "/start")) for i in range(3, 7)]
+        self.assertEqual(statuses, [200, 200, 503, 503], "Одно обновление в работе и два в очереди")
+
+        self.bot.release.set()
+        self.server.stop()
+        metrics = self.server.snapshot()
+        self.assertEqual(metrics["unauthorized"], 2)
+        self.assertEqual(metrics["rejected"], 2)
+        self.assertEqual(metrics["processed"], 3)
+        self.assertEqual([u.message.text for u in self.bot.updates], ["/start"] * 3)
+        self.server.stop = lambda: None
+
+    def test_2_replay_recorded_updates(self):
+        """
+        Тест 2 для вебхука: записанные обновления проигрываются из файла JSONL, строки без update_id и битые строки пропускаются
+        """
+        self.bot.release.set()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "updates.jsonl")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(json.dumps(make_update(1, 20, "💰 Баланс")) + "\n")
+                f.write(json.dumps({"request_id": "x"}) + "\n")
+                f.write(json.dumps(make_update(2, 20, "💰 Баланс"))[:20] + "\n")
+                f.write(json.dumps(make_update(3, 20, "💰 Баланс")) + "\n")
+            result = replay(path, self.server.url, "s3cret")
+        self.assertEqual(result, {"skipped": 2, 200: 2}, "обрезанная строка не прерывает проигрывание")
+
+
+class TestStateStores(unittest.TestCase):
+    """
+    Тесты для хранилищ состояния диалогов - ограничение по времени и размеру, переживание перезапуска
+    """
+
+    def test_1_memory_ttl_and_cap(self):
+        """
+        Тест 1 для MemoryStateStore: брошенный диалог забывается, а при переполнении вытесняется самый старый
+        """
+        now = [0.0]
+        store = MemoryStateStore(ttl=60, max_size=2, clock=lambda: now[0])
+        store.put(1, {"step": "category"})
+        store.put(2, {"step": "amount", "category": "Еда"})
+        store.put(3, {"step": "balance"})
+        self.assertIsNone(store.get(1), "Самое старое состояние должно быть вытеснено")
+        self.assertEqual(store.get(2), {"step": "amount", "category": "Еда"})
+
+        now[0] = 61.0
+        self.assertEqual(store.purge(), 2)
+        self.assertEqual(len(store), 0)
+
+    def test_2_sqlite_survives_restart(self):
+        """
+        Тест 2 для SQLiteStateStore: состояние читается после повторного открытия базы, устаревшие удаляются
+        """
+        now = [1000.0]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "test.db")
+            db = FinanceDB(path)
+            SQLiteStateStore(db.pool, clock=lambda: now[0]).put(1, {"step": "amount", "category": "Связь"})
+            db.close()
+
+            db = FinanceDB(path)
+            store = SQLiteStateStore(db.pool, ttl=60, max_size=1, clock=lambda: now[0])
+            self.assertEqual(store.get(1), {"step": "amount", "category": "Связь"}, "Состояние должно пережить перезапуск")
+            now[0] = 1030.0
+            store.put(2, {"step": "balance"})
+            now[0] = 1070.0
+            store.put(3, {"step": "category"})
+            self.assertIsNone(store.get(1), "Состояние старше ttl не возвращается")
+            self.assertEqual(store.purge(), 2, "Одна запись устарела, а ещё одна лишняя сверх max_size")
+            self.assertEqual(store.pop(3), {"step": "category"})
+            self.assertIsNone(store.get(3))
+            db.close()
+
+    def test_3_sqlite_reads_from_memory(self):
+        """
+        Тест 3 для SQLiteStateStore: get() и pop() без состояния не обращаются к SQLite, а запись сквозная
+        """
+        def forbidden():
+            raise AssertionError("обращение к SQLite")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = FinanceDB(os.path.join(tmpdir, "test.db"))
+            store = SQLiteStateStore(db.pool)
+            store.put(1, {"step": "amount", "category": "Еда"})
+
+            db.pool.reader = db.pool.writer = forbidden
+            try:
+                self.assertEqual(store.get(1), {"step": "amount", "category": "Еда"})
+                self.assertIsNone(store.get(2))
+                self.assertIsNone(store.pop(2), "Удаление отсутствующего состояния не открывает транзакцию")
+            finally:
+                del db.pool.reader, db.pool.writer
+
+            self.assertEqual(SQLiteStateStore(db.pool).get(1), {"step": "amount", "category": "Еда"}, "Запись доходит до таблицы")
+            self.assertEqual(store.pop(1), {"step": "amount", "category": "Еда"})
+            self.assertIsNone(SQLiteStateStore(db.pool).get(1))
+            db.close()
+
+
+class TestRouter(unittest.TestCase):
+    """
+    Тесты для Router - выбор обработчика по словарям команд и кнопок
+    """
+
+    def message(self, text):
+        return telebot.types.Message.de_json(make_update(1, 5, text)["message"])
+
+    def test_1_resolve_order(self):
+        """
+        Тест 1 для Router: условие first -> команда -> кнопка -> остальные условия -> по умолчанию
+        """
+        router = Router()
+        waiting = set()
+        router.predicate(lambda msg: msg.chat.id in waiting, first=True)(lambda msg: "step")
+        router.command("start")(lambda msg: "start")
+        router.text("💰 Баланс")(lambda msg: "balance")
+        router.predicate(lambda msg: msg.text.isdigit())(lambda msg: "number")
+        router.default(lambda msg: "default")
+
+        self.assertEqual(router.resolve(self.message("/start"))(None), "start")
+        self.assertEqual(router.resolve(self.message("/start@finance_bot"))(None), "start")
+        self.assertEqual(router.resolve(self.message("💰 Баланс"))(None), "balance")
+        self.assertEqual(router.resolve(self.message("42"))(None), "number")
+        self.assertEqual(router.resolve(self.message("/help"))(None), "default")
+        waiting.add(5)
+        self.assertEqual(router.resolve(self.message("💰 Баланс"))(None), "step")
+
+    def test_2_installed_as_single_handler(self):
+        """
+        Тест 2 для Router: в боте регистрируется один обработчик, который вызывает нужную функцию
+        """
+        bot = telebot.TeleBot("0:test", threaded=False)
+        router = Router()
+        calls = []
+        router.text("📊 Статистика")(lambda msg: calls.append(msg.text))
+        router.install(bot)
+        bot.process_new_messages([self.message("📊 Статистика"), self.message("что-то")])
+        self.assertEqual(len(bot.message_handlers), 1)
+        self.assertEqual(calls, ["📊 Статистика"])
+
+
+class TestKeyboards(unittest.TestCase):
+    """
+    Тесты для KeyboardRegistry - клавиатуры строятся и сериализуются один раз
+    """
+
+    def test_1_main_menu_is_prebuilt(self):
+        """
+        Тест 1 для клавиатур: main_menu() возвращает один и тот же объект с тем же JSON, что и обычная клавиатура
+        """
+        markup = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+        markup.add("➕ Добавить расход", "📊 Статистика")
+        markup.add("📅 Месяц", "📈 Средние")
+        markup.add("📋 История", "💰 Баланс")
+        markup.add("🗑️ Очистить все", "ℹ️ Помощь")
+        self.assertIs(app.main_menu(), app.main_menu())
+        self.assertEqual(app.main_menu().to_json(), markup.to_json())
+        self.assertEqual(telebot.apihelper._convert_markup(app.main_menu()), markup.to_json())
+
+    def test_2_duplicate_name(self):
+        """
+        Тест 2 для клавиатур: имя клавиатуры нельзя зарегистрировать дважды
+        """
+        registry = KeyboardRegistry()
+        registry.reply("menu", ("a", "b"))
+        self.assertIn("menu", registry)
+        with self.assertRaises(ValueError):
+            registry.reply("menu", ("c",))
+
+
+class TestOutbox(unittest.TestCase):
+    """
+    Тесты для Outbox - очередь исходящих сообщений на поддельном Bot API
+    """
+
+    def setUp(self):
+        self.api = FakeBotAPI(latency=0.05).__enter__()
+        self.bot = telebot.TeleBot("1:fake", threaded=False)
+
+    def tearDown(self):
+        self.api.__exit__(None, None, None)
+
+    def test_1_coalesce_pending_messages(self):
+        """
+        Тест 1 для Outbox: пока первое сообщение в полете, следующие в тот же чат склеиваются в одно
+        """
+        outbox = Outbox(self.bot, chat_rate=100, chat_burst=10)
+        markup = app.main_menu()
+        futures = [outbox.send(5, "a", reply_markup=markup)]
+        while not self.api.calls:
+            time.sleep(0.001)
+        futures += [outbox.send(5, text, reply_markup=markup) for text in ("b", "c")]
+        futures.append(outbox.send(5, "без клавиатуры"))
+        futures.append(outbox.send(6, "другой чат"))
+        outbox.close(timeout=5)
+
+        texts = [(int(p["chat_id"]), p["text"]) for p in self.api.methods("sendMessage")]
+        self.assertEqual(sorted(texts), [(5, "a"), (5, "b\n\nc"), (5, "без клавиатуры"), (6, "другой чат")])
+        chat5 = [text for chat, text in texts if chat == 5]
+        self.assertEqual(chat5, ["a", "b\n\nc", "без клавиатуры"], "Порядок сообщений в чате сохраняется")
+        self.assertEqual(futures[1].result().message_id, futures[2].result().message_id)
+        self.assertEqual(outbox.snapshot()["coalesced"], 1)
+        self.assertEqual(outbox.snapshot()["delivered"], 5)
+
+    def test_2_retry_after_429(self):
+        """
+        Тест 2 для Outbox: после 429 сообщение повторяется не раньше retry_after
+        """
+        self.api.fail_next("sendMessage", 429, retry_after=1)
+        outbox = Outbox(self.bot)
+        future = outbox.send(5, "привет")
+        self.assertEqual(future.result(timeout=5).text, "привет")
+        outbox.close()
+
+        calls = [call for call in self.api.calls if call.method == "sendMessage"]
+        self.assertEqual(len(calls), 2)
+        self.assertGreaterEqual(calls[1].time - calls[0].time, 1.0)
+        self.assertEqual(outbox.snapshot()["retries"], 1)
+
+    def test_3_token_bucket(self):
+        """
+        Тест 3 для Outbox: token bucket пропускает burst, а дальше не чаще rate
+        """
+        bucket = TokenBucket(rate=2.0, capacity=2, now=0.0)
+        self.assertEqual(bucket.take(0.0), 0.0)
+        self.assertEqual(bucket.take(0.0), 0.0)
+        self.assertAlmostEqual(bucket.take(0.0), 0.5)
+        self.assertEqual(bucket.take(0.5), 0.0)
+        self.assertFalse(bucket.full(0.5))
+        self.assertTrue(bucket.full(10.0))
+
+    def test_4_calls_keep_chat_order(self):
+        """
+        Тест 4 для Outbox: вызовы call() идут в очередь чата по порядку, не склеиваются и повторяются после 429 с начала файла
+        """
+        self.api.fail_next("sendDocument", 429, retry_after=1)
+        outbox = Outbox(self.bot, chat_rate=100, chat_burst=10)
+        outbox.send(5, "a")
+        while not self.api.calls:
+            time.sleep(0.001)
+        outbox.send(5, "b")
+        document = outbox.call(5, "send_document", 5, io.BytesIO(b"data"), visible_file_name="a.csv")
+        outbox.send(5, "c")
+        outbox.send(5, "d")
+        self.assertIsNotNone(document.result(timeout=5).document)
+        outbox.close(timeout=5)
+
+        sent = [
+            call.params.get("text") or call.params["document"]
+            for call in self.api.calls if call.method in ("sendMessage", "sendDocument")
+        ]
+        self.assertEqual(sent, ["a", "b", b"data", b"data", "c\n\nd"])
+        self.assertEqual(outbox.snapshot()["retries"], 1)
+
+    def test_5_close_timeout_keeps_dispatching(self):
+        """
+        Тест 5 для Outbox: после close() с истекшим timeout диспетчер дослает очередь, а не падает на остановленном пуле
+        """
+        outbox = Outbox(self.bot, chat_rate=5, chat_burst=1)
+        futures = [outbox.send(5, f"{i}", reply_markup=app.keyboards["remove"] if i % 2 else None) for i in range(4)]
+        outbox.close(timeout=0.05)
+        self.assertEqual([future.result(timeout=5).text for future in futures], ["0", "1", "2", "3"])
+        outbox._thread.join(timeout=5)
+        self.assertFalse(outbox._thread.is_alive())
+        self.assertEqual(outbox.snapshot()["errors"], 0)
+
+
+class TestImport(unittest.TestCase):
+    """
+    Тесты для import_expenses - потоковый импорт истории расходов с местом остановки
+    """
+
+    def setUp(self):
+        self.db = FinanceDB(":memory:")
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.db.close()
+        self.tmpdir.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        return path
+
+    def test_1_csv_with_invalid_rows(self):
+        """
+        Тест 1 для импорта: корректные строки загружаются, ошибочные отклоняются, суммы и баланс обновляются
+        """
+        self.db.set_balance(1, 1000.0)
+        self.db.get_stats(1)
+        path = self.write("history.csv", (
+            "user_id,category,amount,date\n"
+            "1,Еда,100,2024-01-02 10:00:00\n"
+            "1,🚗 Транспорт,50.5,2024-01-03T08:30:00\n"
+            "1,Казино,10,\n"
+            "2,Еда,-5,\n"
+            "\n"
+            "2,Связь,20,\n"
+        ))
+        result = self.db.import_expenses(path, batch_size=2)
+
+        self.assertEqual((result["imported"], result["rejected"]), (3, 2))
+        self.assertEqual([line for line, _ in result["errors"]], [4, 5])
+        self.assertEqual(self.db.get_stats(1), {"Еда": 100.0, "Транспорт": 50.5})
+        self.assertEqual(self.db.get_balance(1), 849.5)
+        self.assertIsNone(self.db.get_balance(2), "Импорт не создает баланс")
+        self.assertEqual(self.db.verify_category_totals(), [])
+        self.assertEqual(self.db.get_history(1)[-1][2], "2024-01-02 10:00:00")
+
+    def test_2_resume_after_interruption(self):
+        """
+        Тест 2 для импорта: прерванный импорт продолжается с места остановки, законченный не повторяется
+        """
+        lines = [json.dumps({"user_id": 7, "category": "Еда", "amount": i + 1}) for i in range(10)]
+        path = self.write("history.jsonl", "\n".join(lines) + "\n")
+
+        def interrupt(result):
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            self.db.import_expenses(path, batch_size=4, progress=interrupt)
+        self.assertEqual(self.db.get_stats(7), {"Еда": 10.0})
+
+        result = self.db.import_expenses(path, batch_size=4)
+        self.assertEqual(result["imported"], 10)
+        self.assertTrue(result["done"])
+        self.assertEqual(self.db.get_stats(7), {"Еда": 55.0})
+
+        self.db.import_expenses(path)
+        self.assertEqual(self.db.get_stats(7), {"Еда": 55.0}, "Повторный импорт ничего не добавляет")
+
+    def test_3_oversized_amount_is_a_row_error(self):
+        """
+        Тест 3 для импорта: сумма или user_id вне INTEGER отклоняют только свою строку
+        """
+        self.db.set_balance(1, 1000)
+        path = self.write("big.csv", (
+            "user_id,category,amount\n"
+            "1,Еда,10\n"
+            "1,Еда,1e30\n"
+            "1,Еда,92233720368547758.08\n"
+            "99999999999999999999,Еда,1\n"
+            "1,Еда,20\n"
+        ))
+        result = self.db.import_expenses(path, batch_size=10)
+        self.assertEqual((result["imported"], result["rejected"]), (2, 3))
+        self.assertEqual([line for line, _ in result["errors"]], [3, 4, 5])
+        self.assertEqual(self.db.get_stats(1), {"Еда": Decimal("30.00")})
+
+
+class TestExport(unittest.TestCase):
+    """
+    Тесты для выгрузки истории расходов - перебор по ключу и отправка документом
+    """
+
+    def setUp(self):
+        self.db = FinanceDB(":memory:")
+        self.db.set_balance(1, 10000.0)
+        for i in range(10):
+            self.db.add_expense(1, "Еда", float(i + 1))
+        self.db.add_expense(2, "Связь", 1.0)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_1_iter_and_spool(self):
+        """
+        Тест 1 для выгрузки: iter_expenses отдает все расходы по порядку через границы кусков, большой CSV уходит на диск
+        """
+        rows = list(self.db.iter_expenses(1, chunk_size=3))
+        self.assertEqual([amount for _, _, amount in rows], [float(i + 1) for i in range(10)])
+
+        f, count = write_csv(self.db.iter_expenses(1, chunk_size=3), spool_size=64)
+        with f:
+            self.assertEqual(count, 10)
+            self.assertTrue(f._rolled, "Файл больше spool_size переносится на диск")
+            lines = list(csv.reader(f.read().decode("utf-8-sig").splitlines()))
+        self.assertEqual(lines[0], ["date", "category", "amount"])
+        self.assertEqual(lines[-1][1:], ["Еда", "10.00"])
+
+    def test_2_send_document(self):
+        """
+        Тест 2 для выгрузки: файл отправляется документом с именем expenses_<дата>.csv после уведомления, пустая история не отправляется
+        """
+        with FakeBotAPI() as api:
+            outbox = Outbox(telebot.TeleBot("1:fake", threaded=False))
+            exporter = Exporter(outbox, self.db)
+            self.assertEqual(exporter.submit(5, 1, notice="готовлю").result(timeout=5), 10)
+            self.assertEqual(exporter.submit(5, 3).result(timeout=5), 0)
+            exporter.close()
+            outbox.close()
+
+        self.assertEqual([call.method for call in api.calls], ["sendMessage", "sendDocument"], "Уведомление приходит раньше файла")
+        calls = [call for call in api.calls if call.method == "sendDocument"]
+        self.assertEqual(len(calls), 1)
+        self.assertRegex(calls[0].files["document"], r"^expenses_\d{4}-\d{2}-\d{2}\.csv$")
+        self.assertEqual(calls[0].params["document"].decode("utf-8-sig").count("\n"), 11)
+
+
+class TestAnalytics(unittest.TestCase):
+    """
+    Тесты для аналитики - суммы по дням, неделям и месяцам в expense_buckets
+    """
+
+    def setUp(self):
+        self.db = FinanceDB(":memory:")
+        self.tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmpdir.name, "history.csv")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(
+                "user_id,category,amount,date\n"
+                "1,Еда,100,2024-01-31 23:00:00\n"
+                "1,Еда,30,2024-02-10 12:00:00\n"
+                "1,Связь,20,2024-02-11 12:00:00\n"
+                "1,Еда,60,2024-03-11 09:00:00\n"
+                "1,Еда,40,2024-03-15 18:00:00\n"
+                "1,Транспорт,14,2024-03-15 19:00:00\n"
+            )
+        self.db.import_expenses(path, batch_size=4)
+
+    def tearDown(self):
+        self.db.close()
+        self.tmpdir.cleanup()
+
+    def test_1_month_comparison_and_averages(self):
+        """
+        Тест 1 для аналитики: сравнение месяцев и скользящие средние по дням, неделям и месяцам
+        """
+        today = datetime.date(2024, 3, 15)
+        self.assertEqual(
+            compare_months(self.db, 1, today),
+            {"Еда": (100.0, 30.0), "Связь": (0.0, 20.0), "Транспорт": (14.0, 0.0)},
+        )
+        self.assertEqual(rolling_average(self.db, 1, "d", 7, today), {"Еда": Decimal("14.29"), "Транспорт": 2})
+        self.assertEqual(rolling_average(self.db, 1, "w", 1, today), {"Еда": 100.0, "Транспорт": 14.0})
+        self.assertEqual(rolling_average(self.db, 1, "m", 3, today), {"Еда": Decimal("76.67"), "Связь": Decimal("6.67"), "Транспорт": Decimal("4.67")})
+        self.assertEqual(
+            monthly_totals(self.db, 1, 4, today),
+            [("2023-12-01", 0.0), ("2024-01-01", 100.0), ("2024-02-01", 50.0), ("2024-03-01", 114.0)],
+        )
+
+        self.db.set_balance(1, 1000.0)
+        self.db.add_expense(1, "Одежда", 70.0)
+        self.assertEqual(rolling_average(self.db, 1, "d", 7)["Одежда"], 10.0, "add_expense пополняет периоды сегодняшнего дня")
+
+    def test_2_backfill_matches_incremental(self):
+        """
+        Тест 2 для аналитики: заполнение миграцией совпадает с тем, что накоплено при записи расходов
+        """
+        query = "SELECT * FROM expense_buckets ORDER BY user_id, period, start, category"
+        self.db.cursor.execute(query)
+        incremental = self.db.cursor.fetchall()
+        self.assertEqual(len([row for row in incremental if row[1] == "w"]), 5)
+
+        backfill = dict((version, apply) for version, _, apply in MIGRATIONS)[7]
+        with self.db.pool.writer() as cursor:
+            backfill(cursor)
+        self.db.cursor.execute(query)
+        self.assertEqual(self.db.cursor.fetchall(), incremental)
+
+
+def fake_render(stats, months):
+    """
+    Заменяет render_chart в тестах: matplotlib не нужен, а результат зависит от данных
+    """
+    return b"\x89PNG" + json.dumps([sorted(stats.items()), months]).encode("utf-8")
+
+
+class TestMoney(unittest.TestCase):
+    """
+    Тесты для сумм в копейках - разбор ввода, перевод старой базы и сверка балансов
+    """
+
+    def test_1_parse_and_convert(self):
+        """
+        Тест 1 для сумм: ввод с запятой и пробелами, точные копейки без ошибок float
+        """
+        self.assertEqual(parse_money("1 500,5"), Decimal("1500.50"))
+        self.assertEqual(to_kopecks(0.1), 10)
+        self.assertEqual(to_kopecks("2.675"), 268)
+        for text in ("abc", "nan", "1.005", "", "1e27", "92233720368547758.08"):
+            with self.assertRaises(ValueError):
+                parse_money(text)
+        self.assertEqual(parse_money("92233720368547758.07").scaleb(2), MAX_KOPECKS)
+        for value in ("1e30", "1e999999", Decimal("-1e17")):
+            with self.assertRaises(ValueError, msg="Сумма вне INTEGER SQLite - ValueError, а не InvalidOperation"):
+                to_kopecks(value)
+
+        db = FinanceDB(":memory:")
+        db.set_balance(1, "0.30")
+        for _ in range(3):
+            db.add_expense(1, "Еда", 0.1)
+        self.assertEqual(db.get_balance(1), Decimal("0"), "0.3 - 3 * 0.1 ровно 0")
+        self.assertEqual(db.get_stats(1), {"Еда": Decimal("0.30")})
+        self.assertEqual(db.reconcile(), [])
+        db.close()
+
+    def test_2_migrate_real_amounts_and_reconcile(self):
+        """
+        Тест 2 для сумм: старая база с REAL переводится в копейки, а reconcile находит испорченный баланс
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "old.db")
+            conn = sqlite3.connect(path)
+            conn.execute("CREATE TABLE users (user_id INTEGER PRIMARY KEY, balance REAL DEFAULT 0)")
+            conn.execute("""CREATE TABLE expenses (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER,
+                         category TEXT, amount REAL, date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+            conn.execute("INSERT INTO users VALUES (7, 99.7)")
+            conn.executemany("INSERT INTO expenses (user_id, category, amount) VALUES (7, ?, ?)",
+                             [("Еда", 0.1), ("Еда", 0.2)])
+            conn.commit()
+            conn.close()
+
+            db = FinanceDB(path)
+            db.cursor.execute("SELECT balance, initial_balance FROM users")
+            self.assertEqual(db.cursor.fetchall(), [(9970, 10000)])
+            self.assertEqual(db.get_stats(7), {"Еда": Decimal("0.30")})
+            self.assertEqual(db.reconcile(), [])
+
+            db.cursor.execute("UPDATE users SET balance = 9900 WHERE user_id=7")
+            self.assertEqual(db.reconcile(7), [(7, Decimal("99.00"), Decimal("100.00"), Decimal("0.30"), Decimal("99.70"))])
+            db.close()
+
+
+class TestCurrencies(unittest.TestCase):
+    """
+    Тесты для валют - суммы переводятся в базовую валюту пользователя по таблице курсов при чтении
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.rates = os.path.join(self.tmpdir.name, "rates.json")
+        self.write_rates(USD=90, EUR=100)
+        self.db = FinanceDB(":memory:")
+        self.db.load_rates(self.rates)
+
+    def tearDown(self):
+        self.db.close()
+        self.tmpdir.cleanup()
+
+    def write_rates(self, **rates):
+        with open(self.rates, "w", encoding="utf-8") as f:
+            json.dump({"base": "RUB", "rates": rates}, f)
+
+    def test_1_convert_on_read_and_reload(self):
+        """
+        Тест 1 для валют: статистика и история в базовой валюте, новые курсы меняют статистику, но не баланс
+        """
+        self.assertEqual(split_currency("10 usd"), ("10", "USD"))
+        self.assertEqual(split_currency("9,5€"), ("9,5", "EUR"))
+        self.assertEqual(split_currency("1 500"), ("1 500", None))
+
+        self.db.set_balance(1, 10000)
+        self.db.add_expense(1, "Еда", 100)
+        self.assertEqual(self.db.add_expense_atomic(1, "Еда", 10, "USD"), Decimal("9000.00"))
+        self.db.add_expense(1, "Связь", 1, "EUR")
+        self.assertFalse(self.db.add_expense(1, "Еда", 1, "GBP"), "курса GBP нет")
+        self.assertEqual(self.db.get_stats(1), {"Еда": Decimal("1000.00"), "Связь": Decimal("100.00")})
+        self.assertEqual([row[:2] for row in self.db.get_history(1)],
+                         [("Связь", Decimal("100.00")), ("Еда", Decimal("900.00")), ("Еда", Decimal("100.00"))])
+        self.assertEqual(len(self.db.check_query_plans()), len(HOT_QUERIES), "соединение с курсами идет по ключам")
+
+        self.write_rates(USD=100, EUR=100)
+        self.db.load_rates(self.rates)
+        self.assertEqual(self.db.get_stats(1)["Еда"], Decimal("1100.00"))
+        self.assertEqual(self.db.get_balance(1), Decimal("8900.00"), "баланс списан по курсу на момент записи")
+        self.assertEqual(self.db.reconcile(), [])
+
+        self.write_rates(USD=100)
+        with self.assertRaises(ValueError):
+            self.db.load_rates(self.rates)
+        self.assertEqual(self.db.rate("EUR"), 100.0, "неполный файл курсов не применяется")
+
+    def test_2_base_currency_and_import(self):
+        """
+        Тест 2 для валют: пользователь с базовой валютой USD видит суммы в долларах, импорт проверяет валюту
+        """
+        self.db.set_balance(2, 100, "USD")
+        self.db.add_expense(2, "Еда", 9)
+        self.db.add_expense(2, "Еда", 900, "RUB")
+        self.assertEqual(self.db.get_stats(2), {"Еда": Decimal("19.00")})
+        self.assertEqual(self.db.get_balance(2), Decimal("81.00"))
+
+        path = os.path.join(self.tmpdir.name, "history.jsonl")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write('{"user_id": 2, "category": "Связь", "amount": 5, "currency": "eur"}\n')
+            f.write('{"user_id": 2, "category": "Связь", "amount": 5, "currency": "GBP"}\n')
+        result = self.db.import_expenses(path)
+        self.assertEqual((result["imported"], result["rejected"]), (1, 1))
+        self.assertEqual(self.db.get_stats(2)["Связь"], Decimal("5.56"))
+        self.assertEqual(self.db.get_balance(2), Decimal("75.44"))
+        self.assertEqual(self.db.reconcile(), [])
+
+
+class TestShards(unittest.TestCase):
+    """
+    Тесты для ShardedFinanceDB - пользователи делятся между файлами SQLite по хэшу user_id
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "finance.db")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def fill(self, db, users):
+        for user_id in users:
+            db.set_balance(user_id, 1000)
+            db.add_expense(user_id, "Еда", user_id)
+            db.add_expense(user_id, "Связь", 1.5)
+
+    def test_1_routing_and_cross_shard_queries(self):
+        """
+        Тест 1 для шардов: данные пользователя лежат в его шарде, сверки и сводка собираются со всех шардов
+        """
+        db = ShardedFinanceDB(self.path, 3)
+        users = range(1, 31)
+        self.fill(db, users)
+        self.assertEqual(db.paths, [os.path.join(self.tmpdir.name, f"finance.{index}.db") for index in range(3)])
+        self.assertTrue(all(os.path.exists(path) for path in db.paths))
+        self.assertEqual({shard_for(user_id, 3) for user_id in users}, {0, 1, 2})
+        for index, shard in enumerate(db.shards):
+            shard.cursor.execute("SELECT user_id FROM users")
+            self.assertTrue(all(shard_for(row[0], 3) == index for row in shard.cursor.fetchall()))
+
+        self.assertEqual(db.get_stats(7), {"Еда": Decimal("7.00"), "Связь": Decimal("1.50")})
+        self.assertEqual(db.get_balance(7), Decimal("991.50"))
+        self.assertEqual(len(db.get_history(7)), 2)
+        self.assertEqual(db.submit("add_expense", 7, "Еда", 1).result(), Decimal("990.50"))
+        self.assertEqual(db.reconcile(), [])
+        self.assertEqual(db.verify_category_totals(), [])
+        self.assertEqual(db.category_summary(), {"Еда": (Decimal(sum(users) + 1), 31, 30), "Связь": (Decimal("45.00"), 30, 30)})
+        self.assertEqual(monthly_totals(db, 7, 1)[0][1], Decimal("9.50"), "аналитика читает шард пользователя")
+        self.assertTrue(db.clear_data(7))
+        self.assertIsNone(db.get_balance(7))
+        db.close()
+
+    def test_2_reshard(self):
+        """
+        Тест 2 для шардов: перенос из одной базы в 4 шарда сохраняет балансы, суммы и порядок истории
+        """
+        db = FinanceDB(self.path)
+        self.fill(db, range(1, 21))
+        history = db.get_history(5)
+        db.close()
+
+        target = os.path.join(self.tmpdir.name, "new", "finance.db")
+        os.mkdir(os.path.dirname(target))
+        self.assertEqual(sum(reshard([self.path], target, 4)), 20)
+        with self.assertRaises(ValueError):
+            reshard([self.path], target, 4)
+
+        sharded = ShardedFinanceDB(target, 4)
+        self.assertEqual(sharded.get_history(5), history)
+        self.assertEqual(sharded.get_balance(20), Decimal("978.50"))
+        self.assertEqual(sharded.reconcile(), [])
+        self.assertEqual(sharded.verify_category_totals(), [])
+        self.assertEqual(sharded.rate("RUB"), 1.0)
+        sharded.close()
+
+    def test_3_state_follows_shard(self):
+        """
+        Тест 3 для шардов: состояние диалога лежит в шарде пользователя и находится после reshard()
+        """
+        db = ShardedFinanceDB(self.path, 2)
+        store = ShardedStateStore([SQLiteStateStore(shard.pool) for shard in db.shards])
+        users = range(1, 11)
+        for user_id in users:
+            db.set_balance(user_id, 1000)
+            store.put(user_id, {"step": "amount", "category": str(user_id)})
+        for index, shard in enumerate(db.shards):
+            shard.cursor.execute("SELECT user_id FROM conversation_state")
+            self.assertTrue(all(shard_for(row[0], 2) == index for row in shard.cursor.fetchall()))
+        self.assertEqual(len(store), 10)
+        db.close()
+
+        target = os.path.join(self.tmpdir.name, "new", "finance.db")
+        os.mkdir(os.path.dirname(target))
+        reshard(db.paths, target, 3)
+        db = ShardedFinanceDB(target, 3)
+        store = ShardedStateStore([SQLiteStateStore(shard.pool) for shard in db.shards])
+        self.assertEqual([store.get(user_id)["category"] for user_id in users], [str(user_id) for user_id in users])
+        self.assertEqual(store.pop(7), {"step": "amount", "category": "7"})
+        self.assertIsNone(store.get(7))
+        db.close()
+
+
+class TestCharts(unittest.TestCase):
+    """
+    Тесты для ChartRenderer - кэш картинок и повторное использование file_id
+    """
+
+    def test_1_reuse_file_id(self):
+        """
+        Тест 1 для графиков: те же данные не рисуются и не загружаются второй раз, новые данные рисуются заново
+        """
+        with FakeBotAPI() as api:
+            outbox = Outbox(telebot.TeleBot("1:fake", threaded=False), chat_rate=100)
+            charts = ChartRenderer(outbox, render=fake_render)
+            months = [("2024-01-01", 10.0)]
+            first = charts.submit(5, 1, {"Еда": 10.0}, months).result(timeout=10)
+            second = charts.submit(5, 1, {"Еда": 10.0}, months).result(timeout=10)
+            charts.submit(5, 1, {"Еда": 25.0}, months).result(timeout=10)
+            charts.close()
+            outbox.close()
+
+        calls = [call for call in api.calls if call.method == "sendPhoto"]
+        self.assertEqual(charts.renders, 2)
+        self.assertEqual([bool(call.files) for call in calls], [True, False, True])
+        self.assertTrue(calls[0].params["photo"].startswith(b"\x89PNG"))
+        self.assertEqual(calls[1].params["photo"], first.photo[-1].file_id)
+        self.assertEqual(second.photo[-1].file_id, first.photo[-1].file_id)
+
+    def test_2_pool_is_not_forked(self):
+        """
+        Тест 2 для графиков: пул рисования не запускается через fork из процесса с работающими потоками
+        """
+        self.assertIn(pool_context().get_start_method(), ("forkserver", "spawn"))
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Тесты для замеров - гистограммы с выборкой, хендлеры через Router, методы FinanceDB, SQL и /metrics
+    """
+
+    def test_1_sampling_and_prometheus_text(self):
+        """
+        Тест 1 для замеров: счетчики точные, в гистограмму попадает только выборка, ошибки хендлера считаются
+        """
+        rolls = iter([0.1, 0.9, 0.1])
+        metrics = Metrics(buckets=(0.5, 1.0), sample_rate=0.5, rng=lambda: next(rolls))
+        router = Router(metrics=metrics)
+
+        @router.text("ok")
+        def ok(message):
+            pass
+
+        @router.text("boom")
+        def boom(message):
+            raise ValueError("boom")
+
+        router.dispatch(SimpleNamespace(text="ok"))
+        router.dispatch(SimpleNamespace(text="ok"))
+        with self.assertRaises(ValueError):
+            router.dispatch(SimpleNamespace(text="boom"))
+
+        handlers = metrics.snapshot()["handler"]
+        self.assertEqual((handlers["ok"]["calls"], handlers["ok"]["count"]), (2, 1), "Второй вызов не попал в выборку")
+        self.assertEqual((handlers["boom"]["calls"], handlers["boom"]["errors"]), (1, 1))
+        text = metrics.render()
+        self.assertIn('finance_handler_seconds_bucket{handler="ok",le="+Inf"} 1', text)
+        self.assertIn('finance_handler_calls_total{handler="ok"} 2', text)
+        self.assertIn('finance_handler_errors_total{handler="boom"} 1', text)
+
+    def test_2_finance_db_queries_and_endpoint(self):
+        """
+        Тест 2 для замеров: методы FinanceDB и их SQL попадают в общий реестр, медленные запросы пишутся в журнал, /metrics отдает текст Prometheus
+        """
+        db = FinanceDB(":memory:")
+        db.set_balance(1, 100)
+        before = registry.snapshot()["db"].get("get_stats", {}).get("calls", 0)
+        saved = registry.slow_query
+        registry.slow_query = 0.0
+        try:
+            with self.assertLogs("finance_metrics", "WARNING") as logs:
+                db.get_stats(1)
+        finally:
+            registry.slow_query = saved
+            db.close()
+
+        self.assertTrue(any("Медленный запрос" in line and "SELECT" in line for line in logs.output))
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot["db"]["get_stats"]["calls"], before + 1)
+        self.assertTrue(any(query.startswith("SELECT") for query in snapshot["query"]))
+
+        server = MetricsServer(registry, port=0).start()
+        try:
+            with urllib.request.urlopen(server.url) as response:
+                text = response.read().decode("utf-8")
+                content_type = response.headers["Content-Type"]
+        finally:
+            server.stop()
+        self.assertTrue(content_type.startswith("text/plain; version=0.0.4"))
+        self.assertIn('finance_db_calls_total{method="get_stats"}', text)
+        self.assertIn("# TYPE finance_query_seconds histogram", text)
+
+
+class TestApp(unittest.TestCase):
+    """
+    Тесты для фабрики приложения - импорт модуля ничего не открывает, экземпляры в памяти независимы
+    """
+
+    def test_1_lazy_import(self):
+        """
+        Тест 1 для фабрики: импорт не создает finance.db, первое обращение к db собирает приложение по FINANCE_DB
+        """
+        code = (
+            "import proekt_onlycod_documentation as m\n"
+            "assert m.application is None\n"
+            "m.db.set_balance(1, 5)\n"
+            "print(type(m.bot).__name__, m.application.config.db_path)\n"
+            "m.application.close()\n"
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "lazy.db")
+            env = dict(os.environ, FINANCE_DB=path, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+            result = subprocess.run([sys.executable, "-c", code], cwd=tmpdir, env=env, capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertEqual(result.stdout.split(), ["TeleBot", path])
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, "finance.db")))
+
+    def test_2_isolated_instances(self):
+        """
+        Тест 2 для фабрики: у каждого приложения свои бот, база и хендлеры
+        """
+        config = app.AppConfig(token="1:fake", db_path=":memory:", threaded=False)
+        first, second = app.create_app(config), app.create_app(config)
+        try:
+            first.db.set_balance(1, 10)
+            self.assertIsNone(second.db.get_balance(1))
+            self.assertIsNot(first.bot, second.bot)
+            self.assertEqual(len(second.bot.message_handlers), 1, "Router ставится одним хендлером")
+            self.assertEqual(len(second.bot.callback_query_handlers), 1)
+        finally:
+            first.close()
+            second.close()
+
+    def test_3_handlers_use_own_app(self):
+        """
+        Тест 3 для фабрики: обновление, пришедшее боту одного приложения, меняет только его состояние и очередь, даже без текущего приложения
+        """
+        config = app.AppConfig(token="1:fake", db_path=":memory:", threaded=False, global_rate=1000, chat_rate=1000)
+        apps = [app.create_app(config), app.create_app(config)]
+        replies = [[], []]
+        for instance, sent in zip(apps, replies):
+            instance.bot.send_message = lambda chat_id, text, sent=sent, **kwargs: sent.append(text)
+        previous = app.activate(None)
+        try:
+            first, second = apps
+            second.bot.process_new_updates([telebot.types.Update.de_json(make_update(1, 77, "/start"))])
+            self.assertTrue(second.sender.flush(timeout=5))
+            self.assertIn("Введите начальный баланс", replies[1][-1])
+            self.assertEqual(second.user_state.get(77), {"step": "balance"})
+            self.assertEqual((replies[0], first.user_state.get(77)), ([], None))
+
+            first.bot.process_new_updates([telebot.types.Update.de_json(make_update(2, 77, "500"))])
+            second.bot.process_new_updates([telebot.types.Update.de_json(make_update(3, 77, "1000"))])
+            self.assertTrue(first.sender.flush(timeout=5) and second.sender.flush(timeout=5))
+            self.assertEqual(replies[0], ["Используйте кнопки меню или /start"], "у первого приложения нет диалога")
+            self.assertIn("1000.00 установлен", replies[1][-1])
+            self.assertEqual((first.db.get_balance(77), second.db.get_balance(77)), (None, Decimal("1000.00")))
+            self.assertIsNone(app.application, "хендлеры не создают приложение по умолчанию")
+        finally:
+            app.activate(previous)
+            for instance in apps:
+                instance.close()
+
+
+class TestBudgets(unittest.TestCase):
+    """
+    Тесты для месячных бюджетов - трата сама ведет сумму за месяц и предупреждает о порогах 80% и 100%
+    """
+
+    def setUp(self):
+        self.db = FinanceDB(":memory:")
+        self.db.set_balance(1, 100000)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_1_alerts_once_per_threshold(self):
+        """
+        Тест 1 для бюджетов: каждый порог предупреждается один раз, уже потраченное учитывается при установке
+        """
+        self.db.add_expense(1, "Еда", 1000)
+        self.assertTrue(self.db.set_budget(1, "Еда", 5000))
+        self.assertEqual(self.db.get_budgets(1), {"Еда": (Decimal("5000.00"), Decimal("1000.00"))})
+
+        self.assertEqual(self.db.spend(1, "Еда", 2000), (Decimal("97000.00"), None))
+        self.assertEqual(self.db.spend(1, "Еда", 1000)[1], (80, Decimal("4000.00"), Decimal("5000.00")))
+        self.assertIsNone(self.db.spend(1, "Еда", 500)[1], "80% уже предупреждали")
+        self.assertEqual(self.db.spend(1, "Еда", 1000)[1], (100, Decimal("5500.00"), Decimal("5000.00")))
+        self.assertIsNone(self.db.spend(1, "Еда", 100)[1])
+        self.assertIsNone(self.db.spend(1, "Связь", 100)[1], "у категории нет бюджета")
+        self.assertIsNone(self.db.spend(1, "Еда", 100000), "средств не хватает")
+
+        self.assertTrue(self.db.set_budget(1, "Еда", 10000))
+        self.assertEqual(self.db.spend(1, "Еда", 2400)[1][0], 80, "новый лимит снова проверяет пороги")
+        self.assertTrue(self.db.set_budget(1, "Еда", 0))
+        self.assertEqual(self.db.get_budgets(1), {})
+        self.assertEqual(self.db.reconcile(), [])
+
+    def test_2_lazy_month_rollover(self):
+        """
+        Тест 2 для бюджетов: бюджет за прошлый месяц обнуляется первой тратой нового месяца, импорт текущего месяца учитывается
+        """
+        self.db.set_budget(1, "Еда", 1000)
+        self.db.add_expense(1, "Еда", 900)
+        with self.db.pool.writer() as cursor:
+            cursor.execute("UPDATE budgets SET month = '2000-01-01'")
+        self.assertEqual(self.db.get_budgets(1)["Еда"][1], 0, "прошлый месяц при чтении не виден")
+
+        self.assertEqual(self.db.spend(1, "Еда", 100)[1], None)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "history.jsonl")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write('{"user_id": 1, "category": "Еда", "amount": 650}\n')
+                f.write('{"user_id": 1, "category": "Еда", "amount": 5000, "date": "2001-01-01"}\n')
+            self.assertEqual(self.db.import_expenses(path)["imported"], 2)
+        self.assertEqual(self.db.get_budgets(1)["Еда"], (Decimal("1000.00"), Decimal("750.00")))
+        self.assertEqual(self.db.spend(1, "Еда", 50)[1], (80, Decimal("800.00"), Decimal("1000.00")))
+
+        self.db.clear_data(1)
+        self.assertEqual(self.db.get_budgets(1), {})
+
+
+class TestConversationFlow(unittest.TestCase):
+    """
+    Тесты для многошагового диалога бота - шаги хранятся в user_state, а не в next_step_handler
+    """
+
+    def setUp(self):
+        config = app.AppConfig(token="1:fake", db_path=":memory:", threaded=False, global_rate=1000, chat_rate=1000)
+        self.app = app.create_app(config)
+        self.replies = []
+        self.app.bot.send_message = lambda chat_id, text, **kwargs: self.replies.append(text)
+
+    def tearDown(self):
+        self.app.close()
+
+    def send(self, text, update_id=[0]):
+        update_id[0] += 1
+        self.app.bot.process_new_updates([telebot.types.Update.de_json(make_update(update_id[0], 77, text))])
+        self.assertTrue(self.app.sender.flush(timeout=5))
+        return self.replies[-1]
+
+    def test_1_balance_and_expense_flow(self):
+        """
+        Тест 1 для диалога: /start -> ввод баланса с ошибкой и повтором -> категория -> сумма
+        """
+        self.assertIn("Введите начальный баланс", self.send("/start"))
+        self.assertIn("больше 0", self.send("-5"))
+        self.assertIn("1000.00 установлен", self.send("1000"))
+        self.assertIsNone(self.app.user_state.get(77), "После ввода баланса шаг должен закончиться")
+
+        self.send("➕ Добавить расход")
+        self.assertIn("Введите сумму", self.send("🍔 Еда"))
+        self.assertIn("Остаток: 750.00", self.send("250"))
+        self.assertEqual(self.app.db.get_stats(77), {"Еда": 250.0})
+        self.assertIsNone(self.app.user_state.get(77))
+
+    def test_2_budget_command(self):
+        """
+        Тест 2 для диалога: /budget устанавливает бюджет, трата сверх 80% приходит с предупреждением
+        """
+        self.send("/start")
+        self.send("1000")
+        self.assertIn("Формат", self.send("/budget Хлеб 100"))
+        self.assertIn("Еда: 0.00 из 300.00 (0%)", self.send("/budget еда 300"))
+        self.send("➕ Добавить расход")
+        self.send("🍔 Еда")
+        self.assertIn("Потрачено 80% бюджета «Еда»: 250.00 из 300.00", self.send("250"))
+        self.assertIn("Бюджетов нет", self.send("/budget Еда 0"))
+        self.assertIn("Слишком большая сумма", self.send("/budget Еда 1e30"), "На огромный лимит бот отвечает ошибкой")
+        self.assertEqual(self.app.db.get_budgets(77), {})
+
+    def test_3_forged_history_button(self):
+        """
+        Тест 3 для диалога: на подделанную кнопку истории бот отвечает ошибкой, а не падает без ответа
+        """
+        answers = []
+        self.app.bot.answer_callback_query = lambda call_id, text=None, **kwargs: answers.append((call_id, text))
+        update = {
+            "update_id": 1000,
+            "callback_query": {
+                "id": "cb1", "from": {"id": 77, "is_bot": False, "first_name": "T"}, "chat_instance": "1",
+                "data": "hist:o:2024-05-01|not-a-number",
+                "message": {"message_id": 5, "date": 0, "chat": {"id": 77, "type": "private"}, "text": "x"},
+            },
+        }
+        self.app.bot.process_new_updates([telebot.types.Update.de_json(update)])
+        self.assertTrue(self.app.sender.flush(timeout=5))
+        self.assertEqual(answers, [("cb1", "❌ Кнопка устарела")])
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
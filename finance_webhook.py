@@ -0,0 +1,322 @@
+"""Прием обновлений Telegram через вебхук.
+
+Встроенный HTTP-сервер принимает JSON обновлений, проверяет секретный
+токен из заголовка ``X-Telegram-Bot-Api-Secret-Token`` и кладет
+обновления в ограниченную очередь. Пул потоков разбирает очередь и
+передает обновления обычным обработчикам бота. Когда очередь заполнена,
+сервер отвечает 503, и Telegram повторит доставку позже.
+
+Счетчики доступны по ``GET /metrics`` в виде JSON.
+
+Записанные обновления можно проиграть на локальный сервер без сети::
+
+    python finance_webhook.py replay updates.jsonl \\
+        --url http://127.0.0.1:8443/webhook --secret SECRET
+"""
+import argparse
+import hmac
+import json
+import logging
+import queue
+import sys
+import threading
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot import types
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+"""
+Заголовок, в котором Telegram передает секретный токен вебхука
+
+:type: str
+"""
+
+_STOP = object()
+
+
+class WebhookServer:
+    """HTTP-сервер вебхука с очередью обновлений и пулом обработчиков.
+
+    Бот должен быть создан с ``threaded=False``: тогда обработчики
+    выполняются прямо в потоках пула сервера, и размер очереди
+    действительно ограничивает количество необработанных обновлений.
+
+    :ivar metrics: Счетчики сервера: received, accepted, rejected,
+        unauthorized, bad_request, processed, errors, max_depth
+    :vartype metrics: dict[str, int]
+    """
+
+    def __init__(
+        self,
+        bot,
+        host="127.0.0.1",
+        port=8443,
+        path="/webhook",
+        secret_token=None,
+        workers=8,
+        queue_size=1000,
+    ):
+        """
+        :param bot: Бот, чьи обработчики получают обновления
+        :type bot: telebot.TeleBot
+        :param host: Адрес, на котором слушает сервер
+        :type host: str
+        :param port: Порт сервера, 0 - выбрать свободный
+        :type port: int
+        :param path: Путь вебхука
+        :type path: str
+        :param secret_token: Секретный токен вебхука, None - не проверять
+        :type secret_token: str или None
+        :param workers: Количество потоков-обработчиков
+        :type workers: int
+        :param queue_size: Максимальная длина очереди обновлений
+        :type queue_size: int
+        """
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.metrics = dict.fromkeys(
+            [
+                "received",
+                "accepted",
+                "rejected",
+                "unauthorized",
+                "bad_request",
+                "processed",
+                "errors",
+                "max_depth",
+            ],
+            0,
+        )
+        self._lock = threading.Lock()
+        self._workers = [
+            threading.Thread(
+                target=self._work, name=f"webhook-{i}", daemon=True
+            )
+            for i in range(workers)
+        ]
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self._serving = None
+
+    @property
+    def url(self):
+        """Полный адрес вебхука на этом сервере.
+
+        :rtype: str
+        """
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}{self.path}"
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self.metrics[name] += value
+
+    def snapshot(self):
+        """Возвращает копию счетчиков и текущую длину очереди.
+
+        :return: Счетчики сервера и depth - длина очереди
+        :rtype: dict[str, int]
+        """
+        with self._lock:
+            result = dict(self.metrics)
+        result["depth"] = self.queue.qsize()
+        return result
+
+    def accept(self, body, headers):
+        """Проверяет и ставит в очередь одно обновление.
+
+        :param body: Тело запроса
+        :type body: bytes
+        :param headers: Заголовки запроса
+        :type headers: Mapping[str, str]
+        :return: HTTP-код ответа
+        :rtype: int
+        """
+        self._count("received")
+        if self.secret_token is not None:
+            # compare_digest не принимает str с не-ASCII символами, а
+            # заголовок может прийти любым
+            token = (headers.get(SECRET_HEADER) or "").encode("utf-8")
+            if not hmac.compare_digest(
+                token, self.secret_token.encode("utf-8")
+            ):
+                self._count("unauthorized")
+                return 401
+        try:
+            update = types.Update.de_json(body.decode("utf-8"))
+        except Exception as e:
+            logger.error(f"Некорректное обновление: {e}")
+            self._count("bad_request")
+            return 400
+        try:
+            self.queue.put_nowait(update)
+        except queue.Full:
+            self._count("rejected")
+            return 503
+        with self._lock:
+            self.metrics["accepted"] += 1
+            depth = self.queue.qsize()
+            if depth > self.metrics["max_depth"]:
+                self.metrics["max_depth"] = depth
+        return 200
+
+    def _work(self):
+        """Цикл потока-обработчика: берет обновления из очереди."""
+        while True:
+            update = self.queue.get()
+            if update is _STOP:
+                return
+            try:
+                self.bot.process_new_updates([update])
+                self._count("processed")
+            except Exception as e:
+                logger.error(f"Ошибка обработки обновления: {e}")
+                self._count("errors")
+
+    def _handler_class(self):
+        """Создает класс обработчика HTTP-запросов для этого сервера."""
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    self._reply(404)
+                    return
+                length = int(self.headers.get("Content-Length") or 0)
+                status = server.accept(self.rfile.read(length), self.headers)
+                self._reply(status)
+
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self._reply(404)
+                    return
+                body = json.dumps(server.snapshot()).encode("utf-8")
+                self._reply(200, body, "application/json")
+
+            def _reply(self, status, body=b"", content_type="text/plain"):
+                self.send_response(status)
+                if status == 503:
+                    self.send_header("Retry-After", "1")
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return Handler
+
+    def start(self):
+        """Запускает сервер и обработчики в фоновых потоках.
+
+        :return: Этот же сервер
+        :rtype: WebhookServer
+        """
+        for worker in self._workers:
+            worker.start()
+        self._serving = threading.Thread(
+            target=self.httpd.serve_forever, name="webhook-http", daemon=True
+        )
+        self._serving.start()
+        return self
+
+    def serve_forever(self):
+        """Запускает обработчики и обслуживает запросы в текущем потоке.
+
+        :return: None
+        :rtype: None
+        """
+        for worker in self._workers:
+            worker.start()
+        self.httpd.serve_forever()
+
+    def stop(self):
+        """Останавливает сервер, дождавшись обработки очереди.
+
+        :return: None
+        :rtype: None
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for _ in self._workers:
+            self.queue.put(_STOP)
+        for worker in self._workers:
+            worker.join()
+
+
+def replay(path, url, secret_token=None):
+    """Отправляет записанные обновления из файла JSONL на вебхук.
+
+    Строки, которые не разбираются как JSON, например обрезанная
+    последняя строка, и строки без поля update_id пропускаются.
+
+    :param path: Файл, по одному обновлению Telegram в строке
+    :type path: str
+    :param url: Адрес вебхука
+    :type url: str
+    :param secret_token: Секретный токен вебхука
+    :type secret_token: str или None
+    :return: Количество ответов по HTTP-кодам и skipped - пропущенные
+        строки
+    :rtype: dict
+    """
+    result = {"skipped": 0}
+    headers = {"Content-Type": "application/json"}
+    if secret_token is not None:
+        headers[SECRET_HEADER] = secret_token
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            try:
+                update = json.loads(line) if line else None
+            except ValueError as e:
+                logger.error(f"Некорректная строка в {path}: {e}")
+                update = None
+            if not isinstance(update, dict) or "update_id" not in update:
+                result["skipped"] += 1
+                continue
+            request = urllib.request.Request(
+                url, data=line.encode("utf-8"), headers=headers
+            )
+            try:
+                with urllib.request.urlopen(request) as response:
+                    status = response.status
+            except urllib.error.HTTPError as e:
+                status = e.code
+            result[status] = result.get(status, 0) + 1
+    return result
+
+
+def main(argv=None):
+    """Точка входа командной строки для проигрывания обновлений.
+
+    :param argv: Аргументы командной строки, по умолчанию sys.argv
+    :type argv: list[str] или None
+    :return: Код возврата
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(description="Утилиты вебхука бота")
+    commands = parser.add_subparsers(dest="command", required=True)
+    replay_parser = commands.add_parser(
+        "replay", help="отправить обновления из JSONL на вебхук"
+    )
+    replay_parser.add_argument("path", help="файл с обновлениями")
+    replay_parser.add_argument(
+        "--url", default="http://127.0.0.1:8443/webhook"
+    )
+    replay_parser.add_argument("--secret", help="секретный токен вебхука")
+    args = parser.parse_args(argv)
+
+    print(replay(args.path, args.url, args.secret))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
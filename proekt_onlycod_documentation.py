@@ -1,8 +1,51 @@
+import argparse
+import os
 import sqlite3
 import logging
+import threading
+import time
+from concurrent.futures import Future
 from datetime import datetime
 import telebot
-from telebot import types
+from telebot import types, util
+from finance_analytics import (
+    add_to_buckets,
+    compare_months,
+    monthly_totals,
+    rolling_average,
+    timestamp,
+)
+from finance_cache import TTLCache
+from finance_import import (
+    category_names,
+    detect_format,
+    parse_record,
+    read_records,
+)
+from finance_keyboards import KeyboardRegistry
+from finance_metrics import TimedCursor, instrument, registry
+from finance_migrations import check_query_plans, migrate
+from finance_money import from_kopecks, parse_money, to_kopecks
+from finance_pool import ConnectionPool, GroupCommitWriter
+from finance_queries import (
+    BUDGET_SPENT,
+    BUDGET_UPDATE,
+    HISTORY_AFTER,
+    HISTORY_BEFORE,
+    HISTORY_FIRST,
+    HISTORY_LATEST,
+    HISTORY_OLDEST,
+    STATS,
+    TOTALS_REBUILD,
+)
+from finance_rates import (
+    DEFAULT_CURRENCY,
+    RATES_FILE,
+    convert,
+    read_rates,
+    split_currency,
+)
+from finance_router import Router
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -12,136 +55,516 @@ logger = logging.getLogger(__name__)
 :type: logging.Logger
 """
 
-bot = telebot.TeleBot("7974227359:AAHRj6bwFtOS1-UlxAQOpLMWH9CeFjtUjg4")
+BOT_TOKEN = "7974227359:AAHRj6bwFtOS1-UlxAQOpLMWH9CeFjtUjg4"
+"""
+Токен бота по умолчанию, переменная окружения FINANCE_BOT_TOKEN его
+заменяет
 
+:type: str
 """
-Основной экземпляр телеграм-бота, инициализированный с уникальным токеном API.
-Отвечает за взаимодействие с Telegram API, прием и отправку сообщений,
-управление всеми хендлерами и обработку событий от пользователей.
 
-:param bot: Объект класса TeleBot
-:type bot: telebot.TeleBot
+router = Router(metrics=registry)
 """
+Таблица обработчиков текстовых сообщений: команды и кнопки меню
+находятся поиском в словаре, а не перебором фильтров. Устанавливается на
+бота одним обработчиком после объявления всех хендлеров и замеряет время
+каждого хендлера в finance_metrics.registry.
 
-user_temp = {}
+:type: finance_router.Router
+"""
 
+CATEGORY_BUTTONS = (
+    "🍔 Еда",
+    "🚗 Транспорт",
+    "🎬 Развлечения",
+    "👕 Одежда",
+    "🏠 Жилье",
+    "📱 Связь",
+)
 """
-Глобальный словарь для хранения временных данных пользователей
-во время использования, Используется как прослойка для многошаговых
-операций, типо добавления расходов, является переменной с типом dict
+Кнопки категорий расходов, текст категории идет после эмодзи и пробела
+
+:type: tuple[str]
 """
 
+keyboards = KeyboardRegistry()
+"""
+Клавиатуры ответов, построенные и сериализованные один раз при запуске:
+main - основное меню, categories - выбор категории, confirm_clear -
+подтверждение очистки, remove - убрать клавиатуру.
+
+:type: finance_keyboards.KeyboardRegistry
+"""
+keyboards.reply(
+    "main",
+    ("➕ Добавить расход", "📊 Статистика"),
+    ("📅 Месяц", "📈 Средние"),
+    ("📋 История", "💰 Баланс"),
+    ("🗑️ Очистить все", "ℹ️ Помощь"),
+)
+keyboards.reply("categories", CATEGORY_BUTTONS, ("⬅️ Назад",))
+keyboards.reply("confirm_clear", ("✅ Да, очистить", "❌ Нет, отмена"))
+keyboards.add("remove", types.ReplyKeyboardRemove())
+
+
+BUDGET_THRESHOLDS = (80, 100)
+"""
+Пороги бюджета в процентах, о достижении каждого пользователь
+предупреждается один раз за месяц
 
+:type: tuple[int]
+"""
+
+
+def budget_level(spent, limit):
+    """Возвращает наибольший достигнутый порог бюджета.
+
+    :param spent: Потрачено в копейках
+    :type spent: int
+    :param limit: Лимит в копейках
+    :type limit: int
+    :return: Порог из BUDGET_THRESHOLDS или 0, если ни один не достигнут
+    :rtype: int
+    """
+    reached = [t for t in BUDGET_THRESHOLDS if spent * 100 >= limit * t]
+    return max(reached, default=0)
+
+
+def month_start(stamp):
+    """Возвращает начало месяца метки времени в формате корзин
+    expense_buckets.
+
+    :param stamp: Метка времени вида "2024-05-17 10:00:00"
+    :type stamp: str
+    :return: Например "2024-05-01"
+    :rtype: str
+    """
+    return stamp[:8] + "01"
+
+
+@instrument("db")
 class FinanceDB:
     """Класс для управления базой данных финансового Telegram-бота Обеспечивает
     все операции с SQLite базой данных: создание таблиц, управление балансом
     пользователей, работу с расходами и статистикой.
 
-    :ivar conn: Активное соединение с базой данных
+    Каждый метод берет собственный курсор из пула соединений, поэтому
+    экземпляр можно использовать из нескольких потоков бота одновременно.
+    Время публичных методов и SQL-запросов пишется в
+    finance_metrics.registry.
+
+    :ivar pool: Пул соединений с базой данных
+    :vartype pool: ConnectionPool
+
+    :ivar conn: Соединение писателя из пула
     :vartype conn: sqlite3.Connection
 
-    :ivar cursor: Курсор для выполнения SQL-запросов
+    :ivar cursor: Курсор на соединении писателя, оставлен для обратной
+        совместимости и отладки, сами методы класса его не используют
     :vartype cursor: sqlite3.Cursor
 
+    :ivar committer: Фоновый писатель с групповой фиксацией или None,
+        если записи фиксируются сразу
+    :vartype committer: GroupCommitWriter или None
+
+    :ivar balance_cache: Кэш балансов по user_id
+    :vartype balance_cache: TTLCache
+
+    :ivar stats_cache: Кэш результатов get_stats() по user_id
+    :vartype stats_cache: TTLCache
+
+    :ivar rate_cache: Кэш курсов exchange_rates по коду валюты
+    :vartype rate_cache: TTLCache
+
     Основные методы:
-    - create_tables(): Создает структуру базы данных
+    - create_tables(): Создает структуру базы данных миграциями
+    - check_query_plans(): Проверяет, что запросы идут по индексам
     - set_balance(): Устанавливает/обновляет баланс пользователя
     - get_balance(): Получает текущий баланс пользователя
+    - get_currency(): Возвращает базовую валюту пользователя
+    - rate(): Возвращает курс валюты из exchange_rates
+    - load_rates(): Загружает курсы валют из файла
     - add_expense(): Добавляет расход с проверкой средств
+    - spend(): Добавляет расход и проверяет бюджет категории
+    - set_budget(): Устанавливает или удаляет месячный бюджет категории
+    - get_budgets(): Возвращает бюджеты и траты за текущий месяц
     - get_stats(): Возвращает статистику по категориям
+    - rebuild_category_totals(): Пересчитывает суммы по категориям
+    - verify_category_totals(): Сверяет суммы по категориям с расходами
+    - reconcile(): Сверяет балансы с начальным балансом и расходами
+    - category_summary(): Суммы по категориям по всем пользователям
     - get_history(): Возвращает историю расходов
+    - get_history_page(): Возвращает страницу истории по ключу (date, id)
+    - iter_expenses(): Перебирает все расходы пользователя кусками
     - clear_data(): Полностью удаляет данные пользователя
+    - import_expenses(): Загружает историю расходов из CSV или JSONL
+    - cache_info(): Возвращает счетчики кэшей баланса и статистики
     """
 
-    def __init__(self, db_name="finance.db"):
+    def __init__(
+        self,
+        db_name="finance.db",
+        readers=4,
+        group_commit=False,
+        cache_size=10000,
+        cache_ttl=60.0,
+    ):
         """
-        Инициализирует подключение к базе данных и
+        Инициализирует пул соединений с базой данных и
         создает таблицы при необходимости
 
         :param db_name: Имя файла базы данных
         :type db_name: str
+        :param readers: Количество соединений для чтения в пуле
+        :type readers: int
+        :param group_commit: Включить групповую фиксацию записей, при
+            которой записи из разных потоков фиксируются общей
+            транзакцией в фоновом потоке
+        :type group_commit: bool
+        :param cache_size: Сколько пользователей держать в кэшах баланса
+            и статистики, 0 - отключить кэш
+        :type cache_size: int
+        :param cache_ttl: Время жизни записи кэша в секундах
+        :type cache_ttl: float
 
         :raises sqlite3.Error: Если не удалось подключиться к базе данных
         """
-        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+        self.pool = ConnectionPool(
+            db_name, readers=readers, cursor_factory=TimedCursor
+        )
+        self.conn = self.pool.writer_conn
         self.cursor = self.conn.cursor()
         self.create_tables()
+        self.committer = None
+        if group_commit:
+            self.committer = GroupCommitWriter(self.pool)
+        self.balance_cache = TTLCache(cache_size, cache_ttl)
+        self.stats_cache = TTLCache(cache_size, cache_ttl)
+        self.rate_cache = TTLCache(256 if cache_size else 0, cache_ttl)
+
+    def _write(self, op, *args):
+        """Выполняет операцию записи и дожидается её фиксации.
+
+        С групповой фиксацией операция уходит в очередь фонового
+        писателя, без неё выполняется в собственной транзакции.
+
+        :param op: Операция вида ``op(cursor, *args)``
+        :type op: callable
+        :param args: Аргументы операции
+        :return: Результат операции
+        :raises Exception: Исключение, которое выбросила операция или
+            фиксация транзакции
+        """
+        return self.submit(op, *args).result()
+
+    def _invalidate(self, user_id):
+        """Сбрасывает кэши баланса и статистики пользователя.
+
+        :param user_id: Идентификатор пользователя, None - сбросить всё
+        :type user_id: int или None
+        :return: None
+        :rtype: None
+        """
+        self.balance_cache.invalidate(user_id)
+        self.stats_cache.invalidate(user_id)
+
+    def cache_info(self):
+        """Возвращает счетчики попаданий и промахов кэшей.
+
+        :return: Словарь вида {"balance": {...}, "stats": {...},
+            "rates": {...}} со счетчиками TTLCache.info()
+        :rtype: dict[str, dict]
+        """
+        return {
+            "balance": self.balance_cache.info(),
+            "stats": self.stats_cache.info(),
+            "rates": self.rate_cache.info(),
+        }
+
+    def submit(self, op, *args):
+        """Отправляет операцию записи и сразу возвращает Future.
+
+        Операцию можно передать функцией или именем публичного метода
+        записи: "set_balance", "add_expense" или "clear_data". Для
+        "add_expense" результатом Future будет новый баланс или None при
+        нехватке средств. Первым аргументом операции идет user_id, по
+        нему после фиксации сбрасываются кэши. Это единственное место
+        сброса для записей через _write() и submit(): возвращаемый Future
+        завершается только после него, поэтому дождавшийся записи поток
+        не прочитает из кэша старое значение.
+
+        :param op: Операция вида ``op(cursor, *args)`` или имя метода
+        :type op: callable или str
+        :param args: Аргументы операции
+        :return: Future с результатом или исключением операции
+        :rtype: concurrent.futures.Future
+        """
+        if isinstance(op, str):
+            op = getattr(self, f"_op_{op}")
+        if self.committer is not None:
+            future = self.committer.submit(op, *args)
+        else:
+            future = Future()
+            try:
+                with self.pool.writer() as cursor:
+                    future.set_result(op(cursor, *args))
+            except Exception as e:
+                future.set_exception(e)
+        user_id = args[0] if args else None
+        done = Future()
+
+        def finish(future):
+            self._invalidate(user_id)
+            error = future.exception()
+            if error is not None:
+                done.set_exception(error)
+            else:
+                done.set_result(future.result())
+
+        future.add_done_callback(finish)
+        return done
 
     def create_tables(self):
-        """Создает необходимые таблицы в базе данных SQLite.
+        """Создает или обновляет структуру базы данных SQLite.
 
-        Метод выполняет создание двух таблиц:
+        Схема ведется версионными миграциями из модуля finance_migrations,
+        текущая версия хранится в PRAGMA user_version. Метод применяет
+        только те миграции, которых в базе еще нет, поэтому безопасно
+        вызывается и для новой базы, и для уже существующего finance.db.
+        Миграции создают таблицы:
         1. Таблица 'users' для хранения информации о пользователях и их балансе
         2. Таблица 'expenses' для хранения записей о расходах пользователей
+        3. Таблица 'category_totals' с готовыми суммами и количеством
+           расходов по категориям
+        а также индексы по expenses для истории и статистики.
 
         :raises sqlite3.Error: Если возникает ошибка при работе с базой данных
         :return: None
         :rtype: None
         """
         try:
-            self.cursor.execute(
-                """CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                balance REAL DEFAULT 0)"""
-            )
-            self.cursor.execute(
-                """CREATE TABLE IF NOT EXISTS expenses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                category TEXT,
-                amount REAL,
-                date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"""
-            )
-            self.conn.commit()
+            applied = migrate(self.pool)
+            if applied:
+                logger.info(f"Применены миграции схемы: {applied}")
         except sqlite3.Error as e:
             logger.error(f"Ошибка создания таблиц: {e}")
             raise e
 
-    def set_balance(self, user_id, amount):
+    def check_query_plans(self):
+        """Проверяет, что горячие запросы бота используют индексы.
+
+        :return: Словарь: название запроса - строки EXPLAIN QUERY PLAN
+        :rtype: dict[str, list[str]]
+        :raises AssertionError: Если какой-то запрос не использует индекс
+        """
+        with self.pool.reader() as cursor:
+            return check_query_plans(cursor)
+
+    def set_balance(self, user_id, amount, currency=None):
         """Устанавливает или обновляет баланс пользователя при вводе
         :param user_id: Идентификатор пользователя
         :type user_id: int
         :param amount: Баланс пользователя.
-        :type amount: float
+        :type amount: decimal.Decimal, int, float или str
+        :param currency: Базовая валюта пользователя, в ней ведется
+            баланс и показывается статистика. None - оставить прежнюю,
+            для нового пользователя DEFAULT_CURRENCY
+        :type currency: str или None
         :return: True - при успешном выполнении, False в ином случае
         :rtype: bool
         :raises: Возвращает False неявно
         """
         try:
-            self.cursor.execute(
-                "INSERT OR REPLACE INTO users VALUES (?, ?)",
-                (user_id, float(amount))
+            return self._write(
+                self._op_set_balance, user_id, amount, currency
             )
-            self.conn.commit()
-            return True
         except Exception as e:
             logger.error(f"Ошибка установки баланса: {e}")
             return False
 
+    def _op_set_balance(self, cursor, user_id, amount, currency=None):
+        """Операция записи для set_balance(), транзакцией управляет
+        вызывающий.
+
+        initial_balance запоминается так, чтобы уже записанные расходы
+        сходились с новым балансом при сверке reconcile().
+
+        :return: True
+        :rtype: bool
+        :raises ValueError: Если amount не является суммой или курс
+            валюты неизвестен
+        """
+        amount = to_kopecks(amount)
+        if currency is not None:
+            self.rate(currency, cursor)
+        cursor.execute(
+            """INSERT OR REPLACE INTO users
+            (user_id, balance, initial_balance, currency)
+            VALUES (?, ?, ? + COALESCE(
+                (SELECT SUM(charged) FROM expenses WHERE user_id=?), 0),
+            COALESCE(?, (SELECT currency FROM users WHERE user_id=?), ?))""",
+            (user_id, amount, amount, user_id, currency, user_id,
+             DEFAULT_CURRENCY),
+        )
+        return True
+
     def get_balance(self, user_id):
         """Получает текущий баланс пользователя.
 
+        Баланс читается через кэш balance_cache, который сбрасывается
+        при каждой записи данных пользователя.
+
         :param user_id: Идентификатор пользователя
         :type user_id: int
         :return: Вовзаращет баланс при запросе пользователя или None
             если пользователь не найден в базе данных
-        :rtype: float или None
+        :rtype: decimal.Decimal или None
         :raises: Неявно обрабатывает исключения, возвращая None
         """
         try:
-            self.cursor.execute(
-                "SELECT balance FROM users WHERE user_id=?", (user_id,)
+            return self.balance_cache.get_or_load(
+                user_id, lambda: self._load_balance(user_id)
             )
-            result = self.cursor.fetchone()
-            if result:
-                return result[0]
-            else:
-                return None
         except Exception as e:
             logger.error(f"Ошибка получения баланса: {e}")
             return None
 
-    def add_expense(self, user_id, category, amount):
+    def _load_balance(self, user_id):
+        """Читает баланс из базы в обход кэша.
+
+        :return: Баланс или None
+        :rtype: decimal.Decimal или None
+        """
+        with self.pool.reader() as cursor:
+            cursor.execute(
+                "SELECT balance FROM users WHERE user_id=?", (user_id,)
+            )
+            result = cursor.fetchone()
+        if result:
+            return from_kopecks(result[0])
+        else:
+            return None
+
+    def get_currency(self, user_id):
+        """Возвращает базовую валюту пользователя.
+
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :return: Код валюты, DEFAULT_CURRENCY для неизвестного
+            пользователя
+        :rtype: str
+        """
+        with self.pool.reader() as cursor:
+            return self._currency(cursor, user_id)
+
+    def _currency(self, cursor, user_id):
+        """Читает базовую валюту пользователя тем же курсором."""
+        cursor.execute(
+            "SELECT currency FROM users WHERE user_id=?", (user_id,)
+        )
+        row = cursor.fetchone()
+        return row[0] if row else DEFAULT_CURRENCY
+
+    def base_rate(self, cursor, user_id):
+        """Возвращает курс базовой валюты пользователя.
+
+        На него делятся суммы, переведенные соединением с exchange_rates,
+        чтобы получить копейки базовой валюты.
+
+        :param cursor: Курсор, которым читается остальной запрос
+        :type cursor: sqlite3.Cursor
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :return: Курс валюты
+        :rtype: float
+        """
+        return self.rate(self._currency(cursor, user_id), cursor)
+
+    def rate(self, currency, cursor=None):
+        """Возвращает курс валюты.
+
+        Курсы читаются через кэш rate_cache, который сбрасывается при
+        загрузке курсов.
+
+        :param currency: Код валюты
+        :type currency: str
+        :param cursor: Курс при промахе кэша читается этим курсором.
+            Вызывающий, который уже держит соединение пула, обязан его
+            передать: иначе потоки, занявшие всех читателей, ждали бы
+            друг друга
+        :type cursor: sqlite3.Cursor или None
+        :return: Курс валюты к базовой валюте файла курсов
+        :rtype: float
+        :raises ValueError: Если курс валюты неизвестен
+        """
+        rate = self.rate_cache.get_or_load(
+            currency, lambda: self._load_rate(currency, cursor)
+        )
+        if rate is None:
+            raise ValueError(f"Неизвестная валюта: {currency}")
+        return rate
+
+    def _load_rate(self, currency, cursor=None):
+        """Читает курс из базы в обход кэша.
+
+        :return: Курс или None
+        :rtype: float или None
+        """
+        if cursor is None:
+            with self.pool.reader() as cursor:
+                return self._load_rate(currency, cursor)
+        cursor.execute(
+            "SELECT rate FROM exchange_rates WHERE currency=?", (currency,)
+        )
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def currencies(self):
+        """Возвращает валюты, для которых известен курс.
+
+        :return: Коды валют
+        :rtype: list[str]
+        """
+        with self.pool.reader() as cursor:
+            cursor.execute("SELECT currency FROM exchange_rates")
+            return [row[0] for row in cursor.fetchall()]
+
+    def load_rates(self, path=RATES_FILE):
+        """Заменяет таблицу exchange_rates курсами из файла.
+
+        Сбрасывает кэши курсов и статистики: суммы в базовой валюте
+        пересчитываются по новым курсам при следующем чтении.
+
+        :param path: Путь к файлу курсов, формат описан в finance_rates
+        :type path: str
+        :return: Количество загруженных курсов
+        :rtype: int
+        :raises ValueError: Если файл некорректен или в нем нет курса
+            валюты, которая уже используется в расходах или балансах
+        :raises OSError: Если файл не удалось прочитать
+        """
+        rates = read_rates(path)
+        with self.pool.writer() as cursor:
+            cursor.execute(
+                """SELECT currency FROM users UNION
+                SELECT currency FROM category_totals"""
+            )
+            missing = {row[0] for row in cursor.fetchall()} - rates.keys()
+            if missing:
+                raise ValueError(
+                    f"{path}: нет курсов {', '.join(sorted(missing))}"
+                )
+            cursor.execute("DELETE FROM exchange_rates")
+            now = time.time()
+            cursor.executemany(
+                "INSERT INTO exchange_rates VALUES (?, ?, ?)",
+                [(code, rate, now) for code, rate in rates.items()],
+            )
+        self.rate_cache.invalidate()
+        self._invalidate(None)
+        return len(rates)
+
+    def add_expense(self, user_id, category, amount, currency=None):
         """Добавляет трату в конкретную категорию.
 
         :param user_id: Идентификатор пользователя
@@ -149,55 +572,430 @@ class FinanceDB:
         :param category: Категория трат
         :type category: str
         :param amount: Сумма траты
-        :type amount: float
+        :type amount: decimal.Decimal, int, float или str
+        :param currency: Валюта траты, None - базовая валюта пользователя
+        :type currency: str или None
         :return: Возвращает False если текущий баланс меньше суммы
             траты, либо если пользователя нет, а ещё возвращает True в
             других случаях
         :raises: Неявно обрабатывает исключения базы данных, возвращая
             False
         """
+        result = self.add_expense_atomic(user_id, category, amount, currency)
+        return result is not None
+
+    def add_expense_atomic(self, user_id, category, amount, currency=None):
+        """Списывает трату с баланса и записывает её одной транзакцией.
+
+        Баланс уменьшается условным запросом
+        ``UPDATE ... WHERE balance >= ?``, поэтому два одновременных
+        расхода не могут вместе увести баланс в минус. Расход
+        записывается в той же транзакции ``BEGIN IMMEDIATE``, а новый
+        баланс возвращается через RETURNING без отдельного SELECT.
+        Трата в другой валюте списывается с баланса по текущему курсу.
+
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :param category: Категория трат
+        :type category: str
+        :param amount: Сумма траты
+        :type amount: decimal.Decimal, int, float или str
+        :param currency: Валюта траты, None - базовая валюта пользователя
+        :type currency: str или None
+        :return: Баланс после списания или None, если пользователя нет,
+            средств недостаточно, сумма некорректна или курс валюты
+            неизвестен
+        :rtype: decimal.Decimal или None
+        :raises: Неявно обрабатывает исключения базы данных, возвращая
+            None
+        """
+        result = self.spend(user_id, category, amount, currency)
+        return None if result is None else result[0]
+
+    def spend(self, user_id, category, amount, currency=None):
+        """Записывает трату как add_expense_atomic() и в той же
+        транзакции добавляет её к месячному бюджету категории.
+
+        Бюджет хранит уже потраченную за месяц сумму, поэтому проверка
+        лимита - это одно обновление строки budgets по ключу, без
+        суммирования расходов.
+
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :param category: Категория трат
+        :type category: str
+        :param amount: Сумма траты
+        :type amount: decimal.Decimal, int, float или str
+        :param currency: Валюта траты, None - базовая валюта пользователя
+        :type currency: str или None
+        :return: Кортеж (баланс после списания, предупреждение) или None
+            в тех же случаях, что и add_expense_atomic(). Предупреждение -
+            кортеж (порог в процентах, потрачено за месяц, лимит), если
+            трата впервые в этом месяце достигла порога из
+            BUDGET_THRESHOLDS, иначе None
+        :rtype: tuple или None
+        :raises: Неявно обрабатывает исключения базы данных, возвращая
+            None
+        """
         try:
-            balance = self.get_balance(user_id)
-            if balance is None or balance < amount:
-                return False
-
-            self.cursor.execute(
-                """INSERT INTO expenses (user_id, category, amount)
-                                VALUES (?, ?, ?)""",
-                (user_id, category, amount),
-            )
-            self.cursor.execute(
-                "UPDATE users SET balance = balance - ? WHERE user_id=?",
-                (amount, user_id),
+            return self._write(
+                self._op_spend, user_id, category, amount, currency
             )
-            self.conn.commit()
-            return True
         except Exception as e:
             logger.error(f"Ошибка добавления расхода: {e}")
+            return None
+
+    def _op_add_expense(self, cursor, user_id, category, amount,
+                        currency=None):
+        """Операция записи для add_expense_atomic(), транзакцией управляет
+        вызывающий.
+
+        :return: Баланс после списания или None
+        :rtype: decimal.Decimal или None
+        :raises ValueError: Если amount не является суммой или курс
+            валюты неизвестен
+        """
+        result = self._op_spend(cursor, user_id, category, amount, currency)
+        return None if result is None else result[0]
+
+    def _op_spend(self, cursor, user_id, category, amount, currency=None):
+        """Операция записи для spend(), транзакцией управляет вызывающий.
+
+        :return: Кортеж (баланс, предупреждение) или None
+        :rtype: tuple или None
+        :raises ValueError: Если amount не является суммой или курс
+            валюты неизвестен
+        """
+        amount = to_kopecks(amount)
+        base = self._currency(cursor, user_id)
+        currency = currency or base
+        charged = convert(
+            amount, self.rate(currency, cursor), self.rate(base, cursor)
+        )
+        cursor.execute(
+            """UPDATE users SET balance = balance - ?
+            WHERE user_id=? AND balance >= ?
+            RETURNING balance""",
+            (charged, user_id, charged),
+        )
+        result = cursor.fetchone()
+        if result is None:
+            return None
+
+        now = timestamp()
+        cursor.execute(
+            """INSERT INTO expenses
+            (user_id, category, amount, currency, charged, date)
+            VALUES (?, ?, ?, ?, ?, ?)""",
+            (user_id, category, amount, currency, charged, now),
+        )
+        cursor.execute(
+            """INSERT INTO category_totals
+            (user_id, category, currency, total, count)
+            VALUES (?, ?, ?, ?, 1)
+            ON CONFLICT (user_id, category, currency) DO UPDATE SET
+            total = total + excluded.total, count = count + 1""",
+            (user_id, category, currency, amount),
+        )
+        add_to_buckets(cursor, [(user_id, category, amount, now, currency)])
+        alert = self._charge_budget(
+            cursor, user_id, category, charged, month_start(now)
+        )
+        return from_kopecks(result[0]), alert
+
+    def _charge_budget(self, cursor, user_id, category, charged, month):
+        """Добавляет трату к бюджету категории, если он установлен.
+
+        :param charged: Списано в копейках базовой валюты
+        :type charged: int
+        :param month: Начало месяца траты, см. month_start()
+        :type month: str
+        :return: Предупреждение (порог, потрачено, лимит), если трата
+            впервые за месяц достигла порога, иначе None
+        :rtype: tuple или None
+        """
+        cursor.execute(
+            BUDGET_UPDATE + " RETURNING amount, spent, alerted",
+            {
+                "month": month,
+                "charged": charged,
+                "user_id": user_id,
+                "category": category,
+            },
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        limit, spent, alerted = row
+        level = budget_level(spent, limit)
+        if level <= alerted:
+            return None
+        cursor.execute(
+            "UPDATE budgets SET alerted=? WHERE user_id=? AND category=?",
+            (level, user_id, category),
+        )
+        return level, from_kopecks(spent), from_kopecks(limit)
+
+    def set_budget(self, user_id, category, amount):
+        """Устанавливает месячный бюджет категории.
+
+        Уже потраченная в этом месяце сумма считается один раз при
+        установке, дальше её ведут сами траты. Пороги, которые она уже
+        достигла, считаются пройденными и повторно не предупреждаются.
+
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :param category: Категория трат
+        :type category: str
+        :param amount: Лимит в базовой валюте, 0 - удалить бюджет
+        :type amount: decimal.Decimal, int, float или str
+        :return: True - при успешном выполнении, False в ином случае
+        :rtype: bool
+        :raises: Возвращает False неявно
+        """
+        try:
+            return self._write(self._op_set_budget, user_id, category, amount)
+        except Exception as e:
+            logger.error(f"Ошибка установки бюджета: {e}")
             return False
 
+    def _op_set_budget(self, cursor, user_id, category, amount):
+        """Операция записи для set_budget(), транзакцией управляет
+        вызывающий.
+
+        :return: True
+        :rtype: bool
+        :raises ValueError: Если amount не является суммой или меньше 0
+        """
+        limit = to_kopecks(amount)
+        if limit < 0:
+            raise ValueError("Бюджет не может быть меньше 0")
+        if limit == 0:
+            cursor.execute(
+                "DELETE FROM budgets WHERE user_id=? AND category=?",
+                (user_id, category),
+            )
+            return True
+        month = month_start(timestamp())
+        cursor.execute(BUDGET_SPENT, (user_id, category, month))
+        spent = cursor.fetchone()[0]
+        cursor.execute(
+            """INSERT OR REPLACE INTO budgets
+            (user_id, category, amount, month, spent, alerted)
+            VALUES (?, ?, ?, ?, ?, ?)""",
+            (user_id, category, limit, month, spent,
+             budget_level(spent, limit)),
+        )
+        return True
+
+    def get_budgets(self, user_id):
+        """Возвращает бюджеты пользователя и траты по ним за текущий
+        месяц.
+
+        Бюджет, по которому в этом месяце еще не было трат, показывается
+        с нулевыми тратами, хотя в строке еще лежит прошлый месяц.
+
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :return: Словарь категория - (лимит, потрачено), упорядоченный по
+            категориям, в базовой валюте
+        :rtype: dict[str, tuple[decimal.Decimal, decimal.Decimal]]
+        :raises: Неявно обрабатывает исключения, возвращая пустой словарь
+        """
+        try:
+            with self.pool.reader() as cursor:
+                cursor.execute(
+                    """SELECT category, amount,
+                    CASE WHEN month = ? THEN spent ELSE 0 END
+                    FROM budgets WHERE user_id=? ORDER BY category""",
+                    (month_start(timestamp()), user_id),
+                )
+                rows = cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Ошибка получения бюджетов: {e}")
+            return {}
+        return {
+            category: (from_kopecks(limit), from_kopecks(spent))
+            for category, limit, spent in rows
+        }
+
     def get_stats(self, user_id):
         """Получает статистику расходов пользователя по каким-либо категориям.
 
         :param user_id: Идентификатор пользователя
         :type user_id: int
         :return: Возвращает словарь в которых ключи - категории расходов,
-        а значения - общая сумма по категориям
-        :rtype: dict[str, float]
+        а значения - общая сумма по категориям в базовой валюте
+        пользователя по текущим курсам
+        :rtype: dict[str, decimal.Decimal]
         :raises: Неявно обрабатывает исключения базы данных,
         возвращая пустой словарь
         """
         try:
-            self.cursor.execute(
-                """SELECT category, SUM(amount) FROM expenses
-                                WHERE user_id=? GROUP BY category""",
-                (user_id,),
+            stats = self.stats_cache.get_or_load(
+                user_id, lambda: self._load_stats(user_id)
             )
-            return dict(self.cursor.fetchall())
+            return dict(stats)
         except Exception as e:
             logger.error(f"Ошибка получения статистики: {e}")
             return {}
 
+    def _load_stats(self, user_id):
+        """Читает суммы по категориям из базы в обход кэша.
+
+        :return: Словарь категория - сумма
+        :rtype: dict[str, decimal.Decimal]
+        """
+        with self.pool.reader() as cursor:
+            cursor.execute(STATS, (self.base_rate(cursor, user_id), user_id))
+            return {
+                category: from_kopecks(total)
+                for category, total in cursor.fetchall()
+            }
+
+    def rebuild_category_totals(self, user_id=None):
+        """Пересчитывает таблицу category_totals по таблице expenses.
+
+        :param user_id: Идентификатор пользователя, None - пересчитать
+            для всех пользователей
+        :type user_id: int или None
+        :return: Количество записанных строк category_totals
+        :rtype: int
+        :raises sqlite3.Error: Если возникает ошибка при работе с базой
+            данных
+        """
+        return self._write(self._op_rebuild_category_totals, user_id)
+
+    def _op_rebuild_category_totals(self, cursor, user_id):
+        """Операция записи для rebuild_category_totals(), транзакцией
+        управляет вызывающий.
+
+        :return: Количество записанных строк
+        :rtype: int
+        """
+        if user_id is not None:
+            cursor.execute(
+                "DELETE FROM category_totals WHERE user_id=?", (user_id,)
+            )
+            cursor.execute(TOTALS_REBUILD, (user_id,))
+            return cursor.rowcount
+        cursor.execute("DELETE FROM category_totals")
+        cursor.execute(
+            """INSERT INTO category_totals
+            (user_id, category, currency, total, count)
+            SELECT user_id, category, currency, SUM(amount), COUNT(*)
+            FROM expenses GROUP BY user_id, category, currency"""
+        )
+        return cursor.rowcount
+
+    def verify_category_totals(self, user_id=None):
+        """Сверяет таблицу category_totals с суммами по таблице expenses.
+
+        :param user_id: Идентификатор пользователя, None - проверить всех
+        :type user_id: int или None
+        :return: Список расхождений в виде кортежей (user_id, category,
+            currency, сумма по expenses, сумма в category_totals,
+            количество по expenses, количество в category_totals), пустой
+            если всё сходится
+        :rtype: list[tuple]
+        :raises sqlite3.Error: Если возникает ошибка при работе с базой
+            данных
+        """
+        where = "" if user_id is None else " WHERE user_id=?"
+        params = () if user_id is None else (user_id,)
+        with self.pool.reader() as cursor:
+            cursor.execute(
+                """SELECT user_id, category, currency, SUM(amount), COUNT(*)
+                FROM expenses""" + where
+                + " GROUP BY user_id, category, currency",
+                params,
+            )
+            expected = {row[:3]: row[3:] for row in cursor.fetchall()}
+            cursor.execute(
+                """SELECT user_id, category, currency, total, count
+                FROM category_totals""" + where,
+                params,
+            )
+            actual = {row[:3]: row[3:] for row in cursor.fetchall()}
+
+        mismatches = []
+        for key in sorted(expected.keys() | actual.keys()):
+            exp_total, exp_count = expected.get(key, (0, 0))
+            act_total, act_count = actual.get(key, (0, 0))
+            if exp_count != act_count or exp_total != act_total:
+                mismatches.append(
+                    key
+                    + (
+                        from_kopecks(exp_total),
+                        from_kopecks(act_total),
+                        exp_count,
+                        act_count,
+                    )
+                )
+        return mismatches
+
+    def reconcile(self, user_id=None):
+        """Сверяет балансы пользователей с их расходами.
+
+        Баланс должен быть равен начальному балансу за вычетом суммы всех
+        расходов, списанной по курсу на момент записи (expenses.charged).
+        Суммы хранятся в копейках, поэтому сравнение точное.
+
+        :param user_id: Идентификатор пользователя, None - проверить всех
+        :type user_id: int или None
+        :return: Список расхождений в виде кортежей (user_id, баланс,
+            начальный баланс, сумма расходов, ожидаемый баланс), пустой
+            если всё сходится
+        :rtype: list[tuple]
+        :raises sqlite3.Error: Если возникает ошибка при работе с базой
+            данных
+        """
+        where = "" if user_id is None else " WHERE u.user_id=?"
+        params = () if user_id is None else (user_id,)
+        with self.pool.reader() as cursor:
+            cursor.execute(
+                """SELECT u.user_id, u.balance, u.initial_balance,
+                COALESCE((SELECT SUM(e.charged) FROM expenses e
+                          WHERE e.user_id = u.user_id), 0)
+                FROM users u""" + where + " ORDER BY u.user_id",
+                params,
+            )
+            rows = cursor.fetchall()
+        return [
+            (uid,)
+            + tuple(
+                from_kopecks(value)
+                for value in (balance, initial, spent, initial - spent)
+            )
+            for uid, balance, initial, spent in rows
+            if balance != initial - spent
+        ]
+
+    def category_summary(self):
+        """Суммирует расходы всех пользователей базы по категориям.
+
+        Запрос для отчетов: просматривает всю таблицу category_totals,
+        суммы переводятся в валюту, к которой заданы курсы.
+
+        :return: Словарь категория - (сумма, количество расходов,
+            количество пользователей), упорядоченный по категориям
+        :rtype: dict[str, tuple[decimal.Decimal, int, int]]
+        :raises sqlite3.Error: Если возникает ошибка при работе с базой
+            данных
+        """
+        with self.pool.reader() as cursor:
+            cursor.execute(
+                """SELECT t.category,
+                CAST(ROUND(SUM(t.total * r.rate)) AS INTEGER),
+                SUM(t.count), COUNT(DISTINCT t.user_id)
+                FROM category_totals t JOIN exchange_rates r USING (currency)
+                GROUP BY t.category ORDER BY t.category"""
+            )
+            return {
+                category: (from_kopecks(total), count, users)
+                for category, total, count, users in cursor.fetchall()
+            }
+
     def get_history(self, user_id, limit=5):
         """Получает историю расходов.
 
@@ -205,22 +1003,129 @@ class FinanceDB:
         :type user_id: int
         :param limit: Сколько последних записей вернуть сделали 5
         :type limit: int
-        :return: Список последних расходов
+        :return: Список последних расходов (category, amount, date),
+            суммы в базовой валюте пользователя
         :rtype: list[tuple]
         :raises: Неявно обрабатывает исключения базы данных, возвращая
             пустой массив
         """
         try:
-            self.cursor.execute(
-                """SELECT category, amount, date FROM expenses
-                                WHERE user_id=? ORDER BY date DESC LIMIT ?""",
-                (user_id, limit),
-            )
-            return self.cursor.fetchall()
+            with self.pool.reader() as cursor:
+                cursor.execute(
+                    HISTORY_LATEST,
+                    (self.base_rate(cursor, user_id), user_id, limit),
+                )
+                return [
+                    (category, from_kopecks(amount), date)
+                    for category, amount, date in cursor.fetchall()
+                ]
         except Exception as e:
             logger.error(f"Ошибка получения истории: {e}")
             return []
 
+    def get_history_page(self, user_id, limit=5, before=None, after=None):
+        """Получает страницу истории расходов по ключу (date, id).
+
+        Страница начинается сразу за ключом, а не со смещения OFFSET,
+        поэтому каждая страница - один поиск по индексу
+        idx_expenses_user_date_id независимо от глубины.
+
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :param limit: Сколько записей на странице
+        :type limit: int
+        :param before: Ключ (date, id): вернуть записи старше него
+        :type before: tuple или None
+        :param after: Ключ (date, id): вернуть записи новее него
+        :type after: tuple или None
+        :return: Кортеж (записи, ключ для более старой страницы, ключ для
+            более новой страницы). Записи - кортежи (category, amount,
+            date) от новых к старым, суммы в базовой валюте
+            пользователя, ключ равен None, если страницы в
+            эту сторону нет. Без before и after возвращается первая
+            страница с самыми новыми расходами
+        :rtype: tuple[list[tuple], tuple или None, tuple или None]
+        :raises: Неявно обрабатывает исключения базы данных, возвращая
+            пустую страницу
+        """
+        try:
+            with self.pool.reader() as cursor:
+                rate = self.base_rate(cursor, user_id)
+                if after is not None:
+                    cursor.execute(
+                        HISTORY_AFTER, (rate, user_id, *after, limit + 1)
+                    )
+                elif before is not None:
+                    cursor.execute(
+                        HISTORY_BEFORE, (rate, user_id, *before, limit + 1)
+                    )
+                else:
+                    cursor.execute(HISTORY_FIRST, (rate, user_id, limit + 1))
+                rows = cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Ошибка получения истории: {e}")
+            return [], None, None
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if after is not None:
+            rows.reverse()
+        if not rows:
+            return [], None, None
+
+        first = (rows[0][3], rows[0][0])
+        last = (rows[-1][3], rows[-1][0])
+        if after is None:
+            older = last if has_more else None
+            newer = first if before is not None else None
+        else:
+            older = last
+            newer = first if has_more else None
+        page = [
+            (category, from_kopecks(amount), date)
+            for _, category, amount, date in rows
+        ]
+        return page, older, newer
+
+    def iter_expenses(self, user_id, chunk_size=1000):
+        """Перебирает все расходы пользователя от старых к новым.
+
+        Записи читаются кусками по ключу (date, id) через индекс
+        idx_expenses_user_date_id. Соединение для чтения берется из пула
+        только на время одного куска, поэтому долгий перебор не держит
+        его и не открывает долгую транзакцию, а в памяти не больше
+        chunk_size записей.
+
+        :param user_id: Идентификатор пользователя
+        :type user_id: int
+        :param chunk_size: Сколько записей читать одним запросом
+        :type chunk_size: int
+        :return: Генератор кортежей (date, category, amount), суммы в
+            базовой валюте пользователя
+        :rtype: Iterator[tuple[str, str, decimal.Decimal]]
+        :raises sqlite3.Error: Если возникает ошибка при работе с базой
+            данных
+        """
+        key = None
+        with self.pool.reader() as cursor:
+            rate = self.base_rate(cursor, user_id)
+        while True:
+            with self.pool.reader() as cursor:
+                if key is None:
+                    cursor.execute(
+                        HISTORY_OLDEST, (rate, user_id, chunk_size)
+                    )
+                else:
+                    cursor.execute(
+                        HISTORY_AFTER, (rate, user_id, *key, chunk_size)
+                    )
+                rows = cursor.fetchall()
+            for _, category, amount, date in rows:
+                yield date, category, from_kopecks(amount)
+            if len(rows) < chunk_size:
+                return
+            key = (rows[-1][3], rows[-1][0])
+
     def clear_data(self, user_id):
         """Полностью удаляет все данные из базы данных.
 
@@ -231,140 +1136,684 @@ class FinanceDB:
         :raises: Неявно обрабатывает исключения, возвращая False
         """
         try:
-            self.cursor.execute(
-                "DELETE FROM expenses WHERE user_id=?", (user_id,)
-            )
-            self.cursor.execute(
-                "DELETE FROM users WHERE user_id=?", (user_id,)
-            )
-            self.conn.commit()
-            return True
+            return self._write(self._op_clear_data, user_id)
         except Exception as e:
             logger.error(f"Ошибка очистки данных: {e}")
             return False
 
+    def _op_clear_data(self, cursor, user_id):
+        """Операция записи для clear_data(), транзакцией управляет
+        вызывающий.
+
+        :return: True
+        :rtype: bool
+        """
+        cursor.execute("DELETE FROM expenses WHERE user_id=?", (user_id,))
+        cursor.execute(
+            "DELETE FROM category_totals WHERE user_id=?", (user_id,)
+        )
+        cursor.execute(
+            "DELETE FROM expense_buckets WHERE user_id=?", (user_id,)
+        )
+        cursor.execute("DELETE FROM budgets WHERE user_id=?", (user_id,))
+        cursor.execute("DELETE FROM users WHERE user_id=?", (user_id,))
+        return True
+
+    def import_expenses(
+        self,
+        path,
+        fmt=None,
+        batch_size=10000,
+        resume=True,
+        adjust_balance=True,
+        progress=None,
+        max_errors=100,
+    ):
+        """Загружает историю расходов из файла большими транзакциями.
+
+        Файл читается потоком, записи вставляются через executemany
+        пачками по batch_size. Суммы по категориям и балансы обновляются
+        один раз на пользователя за пачку, баланс при этом может уйти в
+        минус. Вместе с каждой пачкой в таблицу import_checkpoints
+        записывается место остановки, поэтому прерванный импорт
+        продолжается с первой незаписанной строки, а законченный не
+        повторяется.
+
+        :param path: Путь к файлу
+        :type path: str
+        :param fmt: Формат файла: "csv" или "jsonl", None - по
+            расширению
+        :type fmt: str или None
+        :param batch_size: Количество записей в одной транзакции
+        :type batch_size: int
+        :param resume: Продолжить с сохраненного места, False - начать
+            файл заново
+        :type resume: bool
+        :param adjust_balance: Списывать импортированные суммы с баланса
+            пользователей, у которых он установлен
+        :type adjust_balance: bool
+        :param progress: Функция, которую после каждой пачки вызывают со
+            словарем счетчиков импорта
+        :type progress: callable или None
+        :param max_errors: Сколько ошибочных строк запомнить для отчета
+        :type max_errors: int
+        :return: Счетчики: imported, rejected, line, offset, size, done и
+            errors - список (номер строки, причина)
+        :rtype: dict
+        :raises ValueError: Если формат не поддерживается или файл стал
+            короче сохраненного места остановки
+        :raises sqlite3.Error: Если возникает ошибка при работе с базой
+            данных
+        """
+        fmt = fmt or detect_format(path)
+        source = os.path.abspath(path)
+        result = {
+            "imported": 0,
+            "rejected": 0,
+            "line": 0,
+            "offset": 0,
+            "size": os.path.getsize(path),
+            "done": False,
+            "errors": [],
+        }
+        if resume:
+            with self.pool.reader() as cursor:
+                cursor.execute(
+                    """SELECT offset, line, imported, rejected, done
+                    FROM import_checkpoints WHERE source=?""",
+                    (source,),
+                )
+                row = cursor.fetchone()
+            if row is not None:
+                (result["offset"], result["line"], result["imported"],
+                 result["rejected"], done) = row
+                result["done"] = bool(done)
+                if result["offset"] > result["size"]:
+                    raise ValueError(
+                        f"{path} короче сохраненного места остановки"
+                    )
+        if result["done"]:
+            return result
+
+        categories = category_names(CATEGORY_BUTTONS)
+        currencies = set(self.currencies())
+        batch = []
+        records = read_records(path, fmt, result["offset"], result["line"])
+        for line, offset, record, error in records:
+            if record is not None:
+                try:
+                    batch.append(
+                        parse_record(record, categories, currencies)
+                    )
+                except ValueError as e:
+                    error = str(e)
+            if error is not None:
+                result["rejected"] += 1
+                if len(result["errors"]) < max_errors:
+                    result["errors"].append((line, error))
+            result["line"], result["offset"] = line, offset
+            if len(batch) >= batch_size:
+                self._import_batch(source, batch, result, adjust_balance)
+                batch = []
+                if progress is not None:
+                    progress(result)
+        result["done"] = True
+        self._import_batch(source, batch, result, adjust_balance)
+        if progress is not None:
+            progress(result)
+        return result
+
+    def _import_batch(self, source, batch, result, adjust_balance):
+        """Записывает пачку импорта и место остановки одной транзакцией и
+        сбрасывает кэши затронутых пользователей.
+        """
+        with self.pool.writer() as cursor:
+            users = self._op_import_batch(cursor, batch, adjust_balance)
+            result["imported"] += len(batch)
+            cursor.execute(
+                """INSERT OR REPLACE INTO import_checkpoints
+                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (source, result["offset"], result["line"],
+                 result["imported"], result["rejected"],
+                 int(result["done"]), time.time()),
+            )
+        for user_id in users:
+            self._invalidate(user_id)
+
+    def _op_import_batch(self, cursor, batch, adjust_balance):
+        """Операция записи пачки импорта, транзакцией управляет
+        вызывающий.
+
+        :param batch: Строки (user_id, category, amount, date, currency),
+            amount в копейках, currency None - базовая валюта
+            пользователя
+        :type batch: list[tuple]
+        :return: Идентификаторы затронутых пользователей
+        :rtype: set[int]
+        """
+        now = timestamp()
+        bases = {}
+        for user_id in {row[0] for row in batch}:
+            base = self._currency(cursor, user_id)
+            bases[user_id] = (base, self.rate(base, cursor))
+        month = month_start(now)
+        rows = []
+        totals = {}
+        spent = {}
+        budgets = {}
+        for user_id, category, amount, date, currency in batch:
+            base, base_rate = bases[user_id]
+            currency = currency or base
+            charged = convert(
+                amount, self.rate(currency, cursor), base_rate
+            )
+            rows.append(
+                (user_id, category, amount, currency, charged, date or now)
+            )
+            total = totals.setdefault((user_id, category, currency), [0, 0])
+            total[0] += amount
+            total[1] += 1
+            spent[user_id] = spent.get(user_id, 0) + charged
+            if month_start(date or now) == month:
+                key = (user_id, category)
+                budgets[key] = budgets.get(key, 0) + charged
+        cursor.executemany(
+            """INSERT INTO expenses
+            (user_id, category, amount, currency, charged, date)
+            VALUES (?, ?, ?, ?, ?, ?)""",
+            rows,
+        )
+        cursor.executemany(
+            """INSERT INTO category_totals
+            (user_id, category, currency, total, count)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, category, currency) DO UPDATE SET
+            total = total + excluded.total, count = count + excluded.count""",
+            [key + tuple(value) for key, value in totals.items()],
+        )
+        add_to_buckets(
+            cursor,
+            [(uid, cat, amount, date, cur)
+             for uid, cat, amount, cur, _, date in rows],
+        )
+        # Прошлые месяцы бюджетам не нужны, а траты текущего доходят до
+        # них без предупреждений, импорт ведь не ждет ответа в чате
+        cursor.executemany(
+            BUDGET_UPDATE,
+            [
+                {"month": month, "charged": charged, "user_id": user_id,
+                 "category": category}
+                for (user_id, category), charged in budgets.items()
+            ],
+        )
+        if adjust_balance:
+            sql = "UPDATE users SET balance = balance - ? WHERE user_id=?"
+        else:
+            # Баланс не меняется, значит расходы были оплачены из
+            # начального баланса, иначе reconcile() нашел бы расхождение
+            sql = """UPDATE users SET initial_balance = initial_balance + ?
+            WHERE user_id=?"""
+        cursor.executemany(
+            sql, [(amount, user_id) for user_id, amount in spent.items()]
+        )
+        return spent.keys()
+
+    def close(self):
+        """Дописывает очередь группового писателя и закрывает все
+        соединения пула.
 
-db = FinanceDB()
+        :return: None
+        :rtype: None
+        """
+        if self.committer is not None:
+            self.committer.close()
+        self.pool.close()
+
+
+class AppConfig:
+    """Настройки, из которых create_app() собирает приложение.
+
+    :ivar token: Токен бота
+    :vartype token: str
+
+    :ivar db_path: Файл базы, ":memory:" - база в памяти
+    :vartype db_path: str
+
+    :ivar shards: Количество файлов, между которыми делятся пользователи
+    :vartype shards: int
+
+    :ivar runtime: Режим работы: "polling", "async" или "webhook"
+    :vartype runtime: str
+    """
+
+    def __init__(
+        self,
+        token=BOT_TOKEN,
+        db_path="finance.db",
+        readers=4,
+        group_commit=False,
+        cache_size=10000,
+        shards=1,
+        runtime="polling",
+        workers=16,
+        threaded=True,
+        num_threads=2,
+        global_rate=30.0,
+        chat_rate=1.0,
+        chat_burst=3,
+        sender_workers=8,
+    ):
+        """
+        :param token: Токен бота
+        :type token: str
+        :param db_path: Файл базы
+        :type db_path: str
+        :param readers: Соединения для чтения в пуле каждой базы
+        :type readers: int
+        :param group_commit: Включить групповую фиксацию записей
+        :type group_commit: bool
+        :param cache_size: Размер кэшей FinanceDB, 0 - без кэша
+        :type cache_size: int
+        :param shards: Количество шардов, 1 - одна база db_path
+        :type shards: int
+        :param runtime: Режим работы бота
+        :type runtime: str
+        :param workers: Потоки обработчиков в режимах async и webhook
+        :type workers: int
+        :param threaded: Выполнять ли хендлеры TeleBot в пуле потоков
+        :type threaded: bool
+        :param num_threads: Размер пула потоков TeleBot
+        :type num_threads: int
+        :param global_rate: Лимит Outbox, сообщений в секунду на бота
+        :type global_rate: float
+        :param chat_rate: Лимит Outbox, сообщений в секунду в чат
+        :type chat_rate: float
+        :param chat_burst: Сколько сообщений в чат Outbox шлет подряд
+        :type chat_burst: int
+        :param sender_workers: Потоки отправки Outbox
+        :type sender_workers: int
+        """
+        self.token = token
+        self.db_path = db_path
+        self.readers = readers
+        self.group_commit = group_commit
+        self.cache_size = cache_size
+        self.shards = shards
+        self.runtime = runtime
+        self.workers = workers
+        self.threaded = threaded
+        self.num_threads = num_threads
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.sender_workers = sender_workers
+
+    @classmethod
+    def from_env(cls, **overrides):
+        """Настройки по умолчанию с токеном и файлом базы из окружения:
+        FINANCE_BOT_TOKEN и FINANCE_DB.
+
+        :param overrides: Настройки, которые задать явно
+        :return: Настройки приложения
+        :rtype: AppConfig
+        """
+        options = {
+            "token": os.environ.get("FINANCE_BOT_TOKEN", BOT_TOKEN),
+            "db_path": os.environ.get("FINANCE_DB", "finance.db"),
+        }
+        options.update(overrides)
+        return cls(**options)
+
+
+class App:
+    """Бот, база и очереди одного экземпляра приложения.
+
+    Хендлеры модуля получают приложение первым аргументом и работают
+    только с его частями, поэтому несколько приложений в одном процессе
+    не мешают друг другу.
+
+    :ivar config: Настройки, по которым собрано приложение
+    :vartype config: AppConfig
+
+    :ivar bot: Бот с зарегистрированными хендлерами
+    :vartype bot: telebot.TeleBot
+
+    :ivar db: База данных
+    :vartype db: FinanceDB или ShardedFinanceDB
+
+    :ivar user_state: Хранилище состояния многошаговых операций, типо
+        добавления расходов: текущий шаг диалога пользователя и выбранная
+        категория. Хранится в таблице conversation_state шарда
+        пользователя, поэтому переживает перезапуск бота, а брошенные
+        диалоги забываются через час
+    :vartype user_state: finance_state.SQLiteStateStore или
+        finance_state.ShardedStateStore
+
+    :ivar sender: Очередь исходящих сообщений: хендлеры ставят ответы в
+        нее и сразу возвращаются, а отправку с учетом лимитов Telegram и
+        ошибок 429 ведут потоки Outbox
+    :vartype sender: finance_outbox.Outbox
+
+    :ivar exporter: Выгрузка истории расходов файлом в отдельном пуле из
+        двух потоков
+    :vartype exporter: finance_export.Exporter
+
+    :ivar charts: Графики статистики: рисуются в процессе пула и
+        кэшируются вместе с file_id. Работает, если установлен matplotlib
+    :vartype charts: finance_charts.ChartRenderer
+    """
+
+    PARTS = ("bot", "db", "user_state", "sender", "exporter", "charts")
+
+    def __init__(self, config):
+        """
+        Создает бота, открывает базу и регистрирует хендлеры
+
+        :param config: Настройки приложения
+        :type config: AppConfig
+
+        :raises sqlite3.Error: Если не удалось открыть базу данных
+        """
+        # Части, которые нужны только собранному приложению, импортируются
+        # здесь, чтобы импорт модуля их не загружал
+        from finance_charts import ChartRenderer
+        from finance_export import Exporter
+        from finance_outbox import Outbox
+        from finance_shards import ShardedFinanceDB
+        from finance_state import ShardedStateStore, SQLiteStateStore
+
+        self.config = config
+        self.bot = telebot.TeleBot(
+            config.token,
+            threaded=config.threaded,
+            num_threads=config.num_threads,
+        )
+        options = {
+            "readers": config.readers,
+            "group_commit": config.group_commit,
+            "cache_size": config.cache_size,
+        }
+        if config.shards > 1:
+            self.db = ShardedFinanceDB(
+                config.db_path, config.shards, factory=FinanceDB, **options
+            )
+            self.user_state = ShardedStateStore(
+                [SQLiteStateStore(shard.pool) for shard in self.db.shards]
+            )
+        else:
+            self.db = FinanceDB(config.db_path, **options)
+            self.user_state = SQLiteStateStore(self.db.pool)
+        self.sender = Outbox(
+            self.bot,
+            global_rate=config.global_rate,
+            chat_rate=config.chat_rate,
+            chat_burst=config.chat_burst,
+            workers=config.sender_workers,
+        )
+        self.exporter = Exporter(self.sender, self.db)
+        self.charts = ChartRenderer(self.sender)
+        register_handlers(self)
+
+    def close(self):
+        """Дожидается отправки сообщений и выгрузок и закрывает базу.
+
+        :return: None
+        :rtype: None
+        """
+        self.exporter.close()
+        self.charts.close()
+        self.sender.close(timeout=10)
+        self.db.close()
+
+
+application = None
 """
-Экземпляр подключения к базе данных для управления финансовыми операциями
-Основной интерфейс для работы с хранением данных пользователей
-:type: class
+Текущее приложение, с которым работают хендлеры, или None, пока оно не
+создано
+
+:type: App или None
 """
 
+_application_lock = threading.Lock()
+
+
+def create_app(config=None):
+    """Собирает новое приложение.
+
+    Каждый вызов создает отдельные бота, базу и очереди, поэтому с
+    db_path=":memory:" можно дешево получить сколько угодно независимых
+    экземпляров для тестов и бенчмарков.
+
+    :param config: Настройки, по умолчанию AppConfig.from_env()
+    :type config: AppConfig или None
+    :return: Новое приложение, еще не текущее
+    :rtype: App
+    """
+    return App(config if config is not None else AppConfig.from_env())
+
+
+def activate(app):
+    """Делает приложение текущим: атрибуты модуля bot, db, user_state,
+    sender, exporter и charts начинают возвращать его части.
+
+    Хендлеры от текущего приложения не зависят, они работают с тем
+    приложением, на боте которого зарегистрированы.
+
+    :param app: Приложение или None, чтобы следующее обращение к bot или
+        db снова создало приложение по умолчанию
+    :type app: App или None
+    :return: Приложение, которое было текущим до вызова
+    :rtype: App или None
+    """
+    global application
+    previous = application
+    application = app
+    if app is not None:
+        registry.add_gauges("outbox", app.sender.snapshot)
+    return previous
+
+
+def __getattr__(name):
+    """Возвращает часть текущего приложения по обращению к bot, db и
+    другим его частям как к атрибутам модуля.
+
+    Если приложения еще нет, создает приложение по умолчанию, поэтому
+    импорт модуля не открывает finance.db и не создает бота.
+    """
+    if name not in App.PARTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _application_lock:
+        if application is None:
+            activate(create_app())
+        return getattr(application, name)
+
 
 def main_menu():
-    """Создает и возвращает основное меню бота для управления финансами.
+    """Возвращает основное меню бота для управления финансами.
+
+    Меню строится один раз при запуске, каждый вызов возвращает тот же
+    объект с готовым JSON.
 
-    :return: Объект клавиатуры ReplyKeyboardMarkup с основными командами
-        бота
-    :rtype: ReplyKeyboardMarkup
+    :return: Клавиатура с основными командами бота
+    :rtype: finance_keyboards.FrozenKeyboard
     """
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-    markup.add("➕ Добавить расход", "📊 Статистика")
-    markup.add("📋 История", "💰 Баланс")
-    markup.add("🗑️ Очистить все", "ℹ️ Помощь")
-    return markup
+    return keyboards["main"]
+
+
+def awaiting_input(app, message):
+    """Проверяет, ждет ли бот от пользователя ввода баланса или суммы.
+
+    :param app: Приложение, которому пришло обновление
+    :type app: App
+    :param message: Сообщение от пользователя
+    :type message: telebot.types.Message
+    :return: True если пользователь находится на шаге ввода
+    :rtype: bool
+    """
+    state = app.user_state.get(message.from_user.id)
+    return state is not None and state.get("step") in ("balance", "amount")
+
 
+@router.predicate(awaiting_input, first=True)
+def process_step(app, message):
+    """Передает сообщение обработчику текущего шага диалога.
 
-@bot.message_handler(commands=["start"])
-def start_command(message):
+    Проверяется маршрутизатором раньше команд и кнопок, поэтому, как и
+    прежний register_next_step_handler, перехватывает любое сообщение
+    пользователя, от которого бот ждет ввода. Состояние читается один
+    раз и передается обработчику шага.
+
+    :param app: Приложение, которому пришло обновление
+    :type app: App
+    :param message: Сообщение от пользователя
+    :type message: telebot.types.Message
+    :return: None
+    :rtype: None
+    """
+    state = app.user_state.get(message.from_user.id) or {}
+    if state.get("step") == "balance":
+        process_balance(app, message)
+    else:
+        process_amount(app, message, state)
+
+
+@router.command("start")
+def start_command(app, message):
     """Обработчик команды старт.
 
+    :param app: Приложение, которому пришло обновление
+    :type app: App
     :param message: Сообщение от пользователя
     :type message: telebot.types.message
     :return: None
     """
     user_id = message.from_user.id
-    balance = db.get_balance(user_id)
+    balance = app.db.get_balance(user_id)
 
     if balance is None:
-        msg = bot.send_message(message.chat.id, "💰 Введите начальный баланс:")
-        bot.register_next_step_handler(msg, process_balance)
+        app.user_state.put(user_id, {"step": "balance"})
+        app.sender.send(
+            message.chat.id,
+            "💰 Введите начальный баланс, например 1000 или 500 USD:",
+        )
     else:
-        bot.send_message(
+        app.sender.send(
             message.chat.id,
             f"💰 Ваш баланс: {balance:.2f}",
             reply_markup=main_menu(),
         )
 
 
-def process_balance(message):
+def money_label(amount, currency=None):
+    """Форматирует сумму для сообщения, с кодом валюты, если он указан.
+
+    :param amount: Сумма
+    :type amount: decimal.Decimal
+    :param currency: Код валюты
+    :type currency: str или None
+    :return: Например "10.00" или "10.00 USD"
+    :rtype: str
+    """
+    if currency is None:
+        return f"{amount:.2f}"
+    return f"{amount:.2f} {currency}"
+
+
+def budget_alert(category, alert):
+    """Форматирует предупреждение о бюджете из FinanceDB.spend().
+
+    :param category: Категория трат
+    :type category: str
+    :param alert: Кортеж (порог в процентах, потрачено, лимит)
+    :type alert: tuple
+    :return: Текст предупреждения
+    :rtype: str
+    """
+    level, spent, limit = alert
+    if level >= 100:
+        return f"🚨 Бюджет «{category}» исчерпан: {spent:.2f} из {limit:.2f}"
+    return (
+        f"⚠️ Потрачено {level}% бюджета «{category}»: "
+        f"{spent:.2f} из {limit:.2f}"
+    )
+
+
+def process_balance(app, message):
     """Обрабатывает ввод начального баланса для нового пользователя.
 
+    Валюта, указанная после суммы, становится базовой валютой
+    пользователя. При ошибке ввода пользователь остается на шаге
+    "balance" и может ввести баланс заново.
+
+    :param app: Приложение, которому пришло обновление
+    :type app: App
     :param message: Сообщение с введённым балансом от пользователя
     :type message: telebot.types.Message
     :return: None
     Связанные функции:
         - start_command(): Инициирует процесс ввода баланса
-        - db.set_balance(): Сохраняет баланс в базе данных
+        - app.db.set_balance(): Сохраняет баланс в базе данных
         - main_menu(): Возвращает главное меню бота
     """
     try:
         user_id = message.from_user.id
-        amount = float(message.text)
+        text, currency = split_currency(message.text)
+        amount = parse_money(text)
 
         if amount <= 0:
             raise ValueError("Баланс должен быть больше 0!")
+        if currency is not None:
+            app.db.rate(currency)
 
-        if db.set_balance(user_id, amount):
-            bot.send_message(
+        if app.db.set_balance(user_id, amount, currency):
+            app.user_state.pop(user_id)
+            app.sender.send(
                 message.chat.id,
-                f"✅ Баланс {amount:.2f} установлен!",
+                f"✅ Баланс {money_label(amount, currency)} установлен!",
                 reply_markup=main_menu(),
             )
         else:
-            bot.send_message(message.chat.id, "❌ Ошибка!")
+            app.user_state.pop(user_id)
+            app.sender.send(message.chat.id, "❌ Ошибка!")
     except ValueError as e:
-        bot.send_message(message.chat.id, f"❌ {e}")
-        bot.register_next_step_handler(message, process_balance)
+        app.sender.send(message.chat.id, f"❌ {e}")
     except Exception as e:
         logger.error(f"Ошибка в process_balance: {e}")
-        bot.send_message(message.chat.id, "❌ Ошибка!")
-        bot.register_next_step_handler(message, process_balance)
+        app.sender.send(message.chat.id, "❌ Ошибка!")
 
 
-@bot.message_handler(func=lambda msg: msg.text == "➕ Добавить расход")
-def add_expense_start(message):
+@router.text("➕ Добавить расход")
+def add_expense_start(app, message):
     """Начинает процесс добавления нового расхода.
 
+    :param app: Приложение, которому пришло обновление
+    :type app: App
     :param message: Сообщение от пользователя
     :type message: telebot.types.Message
     :return: None
     :rtype: None
     """
     user_id = message.from_user.id
-    if db.get_balance(user_id) is None:
-        bot.send_message(message.chat.id, "Сначала установите баланс!")
+    if app.db.get_balance(user_id) is None:
+        app.sender.send(message.chat.id, "Сначала установите баланс!")
         return
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-    markup.add("🍔 Еда", "🚗 Транспорт")
-    markup.add("🎬 Развлечения", "👕 Одежда")
-    markup.add("🏠 Жилье", "📱 Связь")
-    markup.add("⬅️ Назад")
-
-    user_temp[user_id] = {"step": "category"}
-    bot.send_message(
-        message.chat.id, "📁 Выберите категорию:", reply_markup=markup
+    app.user_state.put(user_id, {"step": "category"})
+    app.sender.send(
+        message.chat.id,
+        "📁 Выберите категорию:",
+        reply_markup=keyboards["categories"],
     )
 
 
-@bot.message_handler(
-    func=lambda msg: msg.text
-    in [
-        "🍔 Еда",
-        "🚗 Транспорт",
-        "🎬 Развлечения",
-        "👕 Одежда",
-        "🏠 Жилье",
-        "📱 Связь",
-    ]
-)
-def process_category(message):
+@router.text(*CATEGORY_BUTTONS)
+def process_category(app, message):
     """Обрабатывает выбор категории расхода и переходит к вводу суммы.
 
     Этот хендлер сохраняет выбранную пользователем категорию расходов
-    и инициирует следующий шаг - ввод суммы расхода.
+    в user_state и инициирует следующий шаг - ввод суммы расхода.
 
+    :param app: Приложение, которому пришло обновление
+    :type app: App
     :param message: Сообщение с выбранной категорией
     :type message: telebot.types.Message
     :return: None
@@ -373,98 +1822,106 @@ def process_category(message):
     user_id = message.from_user.id
     category = message.text[2:]
 
-    if user_id not in user_temp:
-        user_temp[user_id] = {}
-    user_temp[user_id]["category"] = category
-    user_temp[user_id]["step"] = "amount"
-    markup = types.ReplyKeyboardRemove()
-    bot.send_message(message.chat.id, "💵 Введите сумму:", reply_markup=markup)
-    bot.register_next_step_handler(message, process_amount)
+    app.user_state.put(user_id, {"step": "amount", "category": category})
+    app.sender.send(
+        message.chat.id, "💵 Введите сумму:", reply_markup=keyboards["remove"]
+    )
 
 
-def process_amount(message):
+def process_amount(app, message, state):
     """Обрабатывает ввод суммы расхода и сохраняет запись в базу данных.
 
+    :param app: Приложение, которому пришло обновление
+    :type app: App
     :param message: Сообщение с введённой суммой расхода
     :type message: telebot.types.Message
+    :param state: Состояние диалога, прочитанное process_step()
+    :type state: dict
     :return: None
     :rtype: None
-    :raises ValueError: Если message.text не может быть преобразован в
-        float или amount <= 0
-    :raises sqlite3.Error: При ошибках SQLite в методах db.add_expense()
-        или db.get_balance()
+    :raises ValueError: Если message.text не является суммой с точностью
+        до копеек, amount <= 0 или курс указанной валюты неизвестен
+    :raises sqlite3.Error: При ошибках SQLite в методе app.db.spend()
     :raises Exception: При любых других ошибках
     """
     try:
         user_id = message.from_user.id
 
-        if user_id not in user_temp or "category" not in user_temp[user_id]:
-            bot.send_message(
+        if "category" not in state:
+            app.sender.send(
                 message.chat.id,
                 "❌ Ошибка! Начните заново.",
                 reply_markup=main_menu(),
             )
             return
 
-        amount = float(message.text)
+        text, currency = split_currency(message.text)
+        amount = parse_money(text)
 
         if amount <= 0:
             raise ValueError("Сумма должна быть больше 0!")
-
-        category = user_temp[user_id]["category"]
-
-        if db.add_expense(user_id, category, amount):
-            balance = db.get_balance(user_id)
-            bot.send_message(
-                message.chat.id,
-                f"✅ Добавлено!\n📁 {category}: {amount:.2f}\n"
-                f"💰 Остаток: {balance:.2f}",
-                reply_markup=main_menu(),
+        if currency is not None:
+            app.db.rate(currency)
+
+        category = state["category"]
+
+        result = app.db.spend(user_id, category, amount, currency)
+        if result is not None:
+            balance, alert = result
+            text = (
+                f"✅ Добавлено!\n📁 {category}: "
+                f"{money_label(amount, currency)}\n"
+                f"💰 Остаток: {balance:.2f}"
             )
+            if alert is not None:
+                text += "\n\n" + budget_alert(category, alert)
+            app.sender.send(message.chat.id, text, reply_markup=main_menu())
         else:
-            bot.send_message(
+            app.sender.send(
                 message.chat.id,
                 "❌ Недостаточно средств!",
                 reply_markup=main_menu(),
             )
 
-        user_temp.pop(user_id, None)
+        app.user_state.pop(user_id)
 
-    except ValueError:
-        bot.send_message(
-            message.chat.id, "❌ Введите число!", reply_markup=main_menu()
-        )
-        user_temp.pop(user_id, None)
+    except ValueError as e:
+        app.sender.send(message.chat.id, f"❌ {e}", reply_markup=main_menu())
+        app.user_state.pop(user_id)
     except Exception as e:
         logger.error(f"Ошибка в process_amount: {e}")
-        bot.send_message(
+        app.sender.send(
             message.chat.id, "❌ Ошибка!", reply_markup=main_menu()
         )
-        user_temp.pop(user_id, None)
+        app.user_state.pop(user_id)
 
 
-@bot.message_handler(func=lambda msg: msg.text == "📊 Статистика")
-def show_stats(message):
+@router.text("📊 Статистика")
+def show_stats(app, message):
     """Отображает статистику расходов пользователя по категориям.
 
     Показывает упорядоченные данные о всех расходах пользователя,
     сгруппированные по категориям с суммой трат по каждой категории.
 
+    :param app: Приложение, которому пришло обновление
+    :type app: App
     :param message: Сообщение от пользователя
     :type message: telebot.types.Message
     :return: None
     :rtype: None
-    :raises: Неявно обрабатывает исключения через db.get_stats(),
+    :raises: Неявно обрабатывает исключения через app.db.get_stats(),
     возвращающую пустой словарь при ошибках
     Связанные функции:
-        - db.get_stats(): SQL-запрос: SELECT category... и тд
+        - app.db.get_stats(): SQL-запрос: SELECT category... и тд
         - main_menu(): Возврат к главному меню после показа статистики
+        - app.charts.submit(): График по категориям и месяцам вслед за
+          текстом, если установлен matplotlib
     """
     user_id = message.from_user.id
-    stats = db.get_stats(user_id)
+    stats = app.db.get_stats(user_id)
 
     if not stats:
-        bot.send_message(
+        app.sender.send(
             message.chat.id, "📊 Нет расходов", reply_markup=main_menu()
         )
         return
@@ -472,119 +1929,426 @@ def show_stats(message):
     for category, total in stats.items():
         text += f"{category}: {total:.2f}\n"
 
-    bot.send_message(message.chat.id, text, reply_markup=main_menu())
+    app.sender.send(message.chat.id, text, reply_markup=main_menu())
+    from finance_charts import CHARTS_AVAILABLE
 
+    if CHARTS_AVAILABLE:
+        try:
+            months = monthly_totals(app.db, user_id)
+        except Exception as e:
+            logger.error(f"Ошибка получения сумм по месяцам: {e}")
+            return
+        app.charts.submit(message.chat.id, user_id, stats, months)
 
-@bot.message_handler(func=lambda msg: msg.text == "📋 История")
-def show_history(message):
+
+@router.text("📅 Месяц")
+def show_month(app, message):
+    """Сравнивает расходы текущего месяца с прошлым по категориям.
+
+    :param app: Приложение, которому пришло обновление
+    :type app: App
+    :param message: Сообщение от пользователя
+    :type message: telebot.types.Message
+    :return: None
+    :rtype: None
+    """
+    try:
+        months = compare_months(app.db, message.from_user.id)
+    except Exception as e:
+        logger.error(f"Ошибка сравнения месяцев: {e}")
+        months = {}
+    if not months:
+        app.sender.send(
+            message.chat.id,
+            "📅 Нет расходов за два месяца",
+            reply_markup=main_menu(),
+        )
+        return
+    text = "📅 Этот месяц (прошлый):\n"
+    for category, (this, last) in months.items():
+        change = f", {(this - last) / last:+.0%}" if last else ""
+        text += f"{category}: {this:.2f} ({last:.2f}{change})\n"
+    this = sum(this for this, _ in months.values())
+    last = sum(last for _, last in months.values())
+    text += f"\nИтого: {this:.2f} ({last:.2f})"
+    app.sender.send(message.chat.id, text, reply_markup=main_menu())
+
+
+@router.text("📈 Средние")
+def show_averages(app, message):
+    """Показывает средние расходы за последние дни, недели и месяцы.
+
+    :param app: Приложение, которому пришло обновление
+    :type app: App
+    :param message: Сообщение от пользователя
+    :type message: telebot.types.Message
+    :return: None
+    :rtype: None
+    """
+    user_id = message.from_user.id
+    try:
+        daily = rolling_average(app.db, user_id, "d", 7)
+        weekly = rolling_average(app.db, user_id, "w", 4)
+        monthly = rolling_average(app.db, user_id, "m", 3)
+    except Exception as e:
+        logger.error(f"Ошибка расчета средних: {e}")
+        daily = weekly = monthly = {}
+    if not monthly:
+        app.sender.send(
+            message.chat.id,
+            "📈 Нет расходов за 3 месяца",
+            reply_markup=main_menu(),
+        )
+        return
+    text = (
+        "📈 Средние расходы:\n"
+        f"За 7 дней: {sum(daily.values()):.2f} в день\n"
+        f"За 4 недели: {sum(weekly.values()):.2f} в неделю\n"
+        f"За 3 месяца: {sum(monthly.values()):.2f} в месяц\n"
+        "\nПо категориям, в неделю:\n"
+    )
+    for category, average in weekly.items():
+        text += f"{category}: {average:.2f}\n"
+    app.sender.send(message.chat.id, text, reply_markup=main_menu())
+
+
+def format_history(rows):
+    """Форматирует записи истории расходов в текст сообщения.
+
+    :param rows: Записи (category, amount, date)
+    :type rows: list[tuple]
+    :return: Текст со строкой на каждый расход
+    :rtype: str
+    :raises ValueError: Если дата из БД имеет некорректный формат
+    """
+    text = "📋 История:\n"
+    for category, amount, date in rows:
+        date_str = datetime.strptime(date[:10], "%Y-%m-%d").strftime("%d.%m")
+        text += f"{date_str}: {category} - {amount:.2f}\n"
+    return text
+
+
+def history_markup(older, newer):
+    """Создает инлайн-клавиатуру для листания истории.
+
+    Ключ страницы (date, id) передается в callback_data в виде
+    ``hist:o:<date>|<id>`` для более старых и ``hist:n:<date>|<id>`` для
+    более новых записей.
+
+    :param older: Ключ для более старой страницы или None
+    :type older: tuple или None
+    :param newer: Ключ для более новой страницы или None
+    :type newer: tuple или None
+    :return: Клавиатура или None, если листать некуда
+    :rtype: InlineKeyboardMarkup или None
+    """
+    buttons = []
+    if older is not None:
+        buttons.append(types.InlineKeyboardButton(
+            "⬅️ Раньше", callback_data=f"hist:o:{older[0]}|{older[1]}"
+        ))
+    if newer is not None:
+        buttons.append(types.InlineKeyboardButton(
+            "Позже ➡️", callback_data=f"hist:n:{newer[0]}|{newer[1]}"
+        ))
+    if not buttons:
+        return None
+    markup = types.InlineKeyboardMarkup()
+    markup.row(*buttons)
+    return markup
+
+
+def parse_history_key(data):
+    """Разбирает callback_data кнопки листания истории.
+
+    :param data: callback_data вида ``hist:o:<date>|<id>``, см.
+        history_markup()
+    :type data: str
+    :return: Кортеж (направление "o" или "n", ключ (date, id))
+    :rtype: tuple[str, tuple[str, int]]
+    :raises ValueError: Если данные не похожи на кнопку истории, например
+        подделаны или остались от старой версии бота
+    """
+    prefix, direction, key = (data.split(":", 2) + ["", ""])[:3]
+    date, _, expense_id = key.rpartition("|")
+    if prefix != "hist" or direction not in ("o", "n") or not date:
+        raise ValueError(f"Некорректная кнопка истории: {data!r}")
+    return direction, (date, int(expense_id))
+
+
+@router.text("📋 История")
+def show_history(app, message):
     """Отображает историю последних расходов пользователя Показывает последние
     5 записей о расходах пользователя в обратном хронологическом порядке с
-    датой.
+    датой. Если записей больше, под сообщением появляются кнопки для
+    листания истории.
 
+    :param app: Приложение, которому пришло обновление
+    :type app: App
     :param message: Сообщение от пользователя
     :type message: telebot.types.Message
     :return: None
     :rtype: None
-    :raises: Неявно обрабатывает исключения через db.get_history(),
-        возвращающую пустой список при ошибках
+    :raises: Неявно обрабатывает исключения через app.db.get_history_page(),
+        возвращающую пустую страницу при ошибках
     :raises ValueError: Если дата из БД имеет некорректный формат
     """
     user_id = message.from_user.id
-    history = db.get_history(user_id)
+    history, older, newer = app.db.get_history_page(user_id)
 
     if not history:
-        bot.send_message(
+        app.sender.send(
             message.chat.id, "📋 Нет расходов", reply_markup=main_menu()
         )
         return
-    text = "📋 История:\n"
-    for category, amount, date in history:
-        date_str = datetime.strptime(date[:10], "%Y-%m-%d").strftime("%d.%m")
-        text += f"{date_str}: {category} - {amount:.2f}\n"
 
-    bot.send_message(message.chat.id, text, reply_markup=main_menu())
+    markup = history_markup(older, newer) or main_menu()
+    app.sender.send(
+        message.chat.id, format_history(history), reply_markup=markup
+    )
 
 
-@bot.message_handler(func=lambda msg: msg.text == "💰 Баланс")
-def show_balance(message):
+@registry.timed("handler")
+def history_page(app, call):
+    """Листает историю расходов по нажатию инлайн-кнопки.
+
+    Ключ страницы берется из callback_data, сообщение с историей
+    редактируется на месте. На нажатие отвечается всегда, даже если
+    кнопка некорректна, иначе у пользователя не пропадет индикатор
+    загрузки.
+
+    :param app: Приложение, которому пришло обновление
+    :type app: App
+    :param call: Нажатие инлайн-кнопки
+    :type call: telebot.types.CallbackQuery
+    :return: None
+    :rtype: None
+    """
+    try:
+        direction, key = parse_history_key(call.data)
+    except ValueError as e:
+        logger.warning(f"Кнопка истории {call.data!r} отклонена: {e}")
+        app.sender.call(
+            call.message.chat.id,
+            "answer_callback_query",
+            call.id,
+            "❌ Кнопка устарела",
+        )
+        return
+    if direction == "o":
+        history, older, newer = app.db.get_history_page(
+            call.from_user.id, before=key
+        )
+    else:
+        history, older, newer = app.db.get_history_page(
+            call.from_user.id, after=key
+        )
+
+    if not history:
+        app.sender.call(
+            call.message.chat.id,
+            "answer_callback_query",
+            call.id,
+            "Больше записей нет",
+        )
+        return
+    chat_id = call.message.chat.id
+    app.sender.call(
+        chat_id,
+        "edit_message_text",
+        format_history(history),
+        chat_id,
+        call.message.message_id,
+        reply_markup=history_markup(older, newer),
+    )
+    app.sender.call(chat_id, "answer_callback_query", call.id)
+
+
+@router.command("export")
+def export_command(app, message):
+    """Выгружает всю историю расходов пользователя документом.
+
+    Формат задается аргументом команды: ``/export`` - CSV,
+    ``/export xlsx`` - Excel. Файл готовит и отправляет exporter приложения, а
+    хендлер сразу возвращается.
+
+    :param app: Приложение, которому пришло обновление
+    :type app: App
+    :param message: Сообщение от пользователя
+    :type message: telebot.types.Message
+    :return: None
+    :rtype: None
+    """
+    fmt = (util.extract_arguments(message.text) or "csv").strip().lower()
+    if fmt not in ("csv", "xlsx"):
+        app.sender.send(message.chat.id, "❌ Формат: /export или /export xlsx")
+        return
+    from finance_export import XLSX_AVAILABLE
+
+    if fmt == "xlsx" and not XLSX_AVAILABLE:
+        app.sender.send(message.chat.id, "XLSX недоступен, отправлю CSV")
+        fmt = "csv"
+    future = app.exporter.submit(
+        message.chat.id,
+        message.from_user.id,
+        fmt,
+        notice="⏳ Готовлю файл...",
+    )
+    if future is None:
+        app.sender.send(message.chat.id, "⏳ Выгрузка уже готовится")
+        return
+
+    def done(future):
+        if future.exception() is not None:
+            app.sender.send(message.chat.id, "❌ Ошибка выгрузки!")
+        elif not future.result():
+            app.sender.send(
+                message.chat.id, "📋 Нет расходов", reply_markup=main_menu()
+            )
+
+    future.add_done_callback(done)
+
+
+@router.command("budget")
+def budget_command(app, message):
+    """Показывает или устанавливает месячные бюджеты по категориям.
+
+    ``/budget`` - список бюджетов и трат за месяц, ``/budget Еда 5000``
+    - установить бюджет категории, ``/budget Еда 0`` - удалить его.
+    Лимит задается в базовой валюте пользователя.
+
+    :param app: Приложение, которому пришло обновление
+    :type app: App
+    :param message: Сообщение от пользователя
+    :type message: telebot.types.Message
+    :return: None
+    :rtype: None
+    """
+    user_id = message.from_user.id
+    if app.db.get_balance(user_id) is None:
+        app.sender.send(message.chat.id, "Сначала установите баланс!")
+        return
+    args = (util.extract_arguments(message.text) or "").split(maxsplit=1)
+    if args:
+        categories = {
+            button[2:].lower(): button[2:] for button in CATEGORY_BUTTONS
+        }
+        category = categories.get(args[0].lower())
+        if category is None or len(args) < 2:
+            app.sender.send(
+                message.chat.id,
+                "❌ Формат: /budget Еда 5000, 0 - удалить бюджет\n"
+                f"Категории: {', '.join(categories.values())}",
+            )
+            return
+        try:
+            amount = parse_money(args[1])
+        except ValueError as e:
+            app.sender.send(message.chat.id, f"❌ {e}")
+            return
+        if amount < 0 or not app.db.set_budget(user_id, category, amount):
+            app.sender.send(message.chat.id, "❌ Ошибка!")
+            return
+    budgets = app.db.get_budgets(user_id)
+    if not budgets:
+        app.sender.send(
+            message.chat.id,
+            "🎯 Бюджетов нет. Установить: /budget Еда 5000",
+            reply_markup=main_menu(),
+        )
+        return
+    text = "🎯 Бюджеты на месяц:\n"
+    for category, (limit, spent) in budgets.items():
+        text += f"{category}: {spent:.2f} из {limit:.2f} "
+        text += f"({spent / limit:.0%})\n"
+    app.sender.send(message.chat.id, text, reply_markup=main_menu())
+
+
+@router.text("💰 Баланс")
+def show_balance(app, message):
     """Отображает текущий баланс пользователя Показывает актуальный остаток
     средств пользователя, полученный из базы данных Если баланс не установлен,
     предлагает установить его через команду /start.
 
+    :param app: Приложение, которому пришло обновление
+    :type app: App
     :param message: Сообщение от пользователя
     :type message: telebot.types.Message
     :return: None
     :rtype: None
-    :raises: Неявно обрабатывает исключения через db.get_balance(),
+    :raises: Неявно обрабатывает исключения через app.db.get_balance(),
         возвращающую None при ошибках
     """
     user_id = message.from_user.id
-    balance = db.get_balance(user_id)
+    balance = app.db.get_balance(user_id)
     if balance is None:
-        bot.send_message(message.chat.id, "Сначала установите баланс!")
+        app.sender.send(message.chat.id, "Сначала установите баланс!")
     else:
-        bot.send_message(
+        app.sender.send(
             message.chat.id,
             f"💰 Баланс: {balance:.2f}",
             reply_markup=main_menu(),
         )
 
 
-@bot.message_handler(func=lambda msg: msg.text == "🗑️ Очистить все")
-def clear_start(message):
+@router.text("🗑️ Очистить все")
+def clear_start(app, message):
     """Инициирует процесс полного удаления всех данных пользователя Показывает
     подтверждающее меню с двумя вариантами ответа перед выполнением опасной
     операции полного удаления данных пользователя из базы данных.
 
+    :param app: Приложение, которому пришло обновление
+    :type app: App
     :param message: Сообщение от пользователя
     :type message: telebot.types.Message
     :return: None
     :rtype: None
     """
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-    markup.add("✅ Да, очистить", "❌ Нет, отмена")
-
-    bot.send_message(
-        message.chat.id, "⚠️ Удалить ВСЕ данные?", reply_markup=markup
+    app.sender.send(
+        message.chat.id,
+        "⚠️ Удалить ВСЕ данные?",
+        reply_markup=keyboards["confirm_clear"],
     )
 
 
-@bot.message_handler(func=lambda msg: msg.text == "✅ Да, очистить")
-def clear_confirm(message):
+@router.text("✅ Да, очистить")
+def clear_confirm(app, message):
     """Выполняет полное удаление всех данных пользователя после подтверждения
-    Финальный шаг в цепочке удаления данных. Вызывает db.clear_data(), которая
-    полностью удаляет пользователя из системы, включая баланс и всю историю
-    расходов.
+    Финальный шаг в цепочке удаления данных. Вызывает clear_data() базы
+    приложения, которая полностью удаляет пользователя из системы, включая
+    баланс и всю историю расходов.
 
+    :param app: Приложение, которому пришло обновление
+    :type app: App
     :param message: Сообщение подтверждения от пользователя
     :type message: telebot.types.Message
     :return: None
     :rtype: None
-    :raises: Неявно обрабатывает исключения через db.clear_data(),
+    :raises: Неявно обрабатывает исключения через app.db.clear_data(),
         возвращающую False при ошибках
     """
     user_id = message.from_user.id
 
-    if db.clear_data(user_id):
-        bot.send_message(
+    if app.db.clear_data(user_id):
+        app.sender.send(
             message.chat.id, "✅ Данные удалены!", reply_markup=main_menu()
         )
     else:
-        bot.send_message(
+        app.sender.send(
             message.chat.id, "❌ Ошибка!", reply_markup=main_menu()
         )
 
 
-@bot.message_handler(
-    func=lambda msg: msg.text in ["❌ Нет, отмена", "⬅️ Назад", "ℹ️ Помощь"]
-)
-def cancel_or_help(message):
+@router.text("❌ Нет, отмена", "⬅️ Назад", "ℹ️ Помощь")
+def cancel_or_help(app, message):
     """
     Обрабатывает команды "Помощь" и "Назад", обеспечивая навигацию по боту
     Универсальный хендлер для двух распространённых действий:
     1. Показ справочной информации о функциях бота
     2. Возврат в главное меню из любого места
 
+    :param app: Приложение, которому пришло обновление
+    :type app: App
     :param message: Сообщение от пользователя
     :type message: telebot.types.Message
     :return: None
@@ -594,26 +2358,33 @@ def cancel_or_help(message):
         text = """ℹ️ Помощь:
 ➕ Добавить расход - добавить новый расход
 📊 Статистика - статистика по категориям
+📅 Месяц - этот месяц в сравнении с прошлым
+📈 Средние - средние расходы в день, неделю и месяц
 📋 История - последние расходы
+💱 Сумму можно ввести в другой валюте: 10 USD, 10$ или 10€
 💰 Баланс - текущий баланс
 🗑️ Очистить все - удалить все данные
+/export - выгрузить все расходы в CSV, /export xlsx - в Excel
+/budget - бюджеты на месяц, /budget Еда 5000 - установить бюджет
 
 💡 Сначала установите баланс командой /start"""
-        bot.send_message(message.chat.id, text, reply_markup=main_menu())
+        app.sender.send(message.chat.id, text, reply_markup=main_menu())
     else:
-        bot.send_message(
+        app.sender.send(
             message.chat.id, "⬅️ Возврат в меню", reply_markup=main_menu()
         )
 
 
-@bot.message_handler(func=lambda msg: True)
-def unknown_message(message):
+@router.default
+def unknown_message(app, message):
     """
     Обрабатывает неизвестные или некорректные сообщения от пользователя.
     Функция, которая перехватывает все сообщения, не обработанные
     другими хендлерами, предоставляет пользователю инструкцию по корректному
     использованию бота и возвращает его в главное меню.
 
+    :param app: Приложение, которому пришло обновление
+    :type app: App
     :param message: Любое сообщение от пользователя,
         не соответствующее заданным внутри моего бота
     :type message: telebot.types.Message
@@ -624,13 +2395,143 @@ def unknown_message(message):
     - main_menu(): Главное меню, куда возвращается пользователь
     - Все другие хендлеры: обрабатывают известные функции перед выводом
     """
-    bot.send_message(
+    app.sender.send(
         message.chat.id,
         "Используйте кнопки меню или /start",
         reply_markup=main_menu(),
     )
 
 
+def register_handlers(app):
+    """Регистрирует хендлеры модуля на боте приложения.
+
+    Каждый хендлер получает это приложение первым аргументом.
+
+    :param app: Приложение
+    :type app: App
+    :return: None
+    :rtype: None
+    """
+    router.install(app.bot, app)
+
+    def history_callback(call):
+        history_page(app, call)
+
+    app.bot.register_callback_query_handler(
+        history_callback, func=lambda call: call.data.startswith("hist:")
+    )
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бот-трекер расходов")
+    parser.add_argument(
+        "--runtime",
+        choices=["polling", "async", "webhook"],
+        default="polling",
+        help="polling - TeleBot с потоками, async - AsyncTeleBot, "
+        "webhook - встроенный HTTP-сервер вебхука",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=16,
+        help="потоки для обработчиков и базы в режимах async и webhook",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="адрес вебхука")
+    parser.add_argument("--port", type=int, default=8443, help="порт вебхука")
+    parser.add_argument(
+        "--secret",
+        default=os.environ.get("FINANCE_WEBHOOK_SECRET"),
+        help="секретный токен вебхука",
+    )
+    parser.add_argument(
+        "--queue-size", type=int, default=1000, help="очередь вебхука"
+    )
+    parser.add_argument(
+        "--webhook-url",
+        help="публичный адрес вебхука, который зарегистрировать в Telegram",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="разделить пользователей по стольким файлам finance.N.db",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="порт, на котором отдавать /metrics для Prometheus",
+    )
+    parser.add_argument(
+        "--metrics-sample",
+        type=float,
+        default=1.0,
+        help="доля вызовов, время которых попадает в гистограммы",
+    )
+    parser.add_argument(
+        "--slow-query-ms",
+        type=float,
+        default=100.0,
+        help="записывать в журнал SQL-запросы дольше стольких мс, "
+        "0 - не записывать",
+    )
+    args = parser.parse_args()
+
+    registry.sample_rate = args.metrics_sample
+    registry.slow_query = args.slow_query_ms / 1000 or None
+    metrics_server = None
+    if args.metrics_port is not None:
+        from finance_metrics import MetricsServer
+
+        metrics_server = MetricsServer(
+            registry, host=args.host, port=args.metrics_port
+        ).start()
+
+    activate(
+        create_app(
+            AppConfig.from_env(
+                shards=args.shards,
+                runtime=args.runtime,
+                workers=args.workers,
+                threaded=args.runtime != "webhook",
+            )
+        )
+    )
+    if os.path.exists(RATES_FILE):
+        application.db.load_rates(RATES_FILE)
     print("Бот запущен...")
-    bot.polling(none_stop=True)
+    try:
+        if application.config.runtime == "async":
+            from finance_async import AsyncRuntime
+
+            runtime = AsyncRuntime(
+                application.bot, workers=application.config.workers
+            )
+            # Хендлеры уже перенесены на асинхронный бот, дальше Outbox
+            # обращается к Telegram через фасад
+            application.bot = runtime.bridge
+            application.sender.bot = runtime.bridge
+            runtime.run()
+        elif application.config.runtime == "webhook":
+            from finance_webhook import WebhookServer
+
+            server = WebhookServer(
+                application.bot,
+                host=args.host,
+                port=args.port,
+                secret_token=args.secret,
+                workers=application.config.workers,
+                queue_size=args.queue_size,
+            )
+            registry.add_gauges("webhook", server.snapshot)
+            if args.webhook_url:
+                application.bot.set_webhook(
+                    args.webhook_url, secret_token=args.secret
+                )
+            server.serve_forever()
+        else:
+            application.bot.polling(none_stop=True)
+    finally:
+        application.close()
+        if metrics_server is not None:
+            metrics_server.stop()